@@ -0,0 +1,161 @@
+'''Runs a per filament calculation over batches of filaments in a process pool.
+
+The particle columns the calculation needs are copied once into shared memory,
+so each worker only receives the names of the blocks and the range of filaments
+to work on rather than pickled copies of the data. Workers write their results
+straight into a shared output column, so the result is in filament order and
+is exactly what a serial run gives.
+'''
+
+import concurrent.futures
+from multiprocessing import shared_memory
+import time
+
+import numpy as np
+
+from filtools import perf_report
+
+#Number of filaments sent to a worker at a time
+DEFAULT_CHUNK_SIZE = 256
+
+
+class sharedArrays(object):
+
+    '''Copies a dictionary of numpy arrays into shared memory blocks. spec is
+    what a worker needs to attach to them with attachSharedArrays
+
+    Use as a context manager so the blocks are always freed'''
+
+    def __init__(self, arrays):
+        self.blocks = []
+        self.arrays = {}
+        self.spec = {}
+
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            block = shared_memory.SharedMemory(create = True, size = max(array.nbytes, 1))
+            self.blocks.append(block)
+
+            self.arrays[name] = np.ndarray(array.shape, dtype = array.dtype, buffer = block.buf)
+            self.arrays[name][...] = array
+            self.spec[name] = (block.name, array.shape, array.dtype.str)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.arrays = {}
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+def attachSharedArrays(spec):
+
+    '''Returns the arrays described by a sharedArrays spec and the blocks
+    holding them, which have to be closed when the arrays are finished with'''
+
+    blocks = []
+    arrays = {}
+    for name, (block_name, shape, dtype) in spec.items():
+        block = shared_memory.SharedMemory(name = block_name)
+        blocks.append(block)
+        arrays[name] = np.ndarray(shape, dtype = np.dtype(dtype), buffer = block.buf)
+
+    return arrays, blocks
+
+def filamentChunks(number_of_filaments, chunk_size = DEFAULT_CHUNK_SIZE):
+    return [(start, min(start + chunk_size, number_of_filaments)) for start in range(0, number_of_filaments, max(chunk_size, 1))]
+
+def unfinishedRuns(finished, first_filament, last_filament):
+
+    '''Splits the filaments first_filament to last_filament into the runs of
+    them that aren't finished yet'''
+
+    unfinished = np.concatenate(([False], ~finished[first_filament:last_filament], [False]))
+    edges = np.flatnonzero(np.diff(unfinished.astype(np.int8))) + first_filament
+    return list(zip(edges[::2].tolist(), edges[1::2].tolist()))
+
+def _runChunk(chunk_function, spec, first_filament, last_filament, arguments):
+
+    '''Runs chunk_function on the rows of some filaments in a worker process and
+    writes its result into the shared output column. Returns how long the
+    calculation took'''
+
+    arrays, blocks = attachSharedArrays(spec)
+    try:
+        filament_offsets = arrays.pop('filament_offsets')[first_filament:last_filament + 1]
+        output = arrays.pop('output')
+        rows = slice(filament_offsets[0], filament_offsets[-1])
+
+        columns = {name:column[rows] for name, column in arrays.items()}
+        start_time = time.perf_counter()
+        output[rows] = chunk_function(columns, filament_offsets - filament_offsets[0], *arguments)
+        return time.perf_counter() - start_time
+    finally:
+        arrays = columns = output = None
+        for block in blocks:
+            block.close()
+
+def mapFilamentChunks(chunk_function, columns, filament_offsets, initial_output, arguments = (), jobs = 1, chunk_size = DEFAULT_CHUNK_SIZE, progress_message = None, checkpoint = None):
+
+    '''Works out a new particle column a batch of filaments at a time
+
+    chunk_function(columns, filament_offsets, *arguments) is given the columns
+    for the particles of some filaments (a dictionary of arrays in filament
+    order) and their offsets starting at 0, and returns the new column values
+    for those particles. It has to be a module level function so it can be
+    sent to the workers
+
+    initial_output is copied and gives the type of the new column. With more
+    than one job the batches run in a process pool. progress_message (with a %s
+    for the filament number) is printed as batches finish
+
+    checkpoint is an optional fit_checkpoint.fitCheckpoint. Filaments it has
+    already finished are skipped (its output is used in place
+    of initial_output) and each batch is recorded in it as it finishes'''
+
+    chunks = filamentChunks(len(filament_offsets) - 1, chunk_size)
+
+    if checkpoint is not None:
+        initial_output = checkpoint.output
+        chunks = [run for first_filament, last_filament in chunks for run in unfinishedRuns(checkpoint.finished, first_filament, last_filament)]
+
+    if jobs <= 1 or len(chunks) <= 1:
+        output = np.array(initial_output, copy = True)
+        for first_filament, last_filament in chunks:
+            offsets = filament_offsets[first_filament:last_filament + 1]
+            rows = slice(offsets[0], offsets[-1])
+            start_time = time.perf_counter()
+            output[rows] = chunk_function({name:column[rows] for name, column in columns.items()}, offsets - offsets[0], *arguments)
+            perf_report.recordFitBatch(first_filament, last_filament, offsets[-1] - offsets[0], time.perf_counter() - start_time)
+            if checkpoint is not None:
+                checkpoint.finishFilaments(first_filament, last_filament, rows, output[rows])
+            if progress_message is not None:
+                print(progress_message % last_filament)
+        if checkpoint is not None:
+            checkpoint.finish()
+        return output
+
+    shared_columns = dict(columns)
+    shared_columns['filament_offsets'] = np.asarray(filament_offsets, dtype = np.int64)
+    shared_columns['output'] = initial_output
+
+    with sharedArrays(shared_columns) as shared:
+        with concurrent.futures.ProcessPoolExecutor(max_workers = min(jobs, len(chunks))) as pool:
+            futures = [pool.submit(_runChunk, chunk_function, shared.spec, first_filament, last_filament, arguments) for first_filament, last_filament in chunks]
+            for future, (first_filament, last_filament) in zip(futures, chunks):
+                chunk_seconds = future.result()
+                perf_report.recordFitBatch(first_filament, last_filament, filament_offsets[last_filament] - filament_offsets[first_filament], chunk_seconds)
+                if checkpoint is not None:
+                    rows = slice(filament_offsets[first_filament], filament_offsets[last_filament])
+                    checkpoint.finishFilaments(first_filament, last_filament, rows, shared.arrays['output'][rows])
+                if progress_message is not None:
+                    print(progress_message % last_filament)
+
+        if checkpoint is not None:
+            checkpoint.finish()
+        return shared.arrays['output'].copy()
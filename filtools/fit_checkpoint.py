@@ -0,0 +1,130 @@
+'''Checkpoints of per filament fit results, so a long fit that gets killed can
+carry on from where it stopped.
+
+A checkpoint is a .npz sidecar next to the starfile holding the new column and
+which filaments have been fitted. It is tied to a hash of the contents of the
+starfile and the fitting parameters, so it is only ever reused for exactly the
+same fit of exactly the same file. Hashing a big starfile takes a while, so it
+is only done once a checkpoint is loaded or saved. Saves are written to a
+temporary file and moved into place, so a kill part way through a save leaves
+the last one intact.
+'''
+
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+
+CHECKPOINT_VERSION = 1
+
+#Seconds between checkpoint saves
+DEFAULT_CHECKPOINT_INTERVAL = 60
+
+
+def hashStarFile(filename, block_size = 16 * 1024**2):
+    file_hash = hashlib.sha256()
+    with open(filename, 'rb') as star_file:
+        for block in iter(lambda: star_file.read(block_size), b''):
+            file_hash.update(block)
+
+    return file_hash.hexdigest()
+
+def checkpointKey(filename, parameters):
+
+    '''Hash of the starfile contents and a dictionary of fitting parameters'''
+
+    key_data = json.dumps({'version':CHECKPOINT_VERSION, 'star_hash':hashStarFile(filename), 'parameters':parameters}, sort_keys = True)
+    return hashlib.sha256(key_data.encode()).hexdigest()
+
+def checkpointPath(filename, name):
+    return '%s_%s.checkpoint.npz' % (os.path.splitext(filename)[0], name)
+
+class fitCheckpoint(object):
+
+    '''Keeps the new column for a fit and which filaments are done, saving
+    them to path at most every interval seconds
+
+    key is the checkpoint key, or a function returning it (e.g. calling
+    checkpointKey) that is only called when the key is first needed
+
+    With resume set a saved checkpoint with the same key is loaded, so output
+    starts with the values already fitted and finished marks their filaments.
+    A checkpoint with a different key is ignored and overwritten'''
+
+    def __init__(self, path, key, initial_output, number_of_filaments, interval = DEFAULT_CHECKPOINT_INTERVAL, resume = False):
+        self.path = path
+        self._key = key
+        self.saved = False
+        self.interval = interval
+        self.output = np.array(initial_output, copy = True)
+        self.finished = np.zeros(number_of_filaments, dtype = bool)
+        self.last_save = time.time()
+
+        if resume:
+            self.load()
+
+    @property
+    def key(self):
+        if callable(self._key):
+            self._key = self._key()
+        return self._key
+
+    def load(self):
+
+        '''Loads the saved checkpoint if it matches. Returns whether it did'''
+
+        try:
+            with np.load(self.path) as saved:
+                key = str(saved['key'])
+                output = saved['output']
+                finished = saved['finished']
+        except (OSError, ValueError, KeyError):
+            print('No checkpoint found at %s, starting from the beginning' % self.path)
+            return False
+
+        if key != self.key or output.shape != self.output.shape or finished.shape != self.finished.shape:
+            print('Ignoring the checkpoint %s as it was made from a different starfile or parameters' % self.path)
+            return False
+
+        self.output[...] = output
+        self.finished[...] = finished
+        print('Resuming from %s, %i of %i filaments are already fitted' % (self.path, np.count_nonzero(finished), len(finished)))
+        return True
+
+    def finishFilaments(self, first_filament, last_filament, rows, new_values):
+
+        '''Records the fitted values of filaments first_filament up to (not
+        including) last_filament, which are the particles in rows, and saves if
+        it's been long enough since the last save'''
+
+        self.output[rows] = new_values
+        self.finished[first_filament:last_filament] = True
+
+        if time.time() - self.last_save >= self.interval:
+            self.save()
+
+    def save(self):
+        temp_path = self.path + '.tmp'
+        try:
+            with open(temp_path, 'wb') as checkpoint_file:
+                np.savez_compressed(checkpoint_file, key = self.key, output = self.output, finished = self.finished)
+            os.replace(temp_path, self.path)
+            self.saved = True
+        except OSError as error:
+            #A failed save shouldn't stop the fit
+            print('Could not save the checkpoint %s: %s' % (self.path, error))
+        self.last_save = time.time()
+
+    def finish(self):
+
+        '''Saves the finished fit if it has been checkpointed before. A fit
+        that ended before its first checkpoint isn't saved'''
+
+        if self.saved:
+            self.save()
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
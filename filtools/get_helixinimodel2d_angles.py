@@ -21,7 +21,7 @@ def getAngles(stack_create_starfile, helix_inimodel2d_starfile, pixel_size):
     #iterate through the images in helix_ini2d starfile and calculate alignement angles
     for hel2dmod_particle_no in range(helix_ini2d_output.number_of_particles):
 
-        image_name = helix_ini2d_output.getParticleSpecificDataString(hel2dmod_particle_no, 'rlnImageName')
+        image_name = helix_ini2d_output.getParticleValueString(hel2dmod_particle_no, 'rlnImageName')
         psi = helix_ini2d_output.getParticleSpecificDataFloat(hel2dmod_particle_no, 'rlnAnglePsi')
         y_origin = helix_ini2d_output.getParticleSpecificDataFloat(hel2dmod_particle_no, 'rlnAnglePsi')
         x_offset_prior = helix_ini2d_output.getParticleSpecificDataFloat(hel2dmod_particle_no, 'rlnClassPriorOffsetX')
@@ -1,23 +1,230 @@
 import numpy as np
 import os
 
+from filtools import perf_report, star_cache, star_file, star_join, star_table, star_stream, star_writer
+from utils import circular
+
+
+#Columns the filament reader always needs to group the particles
+FILAMENT_COLUMNS = ['rlnMicrographName', 'rlnHelicalTubeID', 'rlnHelicalTrackLengthAngst']
+
+
+def loadParticleTableFromStar(filename, use_cache = True, usecols = None, workers = None):
+
+    '''Reads the comments, optics block and particle headers from a starfile and
+    loads the particle data into a starDataTable
+
+    The data is read in chunks so the text of the whole file is never held in
+    memory at once. Parsed files are kept in the star_cache so loading the same
+    unchanged file again skips the parsing
+
+    If usecols is given only those columns are parsed. The other columns stay
+    in the original file and are copied from it when the table is written.
+    Big files are parsed by several processes if workers is more than 1
+
+    Returns (star_comments, optics_info, headers, table)'''
+
+    with perf_report.timeStage('parse') as stage_record:
+        star_data = _readParticleTable(filename, use_cache, usecols, workers)
+        stage_record['particles'] = star_data[3].number_of_rows
+
+    return star_data
+
+def _readParticleTable(filename, use_cache, usecols, workers):
+    if use_cache:
+        cached_star = star_cache.loadCachedTable(filename)
+        if cached_star is not None:
+            star_comments, optics_info, headers, table = cached_star
+            if usecols is not None:
+                missing_columns = [name for name in usecols if name not in headers]
+                if len(missing_columns) > 0:
+                    raise ValueError('The column(s) %s are not in the starfile %s' % (', '.join(missing_columns), filename))
+                table = table.selectColumns([name for name in table.column_names if name in usecols])
+            return star_comments, optics_info, headers, table
+
+    with star_stream.starChunkReader(filename, usecols = usecols, workers = workers) as reader:
+        table = reader.readAllChunks()
+
+    #Only complete tables are cached
+    if use_cache and usecols is None:
+        star_cache.saveCachedTable(filename, reader.star_comments, reader.optics_info, table)
+
+    return reader.star_comments, reader.optics_info, reader.headers, table
+
+def angularRangeMask(anglelist, lower_limit, upper_limit):
+
+    '''Returns a boolean mask of the angles that lie within the range (or the
+    same range shifted by 180 degrees), going round the circle so ranges can
+    cross +-180'''
+
+    within_range = circular.inAngularRange(anglelist, lower_limit, upper_limit)
+    within_range |= circular.inAngularRange(anglelist, lower_limit - 180, upper_limit - 180)
+
+    return within_range
+
+def findFilamentOffsets(micrograph_names, tube_ids):
+
+    '''Returns the CSR style offsets of each filament in columns which have
+    already been sorted by micrograph and tube ID i.e. the particles of
+    filament i are in rows offsets[i]:offsets[i+1]'''
+
+    number_of_rows = len(tube_ids)
+    new_filament = np.ones(number_of_rows, dtype = bool)
+    new_filament[1:] = (micrograph_names[1:] != micrograph_names[:-1]) | (tube_ids[1:] != tube_ids[:-1])
+
+    return np.append(np.flatnonzero(new_filament), number_of_rows).astype(np.int64)
+
+#Which particle of a set of duplicates is kept
+DUPLICATE_POLICIES = ['last', 'first', 'best']
+
+def duplicateParticleMask(track_lengths, filament_offsets, tolerance = 0, keep = 'last', scores = None):
+
+    '''Returns a mask of the duplicate particles of every filament, found in one
+    pass over all of them. The track lengths must be sorted within each
+    filament
+
+    Particles in a filament whose track lengths are within tolerance of the one
+    before are duplicates of it (so -0.0 and 0.0 are always the same). One
+    particle of each set is kept: the last or first in filament order, or the
+    one with the best (highest) score'''
+
+    if keep not in DUPLICATE_POLICIES:
+        raise ValueError('Unknown duplicate policy %s, the options are: %s' % (keep, ', '.join(DUPLICATE_POLICIES)))
+
+    number_of_particles = len(track_lengths)
+    #Adding 0.0 turns -0.0 into 0.0
+    track_lengths = np.asarray(track_lengths, dtype = np.float64) + 0.0
+
+    new_set = np.ones(number_of_particles, dtype = bool)
+    new_set[1:] = np.abs(np.diff(track_lengths)) > tolerance
+    new_set[np.asarray(filament_offsets[:-1])[np.diff(filament_offsets) > 0]] = True
+    set_starts = np.flatnonzero(new_set)
+
+    if keep == 'first':
+        kept = set_starts
+    elif keep == 'last':
+        kept = np.append(set_starts, number_of_particles)[1:] - 1
+    else:
+        if scores is None:
+            raise ValueError('Scores are needed to keep the best duplicate')
+        #Stable, so equal scores keep the first
+        set_ids = np.cumsum(new_set) - 1
+        kept = np.lexsort((-np.asarray(scores, dtype = np.float64), set_ids))[set_starts]
+
+    duplicates = np.ones(number_of_particles, dtype = bool)
+    duplicates[kept] = False
+
+    return duplicates
+
+def positionInGroups(group_ids):
+
+    '''Returns how many earlier items have the same group ID as each item'''
+
+    order = np.argsort(group_ids, kind = 'stable')
+    sorted_ids = np.asarray(group_ids)[order]
+    group_starts = np.flatnonzero(np.concatenate(([True], sorted_ids[1:] != sorted_ids[:-1])))
+
+    positions = np.empty(len(order), dtype = np.int64)
+    positions[order] = np.arange(len(order)) - np.repeat(group_starts, np.diff(np.append(group_starts, len(order))))
+    return positions
+
+#How columns that aren't in every starfile are handled when merging
+MISSING_COLUMN_POLICIES = ['error', 'intersect', 'fill']
+
+def reconcileColumns(column_lists, filenames, missing_columns = 'error'):
+
+    '''Works out the columns of a merged starfile from the columns of each
+    input, in the order of the first one
+
+    missing_columns is 'error' (raise an error unless they all have the same
+    columns), 'intersect' (only keep the columns they all have) or 'fill' (keep
+    every column, see fillMissingColumns)'''
+
+    if missing_columns not in MISSING_COLUMN_POLICIES:
+        raise ValueError('Unknown missing column policy %s, the options are: %s' % (missing_columns, ', '.join(MISSING_COLUMN_POLICIES)))
+
+    all_columns = []
+    for column_names in column_lists:
+        all_columns += [name for name in column_names if name not in all_columns]
+
+    if missing_columns == 'fill':
+        return all_columns
+
+    shared_columns = [name for name in all_columns if all(name in column_names for column_names in column_lists)]
+
+    if missing_columns == 'error' and len(shared_columns) != len(all_columns):
+        mismatches = ['%s is missing %s' % (filename, ', '.join(name for name in all_columns if name not in column_names))
+                      for filename, column_names in zip(filenames, column_lists) if len(set(all_columns) - set(column_names)) > 0]
+        raise ValueError('The starfiles do not have the same columns: %s. Use the intersect or fill policy to merge them anyway' % '; '.join(mismatches))
+
+    return shared_columns
+
+def fillMissingColumns(table, column_names, reference_columns):
+
+    '''Returns the table with column_names in order, adding any it doesn't have
+    filled with 0 (or None for text columns, typed like reference_columns)'''
+
+    present_columns = [name for name in column_names if table.hasColumn(name)]
+    if len(present_columns) == len(column_names):
+        return table.selectColumns(column_names)
+
+    filled_table = table.selectColumns(present_columns)
+    for name in column_names:
+        if not filled_table.hasColumn(name):
+            if star_table.columnIsString(reference_columns[name]):
+                filled_table.addColumn(name, np.full(table.number_of_rows, b'None'))
+            else:
+                filled_table.addColumn(name, np.zeros(table.number_of_rows, dtype = reference_columns[name].dtype))
+
+    return filled_table.selectColumns(column_names)
+
+def mergeOpticsInfo(optics_infos, filenames):
+
+    '''Joins the optics groups of several starfiles. If the optics blocks have
+    different columns the first is used'''
+
+    merged_optics = list(optics_infos[0])
+    header_lines = [line for line in merged_optics if line.startswith(('data_', 'loop_', '_'))]
+    known_groups = [line.split() for line in merged_optics if not line.startswith(('data_', 'loop_', '_'))]
+
+    for optics_info, filename in zip(optics_infos[1:], filenames[1:]):
+        if [line for line in optics_info if line.startswith(('data_', 'loop_', '_'))] != header_lines:
+            print('The optics block of %s is different to %s, so the optics of %s are used' % (filename, filenames[0], filenames[0]))
+            continue
+        for line in optics_info:
+            if not line.startswith(('data_', 'loop_', '_')) and line.split() not in known_groups:
+                known_groups.append(line.split())
+                merged_optics.append(line)
+
+    return merged_optics
+
 
 class readFilamentsFromStarFile(object):
 
     '''Makes an object which arranges the data from a star file such that the
-    information for each filament are grouped together in individual entries to
-    a dictionary which can be accessed by their filament number
+    particles from each filament are grouped together and can be accessed by
+    their filament number
+
+    All the particles are held in one starDataTable sorted by micrograph, tube ID
+    and helical track length. Filament i is the row range
+    filament_offsets[i]:filament_offsets[i+1] of that table, so getting a
+    filament column is just a slice of the shared column array
 
     Also includes functions to access specific data and edit and save the loaded
-    particle data'''
+    particle data
+
+    usecols limits the columns that are parsed (the filament columns are always
+    included) - the others are still written out unchanged. workers is the
+    number of processes used to parse the file'''
 
-    def __init__(self, filename):
+    def __init__(self, filename, use_cache = True, usecols = None, workers = None):
         self.filename = filename
+        self.use_cache = use_cache
+        self.workers = workers
+        self.usecols = None if usecols is None else set(usecols).union(FILAMENT_COLUMNS)
         self.number_of_filaments = 0
         self.optics_info = []
         self.headers = {}
-        self.filaments = {}
-        self.filament_no_of_particles = {}
         self.new_data_headers = {}
         self.star_comments = []
         self.number_updated_columns = 0
@@ -25,166 +232,197 @@ class readFilamentsFromStarFile(object):
         self.fil_no_in_micrograph = {}
         self.rln_fil_no_in_micrograph = {}
 
+        self._table = None
+        self._filament_offsets = np.zeros(1, dtype = np.int64)
+        self._removed_particles = None
+        self._pending_filaments = []
+
         self.loadFilamentsFromStar()
 
+    @property
+    def table(self):
+        self.reloadFilamentObject()
+        return self._table
+
+    @property
+    def filament_offsets(self):
+        self.reloadFilamentObject()
+        return self._filament_offsets
+
+    @property
+    def filament_no_of_particles(self):
+        self.reloadFilamentObject()
+        return np.diff(self._filament_offsets)
+
     def loadFilamentsFromStar(self):
 
-        '''Reads in the a starfile and sorts the particles from each filament into
-        a single dictionary entry into the "filaments" dictionary'''
-
-        with open(self.filename, 'r') as starfile:
-            lines = [i.strip() for i in starfile if len(i.strip()) !=0]
-
-        optics = False
-        star_data = []
-        full_data_dict = {}
-
-        for line in lines:
-            if line[0] == '#':
-                self.star_comments.append(line)
-            elif line == 'data_optics':
-                optics = True
-                self.optics_info.append(line)
-                pass
-            elif line == 'data_particles':
-                optics = False
-                pass
-            elif optics == True:
-                self.optics_info.append(line)
-                pass
-            elif line == 'loop_':
-                pass
-            elif line[0] == '_':
-                header_name = line.split()[0][1:]
-                header_position = int(line.split()[1][1:])
-                self.headers[header_name] = header_position -1
-                pass
-            else:
-                #Construct a dictionary with micrograph names as keys and all particle info from each micrograph as data
-                try:
-                    full_data_dict[line.split()[self.headers['rlnMicrographName']]].append(line.split())
-                except KeyError:
-                    full_data_dict[line.split()[self.headers['rlnMicrographName']]] = [line.split()]
-
-        tube_id_column_number = self.headers['rlnHelicalTubeID']
-
-        #Construct the "filaments" dictionary with the filament "number" as a key
-        #and all the particles from that filament as entries
-        for micrograph_key in sorted(full_data_dict.keys()):
-            micrograph_data = full_data_dict[micrograph_key]
-            filament_positions = {}
-
-            #Make dictionaries which contain the positions for each filament in the original array/starfile
-            for num, particle in enumerate(micrograph_data):
-
-                try:
-                    filament_positions[int(particle[tube_id_column_number])].append(num)
-                    self.number_of_particles += 1
-                except KeyError:
-                    filament_positions[int(particle[tube_id_column_number])] = [num]
-                    self.number_of_particles += 1
-
-            #Use the dictionaries with the array positions to find the particles
-            #and enter them into the "filaments" dictionary
-            for filament_key in sorted(filament_positions.keys()):
-
-                #Keeps track of the actual number of filaments in an image
-                try:
-                    self.fil_no_in_micrograph[micrograph_key] += 1
-                except KeyError:
-                    self.fil_no_in_micrograph[micrograph_key] = 1
-
-                particle_position_list = filament_positions[filament_key]
-
-                #Sort the particles based on helical track tracklength
-                sorted_particles = sorted([micrograph_data[i] for i in particle_position_list], key = lambda x: float(x[self.headers['rlnHelicalTrackLengthAngst']]))
-
-                #The zip() function rearranges the list into a more numpy like
-                #structure: i.e. columns can be easily indexed using array[i] for i'th column
-                sorted_structured_particles = list(zip(*sorted_particles))
-
-                #Keeps track of the RELION tube numbering - important if new filaments need to be added to the object
-                try:
-                    self.rln_fil_no_in_micrograph[micrograph_key]
-                except KeyError: #catches when a new dictionary entry needs to be made
-                    self.rln_fil_no_in_micrograph[micrograph_key] = int(sorted_structured_particles[self.headers['rlnHelicalTubeID']][0])
-                else:
-                    #complex looking code that just checks if the new tube number is the biggest encountered so far
-                    if int(sorted_structured_particles[self.headers['rlnHelicalTubeID']][0]) > self.rln_fil_no_in_micrograph[micrograph_key]:
-                        self.rln_fil_no_in_micrograph[micrograph_key] = int(sorted_structured_particles[self.headers['rlnHelicalTubeID']][0])
-
-                self.filaments[self.number_of_filaments] = sorted_structured_particles
-                self.filament_no_of_particles[self.number_of_filaments] = len(particle_position_list)
-                self.number_of_filaments += 1
+        '''Reads in the a starfile and groups the particles from each filament
+        together with a single lexsort on micrograph, tube ID and track length'''
+
+        self.star_comments, self.optics_info, self.headers, table = loadParticleTableFromStar(self.filename, self.use_cache, self.usecols, self.workers)
+
+        with perf_report.timeStage('group', particles = table.number_of_rows) as stage_record:
+            micrograph_names = table.getColumn('rlnMicrographName')
+            tube_ids = table.getColumn('rlnHelicalTubeID')
+            track_lengths = table.getColumn('rlnHelicalTrackLengthAngst')
+
+            #lexsort is stable so particles with equal track lengths keep their original order
+            self._table = table.take(np.lexsort((track_lengths, tube_ids, micrograph_names)))
+            self._setFilamentOffsets(findFilamentOffsets(self._table.getColumn('rlnMicrographName'), self._table.getColumn('rlnHelicalTubeID')))
+            stage_record['filaments'] = self.number_of_filaments
+
+    def _setFilamentOffsets(self, filament_offsets):
+
+        '''Updates the filament offsets and all the per micrograph counts'''
+
+        self._filament_offsets = filament_offsets
+        self.number_of_filaments = len(filament_offsets) - 1
+        self.number_of_particles = int(filament_offsets[-1])
+
+        starts = filament_offsets[:-1][np.diff(filament_offsets) > 0]
+        micrograph_names = self._table.getColumn('rlnMicrographName')[starts]
+        tube_ids = self._table.getColumn('rlnHelicalTubeID')[starts]
+
+        self.fil_no_in_micrograph = {}
+        self.rln_fil_no_in_micrograph = {}
+
+        if len(starts) == 0:
+            return
+
+        unique_mics, mic_index, mic_counts = np.unique(micrograph_names, return_inverse = True, return_counts = True)
+        max_tube_ids = np.full(len(unique_mics), np.iinfo(np.int64).min)
+        np.maximum.at(max_tube_ids, mic_index, tube_ids)
+
+        for mic_name, count, max_tube_id in zip(unique_mics.astype('U').tolist(), mic_counts.tolist(), max_tube_ids.tolist()):
+            self.fil_no_in_micrograph[mic_name] = count
+            #Keeps track of the RELION tube numbering - important if new filaments need to be added to the object
+            self.rln_fil_no_in_micrograph[mic_name] = max_tube_id
 
     def reloadFilamentObject(self):
 
         '''This function reassembles the self object which can be necessary after
-        making big changes to the object - e.g. merging two big star files '''
+        making big changes to the object - e.g. merging two big star files
 
-        pass
+        Removed particles are dropped from the table and any new filaments are
+        appended to it, in one go rather than once per edit'''
+
+        if self._removed_particles is None and len(self._pending_filaments) == 0:
+            return
+
+        table = self._table
+        filament_offsets = self._filament_offsets
+
+        if self._removed_particles is not None:
+            kept = ~self._removed_particles
+            kept_per_filament = np.zeros(len(filament_offsets) - 1, dtype = np.int64)
+            non_empty = np.diff(filament_offsets) > 0
+            kept_per_filament[non_empty] = np.add.reduceat(kept.astype(np.int64), filament_offsets[:-1][non_empty])
+            filament_offsets = np.concatenate(([0], np.cumsum(kept_per_filament)))
+            table = table.take(kept)
+            self._removed_particles = None
+
+        if len(self._pending_filaments) > 0:
+            new_lengths = [new_filament.number_of_rows for new_filament in self._pending_filaments]
+            table = star_table.concatenateTables([table] + self._pending_filaments)
+            filament_offsets = np.concatenate((filament_offsets, filament_offsets[-1] + np.cumsum(new_lengths)))
+            self._pending_filaments = []
+
+        self._table = table
+        self._setFilamentOffsets(filament_offsets.astype(np.int64))
+
+    def _filamentRows(self, filament_number):
+
+        '''Returns the rows of the table belonging to one filament - a slice
+        unless some of its particles are waiting to be removed'''
+
+        if filament_number >= len(self._filament_offsets) - 1:
+            self.reloadFilamentObject()
+
+        start = self._filament_offsets[filament_number]
+        end = self._filament_offsets[filament_number + 1]
+
+        if self._removed_particles is not None and self._removed_particles[start:end].any():
+            return start + np.flatnonzero(~self._removed_particles[start:end])
+
+        return slice(start, end)
+
+    def getFilamentTable(self, filament_number):
+
+        '''Returns a starDataTable holding just the particles of one filament'''
+
+        rows = self._filamentRows(filament_number)
+        return self._table.take(rows)
 
     def getAllFilamentData(self, filament_number):
 
         '''Returns all the particle data for a specific filament'''
 
-        return self.filaments[filament_number]
+        return self.getFilamentTable(filament_number)
 
     def getNumpyFilamentColumn(self, filament_number, header_name):
 
         '''Returns the specified data column as a 1D numpy array from a
-        single filament '''
+        single filament - for numeric columns this is a view of the stored data'''
 
-        try:
-            return np.array(self.filaments[filament_number][self.headers[header_name]], dtype = 'float32')
-        except ValueError: #happens when data column contains strings e.g. micrograph name
-            return np.array(self.filaments[filament_number][self.headers[header_name]])
+        column = self._table.getColumn(header_name)[self._filamentRows(filament_number)]
+
+        if star_table.columnIsString(column): #happens when data column contains strings e.g. micrograph name
+            return column.astype('U')
+        return column
 
     def getFilamentColumnSpecificDecimalPlaces(self, filament_number, header_name, decimal_places):
 
-        return [round(float(i), decimal_places) for i in self.filaments[filament_number][self.headers[header_name]]]
+        return np.round(self.getNumpyFilamentColumn(filament_number, header_name), decimal_places).tolist()
 
     def getStringListFilamentColumn(self, filament_number, header_name):
 
         '''Returns the column data as a list of strings'''
 
-        return [str(i) for i in self.filaments[filament_number][self.headers[header_name]]]
+        column = self._table.getColumn(header_name)[self._filamentRows(filament_number)]
+        return star_table.columnToText(column).astype('U').tolist()
 
     def getHelicalTrackLengthList(self, filament_number):
 
-        '''Returns the helical track lengths for one filament as a list of strings
+        '''Returns the helical track lengths for one filament as a list of floats
 
         Need a specific function for removing duplicates as some particles have
         track length 0.000000 and some -0.000000 in RELION files'''
 
-        #return [str(i) if i != '-0.000000' else str('0.000000') for i in self.filaments[filament_number][self.headers['rlnHelicalTrackLengthAngst']]]
-        return [float(i) for i in self.filaments[filament_number][self.headers['rlnHelicalTrackLengthAngst']]]
+        return self.getNumpyFilamentColumn(filament_number, 'rlnHelicalTrackLengthAngst').tolist()
 
     def getFilamentDataColumnSpecificParticles(self, header, fil_no, particle_positions):
 
-        return [self.filaments[fil_no][self.headers[header]][i] for i in particle_positions]
+        return self._table.getColumn(header)[self._filamentRows(fil_no)][particle_positions]
 
     def addFilamentDataColumn(self, filament_number, new_data_column, name_of_altered_data_column):
 
-        '''Appends a new column of data on a single filament particle stack and
-        updates the updated data headers '''
+        '''Updates the values of one column for a single filament and records
+        the altered column in the updated data headers '''
+
+        if self._table.hasColumn(name_of_altered_data_column):
+            self._table.setColumn(name_of_altered_data_column, new_data_column, rows = self._filamentRows(filament_number))
 
-        new_column_number = len(sorted(self.headers.keys())) + len(sorted(self.new_data_headers.keys())) - 1
+        self.new_data_headers[name_of_altered_data_column] = self._table.column_names.index(name_of_altered_data_column) if self._table.hasColumn(name_of_altered_data_column) else None
 
-        filament_data = self.filaments[filament_number]
+    def addDataColumn(self, new_data_column, name_of_altered_data_column):
 
-        filament_data.append(new_data_column)
+        '''Updates the values of one column for every particle at once (in
+        filament order) and records the altered column'''
 
-        self.new_data_headers[name_of_altered_data_column] = new_column_number
-        self.filaments[filament_number] = filament_data
+        self.reloadFilamentObject()
+        self._table.setColumn(name_of_altered_data_column, new_data_column)
+        self.new_data_headers[name_of_altered_data_column] = self._table.column_names.index(name_of_altered_data_column)
 
     def addNewFilament(self, new_filament_data, mic_name):
 
-        #some test needs to be inserted to check its all in the correct format
+        '''Adds a starDataTable of particles as a new filament - the table is
+        only joined onto the main table when the object is next reloaded'''
 
-        self.filaments[self.number_of_filaments] = new_filament_data
-        self.filament_no_of_particles[self.number_of_filaments] = len(new_filament_data[0])
-        self.number_of_particles += len(new_filament_data[0])
+        if new_filament_data.column_names != self._table.column_names:
+            new_filament_data = new_filament_data.selectColumns(self._table.column_names)
+
+        self._pending_filaments.append(new_filament_data)
+        self.number_of_particles += new_filament_data.number_of_rows
         try:
             self.fil_no_in_micrograph[mic_name] += 1
         except KeyError:
@@ -216,246 +454,259 @@ class readFilamentsFromStarFile(object):
             self.fil_no_in_micrograph[mic_name] = 0
             new_fil_no = 1
 
-        #make sure the header information for the new filaments is in the correct format
-        temp_particle_block = other_star_object.getAllFilamentData(other_fil_no)
+        other_filament = other_star_object.getFilamentTable(other_fil_no)
 
-        for header in self.headers.keys():
-            #Give the filaments from the new data an original tube number - should help avoid RELION errors/bugs
-            if header == 'rlnHelicalTubeID':
-                temp_particle_block[self.headers[header]] = [new_fil_no for _ in range(other_star_object.filament_no_of_particles[other_fil_no])]
-                continue
-            #reorganise the new data so it matches the "old" star file
-            try:
-                other_star_object.headers[header]
-            except KeyError:
+        #reorganise the new data so it matches the "old" star file
+        for header in self._table.column_names:
+            if not other_filament.hasColumn(header):
                 raise KeyError('The header option %s is present in the %s starfile but not the %s starfile' % (header, self.filename, other_star_object.filename))
-            else:
-                temp_particle_block[self.headers[header]] = other_star_object.getStringListFilamentColumn(other_fil_no, header)
 
-        #Update the various filament numbers and information
-        self.filaments[self.number_of_filaments] = temp_particle_block
-        self.filament_no_of_particles[self.number_of_filaments] = other_star_object.filament_no_of_particles[other_fil_no]
-        self.fil_no_in_micrograph[mic_name] += 1
-        self.number_of_filaments += 1
-        self.rln_fil_no_in_micrograph[mic_name] += 1
-        self.number_of_particles += other_star_object.filament_no_of_particles[other_fil_no]
-
-    def fixExpansionOneFilament(self, fil_no, reference_star_object, expansion_factor):
-
-        ref_fil_particles = reference_star_object.getAllFilamentData(fil_no)
-        expanded_fil_particles = self.getAllFilamentData(fil_no)
-
-        ref_fil_rot = reference_star_object.getFilamentColumnSpecificDecimalPlaces(fil_no, 'rlnAngleRot', 2)
-        expanded_fil_rot = self.getFilamentColumnSpecificDecimalPlaces(fil_no, 'rlnAngleRot', 2)
-
-        #identify the change in rot angle for expanded particles
-        #first_image_name = reference_star_object.getStringListFilamentColumn(fil_no, 'rlnImageName')[0]
-        reference_image_names = reference_star_object.getStringListFilamentColumn(fil_no, 'rlnImageName')
-        first_image_name = reference_image_names[0]
-        expanded_image_name_list = self.getStringListFilamentColumn(fil_no, 'rlnImageName')
-        mic_name = self.getStringListFilamentColumn(fil_no, 'rlnMicrographName')[0]
-
-        #build a dictionary that points to where each set of expanded particles are
-        expanded_particle_position_dict = {}
-        for image_name in reference_image_names:
-            for i, expanded_image_name in enumerate(expanded_image_name_list):
-                if image_name == expanded_image_name:
-                    try:
-                        expanded_particle_position_dict[image_name].append(i)
-                    except KeyError:
-                        expanded_particle_position_dict[image_name] = [i]
-
-        #find rot angle change between expanded particles
-        min_rot_angle_diff = 1e9
-        for particle_position in expanded_particle_position_dict[first_image_name]:
-            try:
-                rot_difference = abs(prev_rot - expanded_fil_rot[particle_position])
-            except NameError:
-                prev_rot = expanded_fil_rot[particle_position]
-            else:
-                if rot_difference < min_rot_angle_diff:
-                    min_rot_angle_diff = round(rot_difference, 2)
-
-        #Following code assembled dictionaries that points to where each expanded particle is in the original filament
-        new_filament_positions = {} #dictionary containing the positions of each set of expanded filaments
-        for i, image_name in enumerate(reference_image_names):
-            for p_position in expanded_particle_position_dict[image_name]:
-
-                rot_change = round(ref_fil_rot[i] - expanded_fil_rot[p_position], 2)
-                expanded_particle_set = int(rot_change/min_rot_angle_diff)
-
-                try:
-                    new_filament_positions[expanded_particle_set].append(p_position)
-                except KeyError:
-                    new_filament_positions[expanded_particle_set] = [p_position]
-
-        #make a new dictionary now containing all the particle data for each expanded set
-        new_filaments = {}
-        for i, expansion_coeff in enumerate(sorted(new_filament_positions.keys())):
-            #if expansion_coeff != 0:
-            new_tube_ID = self.rln_fil_no_in_micrograph[mic_name] + i
-            #print(new_tube_ID)
-            temp_particle_block = reference_star_object.getAllFilamentData(fil_no)
-
-            for header in self.headers.keys():
-                #Give the filaments from the new data an original tube number - should help avoid RELION errors/bugs
-                if header == 'rlnHelicalTubeID':
-                    temp_particle_block[self.headers[header]] = [new_tube_ID for _ in range(reference_star_object.filament_no_of_particles[fil_no])]
-                    continue
-                temp_particle_block[self.headers[header]] = self.getFilamentDataColumnSpecificParticles(header, fil_no, new_filament_positions[expansion_coeff])
-
-            new_filaments[expansion_coeff] = temp_particle_block[:]
-
-        #actually add these new filaments to self.filaments etc
-        for expanded_fil_key in sorted(new_filaments.keys()):
-            self.addNewFilament(new_filaments[expanded_fil_key], mic_name)
+        new_filament = other_filament.selectColumns(self._table.column_names)
+        #Give the filaments from the new data an original tube number - should help avoid RELION errors/bugs
+        new_filament.replaceColumn('rlnHelicalTubeID', np.full(new_filament.number_of_rows, new_fil_no, dtype = self._table.getColumn('rlnHelicalTubeID').dtype))
+
+        #addNewFilament also updates the various filament numbers and information
+        self.addNewFilament(new_filament, mic_name)
+        self.rln_fil_no_in_micrograph[mic_name] = new_fil_no
+
+    def mergeFilaments(self, other_star_objects, missing_columns = 'error'):
+
+        '''Adds all the filaments of other filament objects in one go, after the
+        filaments of this one
+
+        The added filaments are given new tube IDs counting on from the highest
+        already used on their micrograph (in the order of the objects and their
+        filaments), so filaments from different starfiles never share a tube ID.
+        Columns are reconciled once with reconcileColumns'''
+
+        star_objects = [self] + list(other_star_objects)
+        for star_object in star_objects:
+            star_object.reloadFilamentObject()
+
+        column_names = reconcileColumns([star_object._table.column_names for star_object in star_objects],
+                                        [star_object.filename for star_object in star_objects], missing_columns)
+        reference_columns = {}
+        for star_object in reversed(star_objects):
+            reference_columns.update(star_object._table.columns)
+
+        tables = []
+        filament_lengths = []
+        filament_micrographs = []
+        filament_tube_ids = []
+        for star_object in star_objects:
+            tables.append(fillMissingColumns(star_object._table, column_names, reference_columns))
+            #Filaments that have had all their particles removed are dropped
+            lengths = np.diff(star_object._filament_offsets)
+            starts = star_object._filament_offsets[:-1][lengths > 0]
+            filament_lengths.append(lengths[lengths > 0])
+            filament_micrographs.append(star_object._table.getColumn('rlnMicrographName')[starts])
+            filament_tube_ids.append(star_object._table.getColumn('rlnHelicalTubeID')[starts].astype(np.int64))
+
+        #Highest tube ID used so far on each micrograph, starting from this object's
+        all_micrographs = np.unique(np.concatenate(filament_micrographs))
+        highest_tube_ids = np.zeros(len(all_micrographs), dtype = np.int64)
+        np.maximum.at(highest_tube_ids, np.searchsorted(all_micrographs, filament_micrographs[0]), filament_tube_ids[0])
+
+        tube_id_type = self._table.getColumn('rlnHelicalTubeID').dtype
+        for number, (table, lengths, micrographs) in enumerate(zip(tables[1:], filament_lengths[1:], filament_micrographs[1:])):
+            if len(lengths) == 0:
+                continue
+            micrograph_ids = np.searchsorted(all_micrographs, micrographs)
+
+            #Each filament's position among the filaments of its micrograph
+            #gives its new number
+            new_tube_ids = highest_tube_ids[micrograph_ids] + positionInGroups(micrograph_ids) + 1
+            np.maximum.at(highest_tube_ids, micrograph_ids, new_tube_ids)
+
+            table.replaceColumn('rlnHelicalTubeID', np.repeat(new_tube_ids, lengths).astype(tube_id_type))
+
+        filament_offsets = np.concatenate(([0], np.cumsum(np.concatenate(filament_lengths)))).astype(np.int64)
+        self._table = star_table.concatenateTables(tables)
+        self.optics_info = mergeOpticsInfo([star_object.optics_info for star_object in star_objects], [star_object.filename for star_object in star_objects])
+        self._setFilamentOffsets(filament_offsets)
+
+    def splitExpandedFilaments(self, reference_star_object):
+
+        '''Splits the filaments of a symmetry expanded starfile back into one
+        filament per expansion, using the reference (unexpanded) starfile
+
+        Each expanded particle is joined to its reference particle on the
+        micrograph and image name. The rot step between expansions is the
+        smallest rot difference between the copies of the first reference
+        particle of each filament, and the expansion of each copy is its rot
+        change from the reference divided by that step. Particles without a
+        reference particle are dropped. Returns the number of them'''
+
+        self.reloadFilamentObject()
+        reference_star_object.reloadFilamentObject()
+        table = self._table
+        reference_table = reference_star_object._table
+
+        reference_rows, match_counts = star_join.matchRows([table.getColumn('rlnMicrographName'), table.getColumn('rlnImageName')],
+                                                           [reference_table.getColumn('rlnMicrographName'), reference_table.getColumn('rlnImageName')])
+        if (match_counts > 1).any():
+            print('%i expanded particles match more than one reference particle, the first is used' % np.count_nonzero(match_counts > 1))
+
+        rows = np.flatnonzero(reference_rows >= 0)
+        reference_rows = reference_rows[rows]
+        filament_ids = np.repeat(np.arange(self.number_of_filaments), np.diff(self._filament_offsets))[rows]
+        expanded_rot = np.round(table.getColumn('rlnAngleRot')[rows], 2)
+        reference_rot = np.round(reference_table.getColumn('rlnAngleRot'), 2)[reference_rows]
+
+        #The copies of the first reference particle of each filament give the rot step
+        first_reference_rows = np.full(self.number_of_filaments, np.iinfo(np.int64).max)
+        np.minimum.at(first_reference_rows, filament_ids, reference_rows)
+        first_copies = np.flatnonzero(reference_rows == first_reference_rows[filament_ids])
+        first_copy_rot = np.zeros(self.number_of_filaments)
+        copy_numbers = positionInGroups(filament_ids[first_copies])
+        first_copy_rot[filament_ids[first_copies[copy_numbers == 0]]] = expanded_rot[first_copies[copy_numbers == 0]]
+
+        rot_steps = np.full(self.number_of_filaments, np.inf)
+        other_copies = first_copies[copy_numbers > 0]
+        np.minimum.at(rot_steps, filament_ids[other_copies], np.round(circular.angularDistance(expanded_rot[other_copies], first_copy_rot[filament_ids[other_copies]]), 2))
+        rot_steps[rot_steps == 0] = np.inf
+
+        expansion_sets = np.rint(np.round(circular.angularResiduals(reference_rot, expanded_rot), 2) / rot_steps[filament_ids]).astype(np.int64)
+
+        #One new filament per expansion of each filament, in the order of the reference particles
+        order = np.lexsort((rows, reference_rows, expansion_sets, filament_ids))
+        rows = rows[order]
+        new_filament_starts = np.flatnonzero(np.concatenate(([True], (filament_ids[order][1:] != filament_ids[order][:-1]) | (expansion_sets[order][1:] != expansion_sets[order][:-1]))))
+        new_filament_offsets = np.append(new_filament_starts, len(rows)).astype(np.int64)
+
+        #Tube IDs count on from the highest in the expanded starfile on each micrograph
+        micrograph_names = table.getColumn('rlnMicrographName')[rows[new_filament_starts]] if len(rows) > 0 else np.zeros(0, dtype = 'S1')
+        micrographs, micrograph_ids = np.unique(micrograph_names, return_inverse = True)
+        micrograph_ids = micrograph_ids.reshape(-1)
+        highest_tube_ids = np.array([self.rln_fil_no_in_micrograph[name] for name in micrographs.astype('U').tolist()], dtype = np.int64)
+        new_tube_ids = highest_tube_ids[micrograph_ids] + positionInGroups(micrograph_ids)
+
+        number_of_unmatched = table.number_of_rows - len(rows)
+        new_table = table.take(rows)
+        new_table.replaceColumn('rlnHelicalTubeID', np.repeat(new_tube_ids, np.diff(new_filament_offsets)).astype(table.getColumn('rlnHelicalTubeID').dtype))
+        self._table = new_table
+        self._setFilamentOffsets(new_filament_offsets)
+
+        return number_of_unmatched
 
     def removeFilamentDuplicateParticles(self, fil_no):
 
-        hel_track_lengths = self.getHelicalTrackLengthList(fil_no)
-        number_of_duplicates = self.filament_no_of_particles[fil_no] - len(set(hel_track_lengths))
-        #number_of_duplicates = len(hel_track_lengths) - len(set(hel_track_lengths))
-
-        if number_of_duplicates > 0:
-            for duplicate in range(number_of_duplicates):
-                for i, track_length in enumerate(hel_track_lengths):
-                    try:
-                        duplicate_position = hel_track_lengths.index(track_length, i+1)
-                        hel_track_lengths.pop(i)
-                        self.removeParticleData(fil_no, i)
-                        break
-                    except ValueError:
-                        continue
+        '''Removes particles with the same helical track length as a later
+        particle in the filament. Particles are sorted by track length so any
+        duplicates are next to each other'''
+
+        hel_track_lengths = self.getNumpyFilamentColumn(fil_no, 'rlnHelicalTrackLengthAngst')
+        duplicate_positions = np.flatnonzero(duplicateParticleMask(hel_track_lengths, [0, len(hel_track_lengths)]))
+
+        if len(duplicate_positions) > 0:
+            self.removeParticleData(fil_no, duplicate_positions)
         else:
             return 1
 
+    def removeDuplicateParticles(self, tolerance = 0, keep = 'last', score_column = 'rlnMaxValueProbDistribution'):
+
+        '''Marks the duplicate particles of every filament for removal in one go
+        (see duplicateParticleMask) - the table is compacted once when the
+        object is next reloaded. Returns the number of duplicates'''
+
+        self.reloadFilamentObject()
+
+        scores = None
+        if keep == 'best':
+            if not self._table.hasColumn(score_column):
+                raise ValueError('The %s column is needed to keep the best scoring duplicates' % score_column)
+            scores = self._table.getColumn(score_column)
+
+        duplicates = duplicateParticleMask(self._table.getColumn('rlnHelicalTrackLengthAngst'), self._filament_offsets, tolerance, keep, scores)
+        return self.removeParticlesByMask(duplicates)
+
+    def removeParticlesByMask(self, removed):
+
+        '''Marks the particles where removed is True (a mask over the whole
+        table) for removal. Returns how many there are'''
+
+        self.reloadFilamentObject()
+
+        number_removed = int(np.count_nonzero(removed))
+        if number_removed > 0:
+            self._removed_particles = np.array(removed, dtype = bool)
+            self.number_of_particles -= number_removed
+
+        return number_removed
+
     def removeFilament(self, fil_no):
 
         '''Remove all the particles from one filament and update all the relevant
         variables to account for this
 
-        This function is slow if running on a large number of filaments - in which
-        case use the removeMultipleFilaments function'''
+        This function reloads the whole object so is slow if running on a large
+        number of filaments - in which case use the removeMultipleFilaments function'''
 
-        mic_name = self.getStringListFilamentColumn(fil_no, 'rlnMicrographName')[0]
+        self.removeMultipleFilaments([fil_no])
 
-        self.number_of_particles =- self.filament_no_of_particles[fil_no]
-        self.filaments.pop(fil_no)
-        self.filament_no_of_particles.pop(fil_no)
-        #self.number_of_filaments -= 1
+    def removeMultipleFilaments(self, filament_numbers):
 
-        #rename each of the dictionary entries to account for deleted filament
-        for new_fil_no in range(fil_no, self.number_of_filaments):
-            self.filaments[new_fil_no] = self.filaments[new_fil_no + 1][:]
-            self.filament_no_of_particles[new_fil_no] = int(self.filament_no_of_particles[new_fil_no + 1])
+        '''Removes the filaments in filament_numbers and renumbers the remaining
+        filaments sequentially'''
 
-        self.fil_no_in_micrograph[mic_name] =- 1
-        self.rln_fil_no_in_micrograph[mic_name] =- 1
+        self.reloadFilamentObject()
 
-        self.filaments.pop(self.number_of_filaments)
-        self.filament_no_of_particles.pop(self.number_of_filaments)
-        self.number_of_filaments =- 1
+        keep_filament = np.ones(self.number_of_filaments, dtype = bool)
+        keep_filament[np.asarray(filament_numbers, dtype = np.int64)] = False
 
-    def removeMultipleFilaments(self, filament_numbers):
-
-        for fil_no in filament_numbers:
-            mic_name = self.getStringListFilamentColumn(fil_no, 'rlnMicrographName')[0]
-            self.number_of_particles =- self.filament_no_of_particles[fil_no]
-            self.filaments.pop(fil_no)
-            self.filament_no_of_particles.pop(fil_no)
-            self.number_of_filaments -= 1
-            self.fil_no_in_micrograph[mic_name] =- 1
-            self.rln_fil_no_in_micrograph[mic_name] =- 1
-
-        #fixes the numbering system for consistency
-        for i, fil_no in enumerate(sorted(self.filaments.keys())):
-            if i != fil_no:
-                self.filaments[i] = self.filaments[fil_no]
-                self.filament_no_of_particles[i] = self.filaments[fil_no]
-
-        for i, fil_no in enumerate(sorted(self.filaments.keys())):
-            if fil_no < self.number_of_filaments:
-                continue
-            else:
-                self.filaments.pop(fil_no)
-                self.filament_no_of_particles.pop(fil_no)
+        filament_lengths = np.diff(self._filament_offsets)
+        self._table = self._table.take(np.repeat(keep_filament, filament_lengths))
+        self._setFilamentOffsets(np.concatenate(([0], np.cumsum(filament_lengths[keep_filament]))).astype(np.int64))
 
     def removeParticleData(self, fil_no, particle_no):
-        particles_from_filament = list(zip(*self.getAllFilamentData(fil_no)))
-        particles_from_filament.pop(particle_no)
-        self.number_of_particles -= 1
-        self.filament_no_of_particles[fil_no] -= 1
-        self.filaments[fil_no] = list(zip(*particles_from_filament))
 
-    def getNumberofParticlesinFilament(self, filament_no):
-        '''Defunct function as now the filament_no_of_particles dict keeps track of this
+        '''Marks one particle (or an array of particle positions) from a filament
+        for removal - the table is compacted when the object is next reloaded'''
+
+        rows = self._filamentRows(fil_no)
+        if isinstance(rows, slice):
+            rows = np.arange(rows.start, rows.stop)
+        rows = np.atleast_1d(rows[particle_no])
+
+        if self._removed_particles is None:
+            self._removed_particles = np.zeros(self._table.number_of_rows, dtype = bool)
 
-        will delete soon'''
+        self._removed_particles[rows] = True
+        self.number_of_particles -= len(rows)
 
-        return self.filament_no_of_particles[fil_no]
+    def getNumberofParticlesinFilament(self, filament_no):
+
+        return int(self.filament_no_of_particles[filament_no])
 
     def getRlnFilamentNumberandMicrograph(self, filament_no):
 
-        micrograph_name = self.getStringListFilamentColumn(filament_no, 'rlnMicrographName')[0]
-        rln_tube_number = int(self.getStringListFilamentColumn(filament_no, 'rlnHelicalTubeID')[0])
+        rows = self._filamentRows(filament_no)
+        micrograph_name = self._table.getColumn('rlnMicrographName')[rows][0].decode()
+        rln_tube_number = int(self._table.getColumn('rlnHelicalTubeID')[rows][0])
 
         return (micrograph_name, rln_tube_number)
 
-    def writeFilamentsToStarFile(self, save_updated_data = True, suffix = None):
+    def writeFilamentsToStarFile(self, save_updated_data = True, suffix = None, float_format = '%.6f'):
 
         '''Writes the data from all the filaments to a starfile, updating columns
-        of edited data as specified
+        of edited data as specified. Only the edited columns are reformatted
+        (with float_format), everything else is copied from the original file'''
 
-        Need to do a fair bit of faffing around for this due to the way the
-        data is loaded and handled'''
+        self.reloadFilamentObject()
 
         if not suffix:
             save_file_name = self.filename[:-5] + '_updated'
         else:
             save_file_name = self.filename[:-5] + suffix
 
-        #Make an ordered list of the original headers
-        for key in self.headers.keys():
-            try:
-                ordered_header_list.append([self.headers[key], key])
-            except NameError:
-                ordered_header_list = [[self.headers[key],key]]
-        ordered_header_list.sort(key = lambda x:x[0])
-
-        #Updates the column positions in headers to write the edited data columns rather than original data
-        #Also updates savefilename to include all the edited columns
+        #Updates savefilename to include all the edited columns
         if save_updated_data and len(self.new_data_headers.keys()) > 0:
             for key in self.new_data_headers.keys():
-                self.headers[key] = self.new_data_headers[key]
                 save_file_name = save_file_name + key
 
-        with open(save_file_name + '.star', 'w') as write_star:
+        #Filaments are already stored in order so the table can be written directly
+        star_writer.writeStarFile(save_file_name + '.star', self.star_comments, self.optics_info, self._table, float_format)
 
-            if len(self.optics_info) > 0:
-                write_star.write('\n' + self.star_comments[0] + '\n\n')
-                for i in self.optics_info:
-                    write_star.write(str(i + '\n'))
-                write_star.write(str('\n'))
-
-            write_star.write(str('\n ' + self.star_comments[0] + ' \n\ndata_particles\n\nloop_\n'))
-
-            #Write out the header info using the ordered_header_list
-            for number, header in enumerate(ordered_header_list):
-                write_star.write('_%s #%i\n' % (header[1], number + 1))
-
-            #Write out the data
-            for filament_number in sorted(self.filaments.keys()):
-                all_filament_data = []
-
-                #Can't just shunt the data directly into text file due to abstract method of writing new data
-                for header in ordered_header_list:
-                    all_filament_data.append(self.getStringListFilamentColumn(filament_number, header[1]))
-
-                write_data = list(zip(*all_filament_data))
-
-                for i in write_data:
-                    [write_star.write('%s\t' % j) for j in i]
-                    write_star.write('\n')
         print('New starfile saved as ' + save_file_name + '.star')
 
 class readBlockDataFromStarfile(object):
@@ -463,15 +714,25 @@ class readBlockDataFromStarfile(object):
     '''Reads in a starfile as a block of data (rather than seperating out individual
     filaments) which is helpful for functions like making superparticles
 
-    This would also be used for standard single particle projects'''
+    This would also be used for standard single particle projects
 
-    def __init__(self, filename, index_particles=False):
+    The particle data is held column-wise in a starDataTable, so numeric columns
+    are typed numpy arrays that are only parsed from text once. usecols limits
+    the columns that are parsed, the rest are still written out unchanged.
+    workers is the number of processes used to parse the file'''
+
+    def __init__(self, filename, index_particles=False, use_cache=True, usecols=None, workers=None):
         self.filename = filename
         self.index_particles = index_particles
+        self.use_cache = use_cache
+        self.workers = workers
+        self.usecols = usecols
+
+        if self.usecols is not None and self.index_particles:
+            self.usecols = set(self.usecols).union(['rlnMicrographName', 'rlnImageName'])
         self.headers = {}
         self.optics_info = []
-        self.particle_data_block = []
-        self.particles = []
+        self.table = None
         self.new_data_headers = {}
         self.number_of_particles = 0
         self.star_comments = []
@@ -481,83 +742,48 @@ class readBlockDataFromStarfile(object):
 
     def loadBlockDataFromStar(self):
 
-        ''' Loads the particle data from a starfile into a single big list.
+        ''' Loads the particle data from a starfile into a columnar table.
 
         Similar code to loadFilamentsFromStar but doesn't seperate particles into
         individual filaments '''
 
-        with open(self.filename, 'r') as starfile:
-            lines = [i.strip() for i in starfile if len(i.strip()) !=0]
-
-        optics = False
-        star_data = []
-        full_data_dict = {}
-
-        for line in lines:
-            if line[0] == '#':
-                self.star_comments.append(line)
-            elif line == 'data_optics':
-                optics = True
-                self.optics_info.append(line)
-                pass
-            elif line == 'data_particles':
-                optics = False
-                pass
-            elif line == 'data_':
-                optics = False
-                pass
-            elif optics == True:
-                self.optics_info.append(line)
-                pass
-            elif line == 'loop_':
-                pass
-            elif line[0] == '_':
-                header_name = line.split()[0][1:]
-                header_position = int(line.split()[1][1:])
-                self.headers[header_name] = header_position -1
-                pass
-            else:
-                #Load a simple multidimensional list for the particles
-                try:
-                    temp_data_block.append(line.split())
-                except NameError:
-                    temp_data_block = [line.split()]
+        self.star_comments, self.optics_info, self.headers, self.table = loadParticleTableFromStar(self.filename, self.use_cache, self.usecols, self.workers)
+        self.number_of_particles = self.table.number_of_rows
 
-                if self.index_particles:
-                    #This will bug out for expanded particles
-                    p_index = {line.split()[self.headers['rlnImageName']]:self.number_of_particles}
-                    try:
-                        self.particle_index[line.split()[self.headers['rlnMicrographName']]].update(p_index)
-                    except KeyError:
-                        self.particle_index[line.split()[self.headers['rlnMicrographName']]] = p_index
-                self.number_of_particles += 1
+        if self.index_particles:
+            self.indexParticles()
 
-        #Makes a multidimensional array that can be easily indexed for sepecific columns
-        self.particle_data_block = list(zip(*temp_data_block))
+    def indexParticles(self):
 
-        # self.particles is tuple as this is for reference only - not for updating data
-        self.particles = tuple(temp_data_block)
+        '''Makes a dictionary for looking up particle numbers from their
+        micrograph and image names'''
 
-        # hacky bs to set each column in particle_data_block to be a list to allow assignment
-        for n, col in enumerate(self.particle_data_block):
-            self.particle_data_block[n] = list(col)
+        #This will bug out for expanded particles
+        self.particle_index = {}
+        micrograph_names = self.table.getColumn('rlnMicrographName').astype('U').tolist()
+        image_names = self.table.getColumn('rlnImageName').astype('U').tolist()
 
+        for p_no, (mic_name, img_name) in enumerate(zip(micrograph_names, image_names)):
+            try:
+                self.particle_index[mic_name][img_name] = p_no
+            except KeyError:
+                self.particle_index[mic_name] = {img_name:p_no}
 
     def getNumpyDataColumn(self, header_name):
 
         '''Retrieves a specific column of data as a numpy 1D array'''
 
-        try:
-            return np.array(self.particle_data_block[self.headers[header_name]], dtype = 'float32')
-        except ValueError:
-            return np.array(self.particle_data_block[self.headers[header_name]])
+        column = self.table.getColumn(header_name)
+        if star_table.columnIsString(column):
+            return column.astype('U')
+        return column
 
     def getStringDataColumn(self, header_name):
 
         '''Retreves a specific column of data as a list of strings - useful for
         saving star files '''
 
-        return [str(x) for x in self.particle_data_block[self.headers[header_name]]]
+        return star_table.columnToText(self.table.getColumn(header_name)).astype('U').tolist()
 
     def addColumntoBlockData(self, new_data_column, header_name):
 
@@ -565,89 +791,96 @@ class readBlockDataFromStarfile(object):
 
         Raises an error if the new data column is not the correct type or shape'''
 
-        if type(new_data_column) is not list or not np.ndarray:
+        if not isinstance(new_data_column, (list, np.ndarray)):
             raise TypeError('Only lists or numpy arrays can be used as data columns')
 
         if len(new_data_column) != self.number_of_particles:
             raise ValueError('The new data column is an incorrect length or shape')
 
-        new_column_number = len(sorted(self.headers.keys())) + len(sorted(self.new_data_headers.keys()))
-        self.new_data_headers[header_name] = new_column_number
+        self._addNewColumn(header_name, new_data_column)
+
+    def _addNewColumn(self, header_name, new_data_column):
 
-        self.particle_data_block.append(new_data_column)
+        if self.table.hasColumn(header_name):
+            self.table.setColumn(header_name, new_data_column)
+        else:
+            self.table.addColumn(header_name, new_data_column)
 
+        self.new_data_headers[header_name] = self.table.column_names.index(header_name)
 
     def getOneParticleData(self, particle_no):
 
         '''Return all the data for one particle - use a list of strings to ensure
         a predictable result rather than a mixed list'''
 
-        return list(self.particles[particle_no])
+        return self.table.getRow(particle_no)
 
     def getParticleValueString(self, particle_no, header_name):
-        return self.particle_data_block[self.headers[header_name]][particle_no]
+        return self.table.getValueString(header_name, particle_no)
 
     def getParticleSpecificDataFloat(self, particle_no, header_name):
-        return float(self.particle_data_block[self.headers[header_name]][particle_no])
+        return float(self.table.getValue(header_name, particle_no))
 
     def getParticleSpecificNewData(self, particle_no, header_name):
-        self.particle_data_block[self.new_data_headers[header_name]][particle_no] = new_data
+        return self.table.getValue(header_name, particle_no)
 
     def getParticleMicrograph(self, particle_no):
-        return self.particles[particle_no][self.headers['rlnMicrographName']]
+        return self.table.getValue('rlnMicrographName', particle_no)
 
     def getParticleImageName(self, particle_no):
-        return self.particles[particle_no][self.headers['rlnImageName']]
+        return self.table.getValue('rlnImageName', particle_no)
 
     def getParticleNumber(self, mic_name, img_name):
         return self.particle_index[mic_name][img_name]
 
     def setParticleValue(self, particle_no, header_name, value):
-        #print(self.particle_data_block[self.headers[header_name]])
-        self.particle_data_block[self.headers[header_name]][particle_no] = value
+        self.table.setValue(header_name, particle_no, value)
 
     def getParticleValue(self, particle_no, header_name):
-        return self.particles[particle_no][self.headers[header_name]]
+        return self.table.getValue(header_name, particle_no)
 
     def addEmptyDataColumn(self, new_header_name):
 
         ''' Function to add an empty new data column to the particle stack
         which can be edited particle by particle '''
 
-        new_column_number = len(sorted(self.headers.keys())) + len(sorted(self.new_data_headers.keys()))
-
         ### Check new header name doesn't already exist
-        try:
-            temp = self.new_data_headers[new_header_name]
+        if new_header_name in self.new_data_headers:
             raise ValueError('New header already exists')
-        except KeyError:
-            self.new_data_headers[new_header_name] = new_column_number
-
-        list_of_zeros = [0] * self.number_of_particles
 
-        self.particle_data_block.append(list_of_zeros)
+        self._addNewColumn(new_header_name, np.zeros(self.number_of_particles))
 
     def updateParticleDataNewHeader(self, particle_no, header_name, new_data):
-        self.particle_data_block[self.new_data_headers[header_name]][particle_no] = new_data
+        self.table.setValue(header_name, particle_no, new_data)
 
     def updateParticleData(self, particle_no, header_name, new_data):
-        self.particle_data_block[self.headers[header_name]][particle_no] = new_data
+        self.table.setValue(header_name, particle_no, new_data)
 
     def getParticlePositionsBasedOnMetaData(self, header_name, metadata_value):
 
         ''' Returns a list of the indexes for particles which match the metatdata
         value '''
 
-        return [i for i, n in enumerate(self.particle_data_block[self.headers[header_name]]) if n == metadata_value]
+        column = self.table.getColumn(header_name)
+        metadata_value = star_table.valueToColumnType(column, metadata_value)
 
+        return np.flatnonzero(column == metadata_value).tolist()
 
     def updateColumnsWithNewData(self):
 
-        '''Updates the particle_data_block with new data as specified in the
-        new_data_headers dictionary '''
+        '''Columns are edited in place in the table so there is nothing left
+        to update'''
+
+        pass
+
+    def sortParticlesByColumn(self, header_name):
 
-        for key in self.new_data_headers.keys():
-            self.particle_data_block[self.headers[key]] = self.particle_data_block[self.new_data_headers[key]]
+        '''Reorders all the particles based on the values in one column'''
+
+        self.table = self.table.sortByColumn(header_name)
+
+        if self.index_particles:
+            self.indexParticles()
 
     def selectAngularRange(self, header_name, lower_limit, upper_limit):
 
@@ -657,83 +890,36 @@ class readBlockDataFromStarfile(object):
 
         anglelist = self.getNumpyDataColumn(header_name)
 
-        for particle_no in range(self.number_of_particles):
-
-            if lower_limit < anglelist[particle_no] and upper_limit > anglelist[particle_no]:
-                try:
-                    particles_within_angular_range.append(self.getOneParticleData(particle_no))
-                except NameError:
-                    particles_within_angular_range = [self.getOneParticleData(particle_no)]
-            elif (lower_limit - 180) < anglelist[particle_no] and (upper_limit-180) > anglelist[particle_no]:
-                try:
-                    particles_within_angular_range.append(self.getOneParticleData(particle_no))
-                except NameError:
-                    particles_within_angular_range = [self.getOneParticleData(particle_no)]
+        self.table = self.table.take(angularRangeMask(anglelist, lower_limit, upper_limit))
+        self.number_of_particles = self.table.number_of_rows
 
-            #if particle_no % 1000 == 0:
-            #    print('Particle number ' + str(particle_no) + ' has been processed')
+        if self.index_particles:
+            self.indexParticles()
 
-        self.paticles = particles_within_angular_range
-        self.particle_data_block = list(zip(*particles_within_angular_range))
+        self.new_data_headers[header_name + 'Range' + str(lower_limit) + 'to' +str(upper_limit)] = None
 
-        self.new_data_headers[header_name + 'Range' + str(lower_limit) + 'to' +str(upper_limit)] = 0
-
-    def writeBlockDatatoStar(self, save_updated_data=True, save_new_data =False, suffix=None):
+    def writeBlockDatatoStar(self, save_updated_data=True, save_new_data =False, suffix=None, float_format='%.6f'):
 
         if not suffix:
             save_file_name = self.filename[:-5] + '_updated'
         else:
             save_file_name = self.filename[:-5] + suffix
 
-        if save_new_data:
-            for key in self.new_data_headers.keys():
-                self.headers[key] = self.new_data_headers[key]
+        #New columns are only written out if requested
+        write_table = self.table
+        if not save_new_data:
+            original_columns = [name for name in self.table.column_names if name in self.headers]
+            write_table = self.table.selectColumns(original_columns)
 
-        #Make an ordered list of the original headers
-        for key in self.headers.keys():
-            try:
-                ordered_header_list.append([self.headers[key], key])
-            except NameError:
-                ordered_header_list = [[self.headers[key],key]]
-        ordered_header_list.sort(key = lambda x:x[0])
-
-        #Updates the column positions in headers to write the edited data columns rather than original data
         #Also updates savefilename to include all the edited columns
         if save_updated_data and len(self.new_data_headers.keys()) > 0:
             for key in self.new_data_headers.keys():
-                self.headers[key] = self.new_data_headers[key]
                 if not suffix:
                     save_file_name = save_file_name + key
 
-        with open(save_file_name + '.star', 'w') as write_star:
-
-            if len(self.optics_info) > 0:
-                write_star.write('\n' + self.star_comments[0] + '\n\n')
-                for i in self.optics_info:
-                    write_star.write(str(i + '\n'))
-                write_star.write(str('\n'))
-
-            write_star.write(str('\n ' + self.star_comments[0] + ' \n\ndata_particles\n\nloop_\n'))
-
-            #Write out the header info using the ordered_header_list
-            for number, header in enumerate(ordered_header_list):
-                write_star.write('_%s #%i\n' % (header[1], number + 1))
-
-            #Write out the data
-            #Can't just shunt the data directly into text file due to abstract method of writing new data
-            for header in ordered_header_list:
-                try:
-                    all_bulk_data.append(self.getStringDataColumn(header[1]))
-                except NameError:
-                    all_bulk_data = [self.getStringDataColumn(header[1])]
+        star_writer.writeStarFile(save_file_name + '.star', self.star_comments, self.optics_info, write_table, float_format)
 
-            write_data = list(zip(*all_bulk_data))
-
-            for i in write_data:
-                [write_star.write('%s\t' % j) for j in i]
-                write_star.write('\n')
-
-            print('New starfile saved as ' + save_file_name + '.star')
+        print('New starfile saved as ' + save_file_name + '.star')
 
 class parseAllModelsinDirectory(object):
 
@@ -775,46 +961,20 @@ class parseAllModelsinDirectory(object):
 
     def _readOneModelStar(self, filename):
 
-        self.number_of_classes = 0
+        '''Reads the data_model_classes table - the rest of the model star
+        file (e.g. the per class pdfs) is never parsed'''
 
-        with open(self.directory + filename, 'r') as model_star:
-            line = model_star.readline()
-            while line != 'data_model_classes\n':
-                line = model_star.readline()
-
-            while line != 'data_model_class_1\n':
-                line = model_star.readline()
-                try:
-                    temp_data.append(line)
-                except NameError:
-                    temp_data = [line]
-
-        #Sort out the temp_data into a labelled thing
-        for line in temp_data:
-            if line[0] == '_':
-                header_name = line.split()[0][1:]
-                header_position = int(line.split()[1][1:])
-                self.headers[header_name] = header_position -1
-            elif line.startswith('#'):
-                continue
-            elif line.strip() =='loop_':
-                continue
-            elif line.strip() == 'data_model_class_1':
-                continue
-            elif len(line.strip()) == 0:
-                continue
-            else:
-                try:
-                    data.append(line)
-                except NameError:
-                    data = [line]
+        with star_file.starFile(self.directory + filename) as model_star:
+            class_table = model_star.getTable('model_classes')
+
+        self.headers = {header_name:position for position, header_name in enumerate(class_table.column_names)}
+        self.number_of_classes = class_table.number_of_rows
 
-        for num, data_line in enumerate(data):
+        for num in range(class_table.number_of_rows):
             try:
-                self.classes[num].append(data_line.split())
+                self.classes[num].append(class_table.getRow(num))
             except KeyError:
-                self.classes[num] = [data_line.split()]
-            self.number_of_classes += 1
+                self.classes[num] = [class_table.getRow(num)]
 
     def getClassDistForOneClass(self, class_number):
         return [float(i) for i in self.classes[class_number][self.headers['rlnClassDistribution']]]
@@ -0,0 +1,176 @@
+'''Timings of where a run spends its time, for --perf-report.
+
+Each operation of a run is timed with timeOperation. Inside it the library
+times its own stages with timeStage: 'parse' (reading the starfile), 'group'
+(sorting the particles into filaments) and 'write' (saving the new starfile).
+Whatever time is left over is the 'compute' stage. mapFilamentChunks also
+records how long every batch of filaments took to fit, which gives the
+histogram of fit cost per filament (exact per filament with a chunk size of 1).
+
+Nothing is recorded unless a report has been started with startReport.
+'''
+
+import contextlib
+import json
+import sys
+import time
+
+import numpy as np
+
+#Stages the library times itself, compute is the rest of an operation
+TIMED_STAGES = ['parse', 'group', 'write']
+NUMBER_OF_SLOWEST_BATCHES = 10
+
+_current_report = None
+
+
+class perfReport(object):
+
+    '''Holds the timings of the operations of a run'''
+
+    def __init__(self):
+        self.started = time.time()
+        self.start_time = time.perf_counter()
+        self.operations = []
+        self.current_operation = None
+
+    @contextlib.contextmanager
+    def operation(self, name, inputs):
+        operation = {'operation':name, 'input':inputs, 'stages':[], 'fit_batches':[]}
+        self.operations.append(operation)
+        self.current_operation = operation
+        start_time = time.perf_counter()
+        try:
+            yield operation
+        finally:
+            operation['seconds'] = time.perf_counter() - start_time
+            self.current_operation = None
+
+    @contextlib.contextmanager
+    def stage(self, name, particles = None, filaments = None):
+
+        '''Times a stage of the current operation. Yields its record so the
+        particle and filament counts can be filled in once they're known'''
+
+        record = {'stage':name, 'particles':particles, 'filaments':filaments}
+        start_time = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['seconds'] = time.perf_counter() - start_time
+            if self.current_operation is not None:
+                self.current_operation['stages'].append(record)
+
+    def addFitBatch(self, first_filament, last_filament, particles, seconds):
+        if self.current_operation is not None:
+            self.current_operation['fit_batches'].append((first_filament, last_filament, particles, seconds))
+
+    def toDict(self):
+        return {
+                'command':sys.argv,
+                'started':time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+                'total_seconds':time.perf_counter() - self.start_time,
+                'operations':[_summariseOperation(operation) for operation in self.operations],
+                }
+
+    def save(self, filename):
+        with open(filename, 'w') as report_file:
+            json.dump(self.toDict(), report_file, indent = 2)
+        print('Performance report saved as ' + filename)
+
+def _rates(seconds, particles, filaments):
+    rates = {'seconds':seconds, 'particles':particles, 'filaments':filaments}
+    for name, count in [('particles', particles), ('filaments', filaments)]:
+        rates[name + '_per_second'] = count / seconds if count and seconds > 0 else None
+    return rates
+
+def _largestCount(records, name):
+    counts = [record[name] for record in records if record.get(name) is not None]
+    return max(counts) if len(counts) > 0 else None
+
+def _fitCostSummary(fit_batches):
+
+    '''Histogram of the fit time per filament (the time of each batch shared
+    between its filaments) and the slowest batches'''
+
+    if len(fit_batches) == 0:
+        return None
+
+    batches = np.array(fit_batches, dtype = np.float64).reshape(-1, 4)
+    filaments = batches[:,1] - batches[:,0]
+    seconds_per_filament = batches[:,3] / np.maximum(filaments, 1)
+
+    positive_costs = seconds_per_filament[seconds_per_filament > 0]
+    if len(positive_costs) > 0 and positive_costs.min() < positive_costs.max():
+        bin_edges = np.geomspace(positive_costs.min(), positive_costs.max(), 21)
+    else:
+        bin_edges = np.array([0, max(seconds_per_filament.max(), 1e-9)])
+    counts, bin_edges = np.histogram(np.clip(seconds_per_filament, bin_edges[0], bin_edges[-1]), bin_edges, weights = filaments)
+
+    slowest = np.argsort(-seconds_per_filament, kind = 'stable')[:NUMBER_OF_SLOWEST_BATCHES]
+
+    return {
+            'batches':len(batches),
+            'seconds_per_filament_histogram':{'bin_edges':bin_edges.tolist(), 'filaments':counts.astype(np.int64).tolist()},
+            'slowest_batches':[{'first_filament':int(batches[i,0]), 'last_filament':int(batches[i,1]) - 1, 'particles':int(batches[i,2]),
+                                'seconds':float(batches[i,3]), 'seconds_per_filament':float(seconds_per_filament[i])} for i in slowest],
+            }
+
+def _summariseOperation(operation):
+    stages = operation['stages']
+    particles = _largestCount(stages, 'particles')
+    filaments = _largestCount(stages, 'filaments')
+
+    summary = {'operation':operation['operation'], 'input':operation['input']}
+    summary.update(_rates(operation['seconds'], particles, filaments))
+
+    stage_summaries = {}
+    for stage_name in TIMED_STAGES:
+        stage_records = [record for record in stages if record['stage'] == stage_name]
+        if len(stage_records) > 0:
+            stage_summaries[stage_name] = _rates(sum(record['seconds'] for record in stage_records),
+                                                 _largestCount(stage_records, 'particles'), _largestCount(stage_records, 'filaments'))
+
+    compute_seconds = max(operation['seconds'] - sum(record['seconds'] for record in stages), 0)
+    stage_summaries['compute'] = _rates(compute_seconds, particles, filaments)
+    summary['stages'] = stage_summaries
+    summary['filament_fit_cost'] = _fitCostSummary(operation['fit_batches'])
+
+    return summary
+
+def startReport():
+    global _current_report
+    _current_report = perfReport()
+    return _current_report
+
+def currentReport():
+    return _current_report
+
+def stopReport():
+
+    '''Stops recording and returns the report'''
+
+    global _current_report
+    report = _current_report
+    _current_report = None
+    return report
+
+@contextlib.contextmanager
+def timeOperation(name, inputs):
+    if _current_report is None:
+        yield None
+    else:
+        with _current_report.operation(name, inputs) as operation:
+            yield operation
+
+@contextlib.contextmanager
+def timeStage(name, particles = None, filaments = None):
+    if _current_report is None:
+        yield {}
+    else:
+        with _current_report.stage(name, particles, filaments) as record:
+            yield record
+
+def recordFitBatch(first_filament, last_filament, particles, seconds):
+    if _current_report is not None:
+        _current_report.addFitBatch(first_filament, last_filament, particles, seconds)
@@ -4,14 +4,21 @@ from matplotlib.backends.backend_pdf import PdfPages
 import seaborn as sns
 
 
-from filtools import parse_star, parse_mrc
+from filtools import parse_star, parse_mrc, segment_reductions
+
+#The columns each plot reads, the filament columns are always loaded as well
+COMMAND_COLUMNS = {
+    'plot_filament_pdf':['rlnAngleRot', 'rlnAngleTilt', 'rlnAnglePsi', 'rlnOriginXAngst', 'rlnOriginYAngst'],
+    'plotFilamentLengthHistogram':[],
+    'compareFilamentNumbers':[],
+    }
 
 def plot_changes():
     pass
 
 def plot_filament_pdf(starfile_path):
 
-    filament_data = parse_star.readFilamentsFromStarFile(starfile_path)
+    filament_data = parse_star.readFilamentsFromStarFile(starfile_path, usecols = COMMAND_COLUMNS['plot_filament_pdf'])
 
     step = int(filament_data.number_of_filaments/100)
 
@@ -60,20 +67,11 @@ def plot_filament_pdf(starfile_path):
 
 def plotFilamentLengthHistogram(starfile_path):
 
-    filament_data = parse_star.readFilamentsFromStarFile(starfile_path)
-
-    filament_length_array = []
-    longest_filament = 0
-    shortest_fil = 1e6
-
-    for key in sorted(filament_data.filaments.keys()):
-        fil_length = len(filament_data.getNumpyFilamentColumn(key, 'rlnAnglePsi'))
-        filament_length_array.append(fil_length)
+    filament_data = parse_star.readFilamentsFromStarFile(starfile_path, usecols = COMMAND_COLUMNS['plotFilamentLengthHistogram'])
 
-        if fil_length > longest_filament:
-            longest_filament = fil_length
-        if fil_length < shortest_fil:
-            shortest_fil = fil_length
+    filament_length_array = segment_reductions.segmentCounts(filament_data.filament_offsets)
+    longest_filament = int(filament_length_array.max())
+    shortest_fil = int(filament_length_array.min())
 
     bins = longest_filament - shortest_fil + 1
 
@@ -94,21 +92,21 @@ def compareFilamentNumbers(starfile1_path, starfile2_path):
     sns.set_context("poster", font_scale=0.5)
     sns.color_palette(palette=None)
 
-    filament_data1 = parse_star.readFilamentsFromStarFile(starfile1_path)
-    filament_data2 = parse_star.readFilamentsFromStarFile(starfile2_path)
+    filament_data1 = parse_star.readFilamentsFromStarFile(starfile1_path, usecols = COMMAND_COLUMNS['compareFilamentNumbers'])
+    filament_data2 = parse_star.readFilamentsFromStarFile(starfile2_path, usecols = COMMAND_COLUMNS['compareFilamentNumbers'])
 
     dataset1_uniquefils = set()
     dataset1_fil_lengths = dict()
     dataset2_uniquefils = set()
     dataset2_fil_lengths = dict()
 
-    for key in sorted(filament_data1.filaments.keys()):
+    for key in range(filament_data1.number_of_filaments):
         uniquefil_identifier = filament_data1.getRlnFilamentNumberandMicrograph(key)
         dataset1_uniquefils.add(uniquefil_identifier)
         dataset1_fil_lengths[uniquefil_identifier] = filament_data1.getNumberofParticlesinFilament(key)
         #print(len(dataset1_uniquefils), len(dataset2_uniquefils))
 
-    for key in sorted(filament_data2.filaments.keys()):
+    for key in range(filament_data2.number_of_filaments):
         uniquefil_identifier = filament_data2.getRlnFilamentNumberandMicrograph(key)
         dataset2_uniquefils.add(uniquefil_identifier)
         dataset2_fil_lengths[uniquefil_identifier] = filament_data2.getNumberofParticlesinFilament(key)
@@ -0,0 +1,106 @@
+'''Reductions over the particles of every filament at once.
+
+The particles are held in filament order, so filament i is the segment
+values[offsets[i]:offsets[i+1]] (see parse_star.findFilamentOffsets). Each
+function here reduces every segment in a single vectorized call and returns
+one value per filament. Empty filaments give nan (or 0 for counts).
+'''
+
+import numpy as np
+
+
+def segmentCounts(offsets):
+    return np.diff(np.asarray(offsets, dtype = np.int64))
+
+def segmentIds(offsets):
+
+    '''Returns the filament number of every particle'''
+
+    counts = segmentCounts(offsets)
+    return np.repeat(np.arange(len(counts)), counts)
+
+def expandSegments(segment_values, offsets):
+
+    '''Repeats one value per filament for each of its particles'''
+
+    return np.repeat(segment_values, segmentCounts(offsets))
+
+def _reduceSegments(ufunc, values, offsets, dtype = np.float64):
+    counts = segmentCounts(offsets)
+    result = np.full(len(counts), np.nan, dtype = dtype)
+    non_empty = counts > 0
+    if non_empty.any():
+        result[non_empty] = ufunc.reduceat(np.asarray(values), np.asarray(offsets[:-1])[non_empty])
+    return result
+
+def segmentSum(values, offsets):
+    return np.nan_to_num(_reduceSegments(np.add, values, offsets))
+
+def segmentMin(values, offsets):
+    return _reduceSegments(np.minimum, values, offsets)
+
+def segmentMax(values, offsets):
+    return _reduceSegments(np.maximum, values, offsets)
+
+def segmentMean(values, offsets):
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        return segmentSum(values, offsets) / segmentCounts(offsets)
+
+def sortWithinSegments(values, offsets):
+
+    '''Sorts the values of each filament, keeping the filaments in place'''
+
+    return np.asarray(values)[np.lexsort((values, segmentIds(offsets)))]
+
+def segmentQuantiles(values, offsets, quantiles):
+
+    '''Quantiles of each filament with linear interpolation, the same as
+    np.quantile. Returns an array of (filaments, quantiles)'''
+
+    offsets = np.asarray(offsets, dtype = np.int64)
+    counts = segmentCounts(offsets)
+    sorted_values = np.append(sortWithinSegments(values, offsets), np.nan).astype(np.float64)
+    quantiles = np.atleast_1d(np.asarray(quantiles, dtype = np.float64))
+
+    positions = quantiles[None,:] * (counts[:,None] - 1)
+    below = np.floor(positions).astype(np.int64)
+    above = np.minimum(below + 1, counts[:,None] - 1)
+    fraction = positions - below
+
+    #Empty filaments point at the nan on the end
+    empty = counts == 0
+    lower_positions = offsets[:-1,None] + below
+    upper_positions = offsets[:-1,None] + above
+    lower_positions[empty] = upper_positions[empty] = len(sorted_values) - 1
+    lower_values = sorted_values[lower_positions]
+    upper_values = sorted_values[upper_positions]
+
+    #np.quantile's interpolation, which is exact at both ends
+    difference = upper_values - lower_values
+    result = lower_values + difference * fraction
+    upper_half = fraction >= 0.5
+    result[upper_half] = (upper_values - difference * (1 - fraction))[upper_half]
+    result[empty] = np.nan
+
+    return result
+
+def segmentMedian(values, offsets):
+
+    '''Median of each filament, the same as np.median'''
+
+    offsets = np.asarray(offsets, dtype = np.int64)
+    counts = segmentCounts(offsets)
+    sorted_values = np.append(sortWithinSegments(values, offsets), np.nan).astype(np.float64)
+
+    empty = counts == 0
+    lower = np.where(empty, len(sorted_values) - 1, offsets[:-1] + (counts - 1) // 2)
+    upper = np.where(empty, len(sorted_values) - 1, offsets[:-1] + counts // 2)
+
+    return (sorted_values[lower] + sorted_values[upper]) / 2
+
+def segmentCircularMean(angles, offsets):
+
+    '''Circular mean in degrees of the angles of each filament, in [-180, 180]'''
+
+    radians = np.radians(angles)
+    return np.degrees(np.arctan2(segmentMean(np.sin(radians), offsets), segmentMean(np.cos(radians), offsets)))
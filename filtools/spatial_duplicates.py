@@ -0,0 +1,208 @@
+'''Finds particles that were picked more than once from their positions on the
+micrograph under a different filament or tube ID.
+
+Particle centres (the picked coordinates minus the origin shifts) are hashed
+into a grid of cells the size of the distance threshold, separately for each
+micrograph. Any two particles closer than the threshold must be in the same or
+neighbouring cells, so all the close pairs are found with one sort and a
+searchsorted for each of the 9 neighbouring cells - close to linear in the
+number of particles. Pairs from the same filament are neighbouring boxes rather
+than duplicates, so they're dropped. Of the rest only pairs where each
+particle is the other's closest in its filament are kept, so a distance larger
+than the box spacing can't chain along two filaments either. The pairs left
+that share particles are joined into clusters.
+'''
+
+import json
+
+import numpy as np
+
+#Columns needed to find the duplicates
+SPATIAL_COLUMNS = ['rlnMicrographName', 'rlnHelicalTubeID', 'rlnCoordinateX', 'rlnCoordinateY', 'rlnOriginXAngst', 'rlnOriginYAngst']
+
+#Most candidate pairs checked at once, which bounds the memory used
+DEFAULT_PAIR_BLOCK = 2**22
+
+
+def particleCentres(table, apix = 1.05):
+
+    '''Centres of the particles in micrograph pixels, with the origin shifts
+    (in Angstrom) applied'''
+
+    centre_x = table.getColumn('rlnCoordinateX') - table.getColumn('rlnOriginXAngst') / apix
+    centre_y = table.getColumn('rlnCoordinateY') - table.getColumn('rlnOriginYAngst') / apix
+
+    return centre_x, centre_y
+
+def closePairs(micrograph_ids, x_values, y_values, distance, pair_block = DEFAULT_PAIR_BLOCK):
+
+    '''Returns every pair of particles on the same micrograph within distance
+    of each other, as two arrays of particle numbers (first < second)
+
+    The candidate pairs from neighbouring cells are checked pair_block at a
+    time. The work grows with the square of the number of particles in a cell,
+    so it's only close to linear when the distance is small compared to the
+    spacing of the particles'''
+
+    if distance <= 0:
+        raise ValueError('The duplicate distance must be positive, not %s' % distance)
+
+    number_of_particles = len(x_values)
+    if number_of_particles == 0:
+        return np.zeros(0, dtype = np.int64), np.zeros(0, dtype = np.int64)
+
+    cell_x = np.floor(x_values / distance).astype(np.int64)
+    cell_y = np.floor(y_values / distance).astype(np.int64)
+    cell_x -= cell_x.min()
+    cell_y -= cell_y.min()
+
+    #A border of empty cells round each micrograph so neighbours never wrap
+    #onto the next row or micrograph
+    width = int(cell_x.max()) + 3
+    height = int(cell_y.max()) + 3
+    cell_keys = (np.asarray(micrograph_ids, dtype = np.int64) * height + cell_y + 1) * width + cell_x + 1
+
+    order = np.argsort(cell_keys, kind = 'stable')
+    sorted_keys = cell_keys[order]
+    particle_numbers = np.arange(number_of_particles)
+
+    first_particles = []
+    second_particles = []
+    for y_step in (-1, 0, 1):
+        for x_step in (-1, 0, 1):
+            neighbour_keys = cell_keys + y_step * width + x_step
+            lower = np.searchsorted(sorted_keys, neighbour_keys, 'left')
+            counts = np.searchsorted(sorted_keys, neighbour_keys, 'right') - lower
+
+            #Blocks of particles with about pair_block candidates between them
+            candidate_ends = np.cumsum(counts)
+            block_edges = np.unique(np.concatenate(([0], np.searchsorted(candidate_ends, np.arange(pair_block, candidate_ends[-1], pair_block)) + 1, [number_of_particles])))
+
+            for start, end in zip(block_edges[:-1], block_edges[1:]):
+                block_counts = counts[start:end]
+                firsts = np.repeat(particle_numbers[start:end], block_counts)
+                positions = np.arange(len(firsts)) - np.repeat(np.cumsum(block_counts) - block_counts, block_counts) + np.repeat(lower[start:end], block_counts)
+                seconds = order[positions]
+
+                candidates = firsts < seconds
+                firsts = firsts[candidates]
+                seconds = seconds[candidates]
+                close = (x_values[firsts] - x_values[seconds])**2 + (y_values[firsts] - y_values[seconds])**2 <= distance**2
+
+                first_particles.append(firsts[close])
+                second_particles.append(seconds[close])
+
+    return np.concatenate(first_particles), np.concatenate(second_particles)
+
+def mutualNearestPairs(first_particles, second_particles, distances, tube_ids):
+
+    '''Keeps the pairs where each particle is the closest particle of the
+    other's filament to it'''
+
+    keep = np.ones(len(first_particles), dtype = bool)
+    for particles, others in [(first_particles, second_particles), (second_particles, first_particles)]:
+        other_tubes = tube_ids[others]
+        order = np.lexsort((distances, other_tubes, particles))
+        group_starts = np.ones(len(order), dtype = bool)
+        group_starts[1:] = (particles[order][1:] != particles[order][:-1]) | (other_tubes[order][1:] != other_tubes[order][:-1])
+
+        nearest = np.zeros(len(order), dtype = bool)
+        nearest[order[group_starts]] = True
+        keep &= nearest
+
+    return first_particles[keep], second_particles[keep]
+
+def connectedLabels(number_of_particles, first_particles, second_particles):
+
+    '''Labels each particle with the lowest particle number it is joined to
+    through the pairs'''
+
+    labels = np.arange(number_of_particles)
+
+    while True:
+        lowest = np.minimum(labels[first_particles], labels[second_particles])
+        new_labels = labels.copy()
+        np.minimum.at(new_labels, first_particles, lowest)
+        np.minimum.at(new_labels, second_particles, lowest)
+        #Pointer jumping so long chains join up quickly
+        new_labels = new_labels[new_labels]
+
+        if np.array_equal(new_labels, labels):
+            return labels
+        labels = new_labels
+
+def findDuplicateClusters(table, distance, apix = 1.05):
+
+    '''Returns the cluster number of every particle in the table, or -1 for the
+    particles without a particle from another filament within distance (in
+    pixels) of them on the same micrograph'''
+
+    micrograph_ids = np.unique(table.getColumn('rlnMicrographName'), return_inverse = True)[1].reshape(-1)
+    centre_x, centre_y = particleCentres(table, apix)
+    first_particles, second_particles = closePairs(micrograph_ids, centre_x, centre_y, distance)
+
+    #Close particles of the same filament are its neighbouring boxes, which
+    #would otherwise chain the whole filament into one cluster
+    tube_ids = table.getColumn('rlnHelicalTubeID')
+    other_filament = tube_ids[first_particles] != tube_ids[second_particles]
+    first_particles = first_particles[other_filament]
+    second_particles = second_particles[other_filament]
+
+    distances = np.hypot(centre_x[first_particles] - centre_x[second_particles], centre_y[first_particles] - centre_y[second_particles])
+    first_particles, second_particles = mutualNearestPairs(first_particles, second_particles, distances, tube_ids)
+
+    cluster_ids = np.full(table.number_of_rows, -1, dtype = np.int64)
+    if len(first_particles) == 0:
+        return cluster_ids
+
+    labels = connectedLabels(table.number_of_rows, first_particles, second_particles)
+    in_cluster = np.zeros(table.number_of_rows, dtype = bool)
+    in_cluster[first_particles] = in_cluster[second_particles] = True
+    cluster_ids[in_cluster] = np.unique(labels[in_cluster], return_inverse = True)[1].reshape(-1)
+
+    return cluster_ids
+
+def lowerScoringMembers(cluster_ids, scores):
+
+    '''Mask of the particles to drop so only the best scoring particle of each
+    cluster is kept (the first one if the scores are equal)'''
+
+    clustered = np.flatnonzero(cluster_ids >= 0)
+    order = clustered[np.lexsort((-np.asarray(scores, dtype = np.float64)[clustered], cluster_ids[clustered]))]
+    cluster_starts = np.ones(len(order), dtype = bool)
+    cluster_starts[1:] = cluster_ids[order][1:] != cluster_ids[order][:-1]
+
+    dropped = np.zeros(len(cluster_ids), dtype = bool)
+    dropped[order[~cluster_starts]] = True
+
+    return dropped
+
+def clusterReport(table, cluster_ids, dropped, apix = 1.05):
+
+    '''A list with the micrograph and particles of each cluster'''
+
+    clustered = np.flatnonzero(cluster_ids >= 0)
+    clustered = clustered[np.argsort(cluster_ids[clustered], kind = 'stable')]
+    cluster_starts = np.flatnonzero(np.diff(np.concatenate(([-1], cluster_ids[clustered]))) != 0)
+
+    micrograph_names = table.getColumn('rlnMicrographName')
+    centre_x, centre_y = particleCentres(table, apix)
+    optional_columns = [name for name in ['rlnImageName', 'rlnHelicalTubeID', 'rlnMaxValueProbDistribution'] if table.hasColumn(name)]
+
+    report = []
+    for cluster_rows in np.split(clustered, cluster_starts[1:]):
+        particles = []
+        for row in cluster_rows.tolist():
+            particle = {'x':float(centre_x[row]), 'y':float(centre_y[row]), 'kept':not bool(dropped[row])}
+            for name in optional_columns:
+                value = table.getColumn(name)[row]
+                particle[name] = value.decode() if isinstance(value, bytes) else value.item()
+            particles.append(particle)
+        report.append({'micrograph':micrograph_names[cluster_rows[0]].decode(), 'particles':particles})
+
+    return report
+
+def saveClusterReport(filename, table, cluster_ids, dropped, apix = 1.05):
+    with open(filename, 'w') as report_file:
+        json.dump(clusterReport(table, cluster_ids, dropped, apix), report_file, indent = 2)
+    print('The duplicate clusters were saved to ' + filename)
@@ -0,0 +1,181 @@
+'''On disk cache of parsed starfiles.
+
+Each cached starfile is a directory of .npy column files (memory mapped when
+loaded) plus a meta.json holding the header information. Entries are kept in a
+.filtools_cache directory next to the starfile, keyed by its absolute path, and
+are only used if its size and modification time still match, so editing or
+rewriting a starfile invalidates its entry automatically.
+
+The cache is controlled with environment variables:
+    FILTOOLS_CACHE=0          turns the cache off
+    FILTOOLS_CACHE_DIR        keep all the entries in this directory instead
+    FILTOOLS_CACHE_MAX_GB     size limit, least recently used entries are
+                              removed when it is exceeded (default 20)
+'''
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from filtools import star_table, star_tokenizer
+
+CACHE_VERSION = 2
+
+
+def cacheEnabled():
+    return os.environ.get('FILTOOLS_CACHE', '1') != '0'
+
+def getCacheDirectory(filename):
+
+    '''Returns the cache directory for a starfile - next to it unless
+    FILTOOLS_CACHE_DIR is set'''
+
+    return os.environ.get('FILTOOLS_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(filename)), '.filtools_cache'))
+
+def getCacheSizeLimit():
+    return int(float(os.environ.get('FILTOOLS_CACHE_MAX_GB', 20)) * 1024**3)
+
+def cacheEntryPath(filename):
+
+    '''Returns the cache directory used for a starfile'''
+
+    absolute_path = os.path.abspath(filename)
+    path_hash = hashlib.sha1(absolute_path.encode()).hexdigest()[:16]
+
+    return os.path.join(getCacheDirectory(filename), '%s.%s.npcache' % (os.path.basename(filename), path_hash))
+
+def _starFileKey(filename):
+    file_stats = os.stat(filename)
+    return {'path':os.path.abspath(filename), 'size':file_stats.st_size, 'mtime_ns':file_stats.st_mtime_ns}
+
+def _readCacheMetadata(entry_path):
+    try:
+        with open(os.path.join(entry_path, 'meta.json'), 'r') as meta_file:
+            return json.load(meta_file)
+    except (OSError, ValueError):
+        return None
+
+def loadCachedTable(filename):
+
+    '''Loads the header information and particle table of a starfile from the
+    cache. Columns are memory mapped copy-on-write, so they can be edited
+    without touching the cache
+
+    The table keeps the position of each row in the starfile, so star_writer can
+    still copy its original text
+
+    Returns (star_comments, optics_info, headers, table) or None if there is no
+    valid entry for the file'''
+
+    if not cacheEnabled():
+        return None
+
+    entry_path = cacheEntryPath(filename)
+    metadata = _readCacheMetadata(entry_path)
+
+    if metadata is None or metadata['version'] != CACHE_VERSION or metadata['key'] != _starFileKey(filename):
+        return None
+
+    try:
+        columns = {}
+        for number, name in enumerate(metadata['column_names']):
+            columns[name] = np.load(os.path.join(entry_path, '%i.npy' % number), mmap_mode = 'c')
+        row_starts = np.load(os.path.join(entry_path, 'row_starts.npy'), mmap_mode = 'r')
+        row_ends = np.load(os.path.join(entry_path, 'row_ends.npy'), mmap_mode = 'r')
+    except (OSError, ValueError):
+        return None
+
+    #Record the use for the least recently used eviction. The cache may be
+    #read only or the entry evicted by another process, which is fine
+    try:
+        os.utime(os.path.join(entry_path, 'meta.json'))
+    except OSError:
+        pass
+
+    text_source = star_tokenizer.starTextSource.fromDict(metadata['text_source'])
+    table = star_table.starDataTable(metadata['column_names'], columns, text_source, row_starts, row_ends)
+    headers = {name:number for number, name in enumerate(metadata['column_names'])}
+
+    return metadata['star_comments'], metadata['optics_info'], headers, table
+
+def saveCachedTable(filename, star_comments, optics_info, table):
+
+    '''Saves a parsed starfile into the cache and then evicts old entries if
+    the cache has grown past its size limit. Failing to write the cache is
+    never an error - the starfile just gets parsed again next time'''
+
+    if not cacheEnabled() or not table.hasTextSource():
+        return
+
+    entry_path = cacheEntryPath(filename)
+    cache_directory = getCacheDirectory(filename)
+    metadata = {
+                'version':CACHE_VERSION,
+                'key':_starFileKey(filename),
+                'star_comments':star_comments,
+                'optics_info':optics_info,
+                'column_names':table.column_names,
+                'number_of_rows':table.number_of_rows,
+                'text_source':table.text_source.toDict(),
+                'created':time.time(),
+                }
+
+    temp_path = None
+    try:
+        os.makedirs(cache_directory, exist_ok = True)
+
+        #Write into a temporary directory and move it into place so a half
+        #written entry is never read
+        temp_path = tempfile.mkdtemp(dir = cache_directory, prefix = '.tmp')
+        for number, name in enumerate(table.column_names):
+            np.save(os.path.join(temp_path, '%i.npy' % number), np.ascontiguousarray(table.getColumn(name)))
+        np.save(os.path.join(temp_path, 'row_starts.npy'), table.row_starts)
+        np.save(os.path.join(temp_path, 'row_ends.npy'), table.row_ends)
+        with open(os.path.join(temp_path, 'meta.json'), 'w') as meta_file:
+            json.dump(metadata, meta_file)
+
+        if os.path.exists(entry_path):
+            shutil.rmtree(entry_path, ignore_errors = True)
+        os.rename(temp_path, entry_path)
+    except OSError:
+        if temp_path is not None:
+            shutil.rmtree(temp_path, ignore_errors = True)
+        return
+
+    evictCacheEntries(cache_directory, getCacheSizeLimit(), keep = entry_path)
+
+def _entrySize(entry_path):
+    return sum(os.path.getsize(os.path.join(entry_path, i)) for i in os.listdir(entry_path))
+
+def evictCacheEntries(cache_directory, max_bytes, keep = None):
+
+    '''Removes the least recently used entries of a cache directory until it is
+    no bigger than max_bytes. The entry given by keep is only removed if it is
+    bigger than the whole limit by itself'''
+
+    if not os.path.isdir(cache_directory):
+        return
+
+    entries = []
+    for entry_name in os.listdir(cache_directory):
+        entry_path = os.path.join(cache_directory, entry_name)
+        if not entry_name.endswith('.npcache') or not os.path.isdir(entry_path):
+            continue
+        try:
+            last_used = os.path.getmtime(os.path.join(entry_path, 'meta.json'))
+            entries.append([last_used, _entrySize(entry_path), entry_path])
+        except OSError:
+            continue
+
+    total_size = sum(entry[1] for entry in entries)
+
+    for last_used, size, entry_path in sorted(entries, key = lambda x:(x[2] == keep, x[0])):
+        if total_size <= max_bytes:
+            break
+        shutil.rmtree(entry_path, ignore_errors = True)
+        total_size -= size
@@ -0,0 +1,108 @@
+import mmap
+
+from filtools import star_tokenizer
+
+
+def parseStarValue(text):
+
+    '''Converts a single value from a star file into an int, float or str'''
+
+    for value_type in (int, float):
+        try:
+            return value_type(text)
+        except ValueError:
+            pass
+
+    if len(text) > 1 and text[0] == text[-1] and text[0] in '"\'':
+        return text[1:-1]
+    return text
+
+
+class starFile(object):
+
+    '''Index of every data_ block in a starfile - particle, model, optimiser
+    and sampling starfiles all work the same way
+
+    The file is memory mapped and all the blocks are found in a single scan
+    when it is opened, but a block's data is only parsed the first time it
+    is asked for, so reading one small table out of a big file doesn't pay
+    for the rest of it
+
+    Use as a context manager or call close() when finished'''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.buffer = star_tokenizer.mapStarFile(self.filename)
+        self.blocks = {}
+
+        self._tables = {}
+        self._values = {}
+
+        for block in star_tokenizer.findDataBlocks(self.buffer):
+            if block.name not in self.blocks:
+                self.blocks[block.name] = block
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._tables = {}
+        if isinstance(self.buffer, mmap.mmap):
+            try:
+                self.buffer.close()
+            except BufferError:
+                #Still in use by an array, the map is freed along with it
+                pass
+
+    def getBlockNames(self):
+        return list(self.blocks.keys())
+
+    def hasBlock(self, block_name):
+        return block_name in self.blocks
+
+    def getBlock(self, block_name):
+        try:
+            return self.blocks[block_name]
+        except KeyError:
+            raise KeyError('There is no data_%s block in %s' % (block_name, self.filename))
+
+    def getParticleBlock(self):
+        return star_tokenizer.findParticleBlock(list(self.blocks.values()))
+
+    def getTable(self, block_name):
+
+        '''Returns the loop data of a block as a starDataTable, parsing it the
+        first time it is asked for'''
+
+        if block_name not in self._tables:
+            block = self.getBlock(block_name)
+            if not block.is_loop:
+                raise ValueError('data_%s in %s is not a loop_ block' % (block_name, self.filename))
+            self._tables[block_name] = block.readTable(self.buffer, text_source = block.getTextSource(self.filename))
+
+        return self._tables[block_name]
+
+    def getValues(self, block_name):
+
+        '''Returns the values of a key-value block (e.g. data_model_general)
+        as a dictionary'''
+
+        if block_name not in self._values:
+            block = self.getBlock(block_name)
+            if block.is_loop:
+                raise ValueError('data_%s in %s is a loop_ block' % (block_name, self.filename))
+
+            values = {}
+            for line in block.header_lines:
+                if line.startswith('_'):
+                    key_value = line.split(None, 1)
+                    values[key_value[0][1:]] = parseStarValue(key_value[1].strip()) if len(key_value) > 1 else ''
+            self._values[block_name] = values
+
+        return self._values[block_name]
+
+    def getValue(self, block_name, key):
+        return self.getValues(block_name)[key]
@@ -0,0 +1,113 @@
+'''Joins the particles of two starfiles on key columns, e.g. the micrograph and
+image name, without a Python loop over the particles.
+
+The key columns of both tables are turned into one integer code per row (equal
+keys get equal codes), the codes of the right table are sorted once and every
+left row looks up its matches with searchsorted. The result is a pair of index
+arrays, so whole columns can then be copied across with one fancy index.
+'''
+
+import json
+
+import numpy as np
+
+from filtools import star_table
+
+#Columns that identify a particle
+PARTICLE_KEYS = ['rlnMicrographName', 'rlnImageName']
+
+
+def _keyColumn(column):
+    if star_table.columnIsString(column):
+        return np.asarray(column)
+    return star_table.columnToText(column)
+
+def keyCodes(left_columns, right_columns):
+
+    '''Returns an integer code for every row of the left and right tables, the
+    same for rows with the same values in all the key columns'''
+
+    left_codes = np.zeros(len(left_columns[0]), dtype = np.int64)
+    right_codes = np.zeros(len(right_columns[0]), dtype = np.int64)
+
+    for left_column, right_column in zip(left_columns, right_columns):
+        left_column = np.asarray(left_column)
+        right_column = np.asarray(right_column)
+        if left_column.dtype.kind != right_column.dtype.kind:
+            left_column, right_column = _keyColumn(left_column), _keyColumn(right_column)
+
+        values, column_codes = np.unique(np.concatenate((left_column, right_column)), return_inverse = True)
+        column_codes = column_codes.reshape(-1)
+
+        #Combine with the codes so far, then renumber so they stay small
+        combined_codes = np.concatenate((left_codes, right_codes)) * len(values) + column_codes
+        combined_codes = np.unique(combined_codes, return_inverse = True)[1].reshape(-1)
+        left_codes, right_codes = combined_codes[:len(left_codes)], combined_codes[len(left_codes):]
+
+    return left_codes, right_codes
+
+def matchRows(left_columns, right_columns):
+
+    '''For every row of the left table finds the row of the right table with
+    the same keys
+
+    Returns the matching right rows (-1 where there isn't one, the first
+    matching row where there are several) and the number of right rows that
+    matched each left row'''
+
+    left_codes, right_codes = keyCodes(left_columns, right_columns)
+
+    order = np.argsort(right_codes, kind = 'stable')
+    sorted_codes = right_codes[order]
+    lower = np.searchsorted(sorted_codes, left_codes, 'left')
+    match_counts = np.searchsorted(sorted_codes, left_codes, 'right') - lower
+
+    right_rows = np.full(len(left_codes), -1, dtype = np.int64)
+    matched = match_counts > 0
+    right_rows[matched] = order[lower[matched]]
+
+    return right_rows, match_counts
+
+def joinTables(target_table, source_table, target_keys, source_keys):
+
+    '''Matches the rows of target_table to the rows of source_table with the
+    same values in the key columns
+
+    Returns the source row of every target row (-1 where there isn't exactly
+    one, so ambiguous rows are left alone) and the number of source rows that
+    matched each target row'''
+
+    source_rows, match_counts = matchRows([target_table.getColumn(name) for name in target_keys],
+                                          [source_table.getColumn(name) for name in source_keys])
+    source_rows[match_counts > 1] = -1
+
+    return source_rows, match_counts
+
+def transferColumns(target_table, source_table, column_names, source_rows):
+
+    '''Copies the columns from the matched source rows into the target table'''
+
+    target_rows = np.flatnonzero(source_rows >= 0)
+    for name in column_names:
+        target_table.setColumn(name, source_table.getColumn(name)[source_rows[target_rows]], rows = target_rows)
+
+    return len(target_rows)
+
+def joinReport(target_table, target_keys, match_counts):
+
+    '''A dictionary with the number of matched, unmatched and ambiguous target
+    rows and the keys of the unmatched and ambiguous ones'''
+
+    report = {'keys':list(target_keys), 'matched':int(np.count_nonzero(match_counts == 1)),
+              'unmatched':int(np.count_nonzero(match_counts == 0)), 'ambiguous':int(np.count_nonzero(match_counts > 1))}
+
+    key_columns = [star_table.columnToText(target_table.getColumn(name)).astype('U') for name in target_keys]
+    for name, rows in [('unmatched_keys', match_counts == 0), ('ambiguous_keys', match_counts > 1)]:
+        report[name] = [list(key) for key in zip(*[column[rows].tolist() for column in key_columns])]
+
+    return report
+
+def saveJoinReport(filename, target_table, target_keys, match_counts):
+    with open(filename, 'w') as report_file:
+        json.dump(joinReport(target_table, target_keys, match_counts), report_file, indent = 2)
+    print('The unmatched and ambiguous particles were saved to ' + filename)
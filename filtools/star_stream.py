@@ -0,0 +1,181 @@
+import numpy as np
+
+from filtools import star_file, star_tokenizer, star_writer
+
+
+class starChunkReader(object):
+
+    '''Reads the comments, optics block and particle headers of a starfile
+    when it is opened and then yields the particle data as starDataTables of
+    (at most) chunk_size rows, so only one chunk is held in memory at a time
+
+    The blocks of the file are found with star_file.starFile and each chunk
+    is tokenized in bulk by star_tokenizer rather than line by line
+
+    If usecols is given only those columns are loaded into the chunks, the rest
+    are carried through as the original text when the chunks are written.
+    workers sets the number of processes readAllChunks uses to parse the file
+
+    Use as a context manager or call close() when finished'''
+
+    def __init__(self, filename, chunk_size = 100000, usecols = None, workers = None):
+        self.filename = filename
+        self.chunk_size = chunk_size
+        self.usecols = usecols
+        self.workers = workers
+        self.star_comments = []
+        self.optics_info = []
+        self.headers = {}
+        self.column_names = []
+        self.number_of_rows_read = 0
+
+        self.star_file = star_file.starFile(self.filename)
+        self._buffer = self.star_file.buffer
+        self._particle_block = None
+        self.text_source = None
+
+        self.readStarHeader()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.star_file.close()
+
+    def readStarHeader(self):
+
+        '''Finds the data blocks in the file and sorts out the comments, optics
+        info and particle headers'''
+
+        self._particle_block = self.star_file.getParticleBlock()
+
+        for block in self.star_file.blocks.values():
+            for line in block.header_lines:
+                if line.startswith('#'):
+                    self.star_comments.append(line)
+
+            if block.name == 'optics':
+                optics_lines = self._buffer[block.start:block.end].decode().splitlines()
+                self.optics_info = [i.strip() for i in optics_lines if len(i.strip()) != 0 and not i.strip().startswith('#')]
+
+        for position, header_name in enumerate(self._particle_block.column_names):
+            self.headers[header_name] = position
+
+        self.column_names = list(self._particle_block.column_names)
+        self.text_source = self._particle_block.getTextSource(self.filename)
+
+        if self.usecols is not None:
+            missing_columns = [name for name in self.usecols if name not in self.headers]
+            if len(missing_columns) > 0:
+                raise ValueError('The column(s) %s are not in the starfile %s' % (', '.join(missing_columns), self.filename))
+            self.usecols = set(self.usecols)
+
+    def _findChunkEnd(self, position, number_of_lines):
+
+        '''Returns the byte position after the next number_of_lines lines'''
+
+        body_end = self._particle_block.body_end
+        window = 256 * number_of_lines
+
+        while True:
+            window_end = min(position + window, body_end)
+            newlines = np.flatnonzero(np.frombuffer(self._buffer, dtype = np.uint8, count = window_end - position, offset = position) == 10)
+
+            if len(newlines) >= number_of_lines:
+                return position + int(newlines[number_of_lines - 1]) + 1
+            if window_end == body_end:
+                return body_end
+            window *= 2
+
+    def iterChunks(self):
+
+        '''Yields the particle data as starDataTables of chunk_size rows'''
+
+        position = self._particle_block.body_start
+
+        while position < self._particle_block.body_end:
+            chunk_end = self._findChunkEnd(position, self.chunk_size)
+            chunk = star_tokenizer.readTableFromByteRange(self._buffer, position, chunk_end, self.column_names, text_source = self.text_source, usecols = self.usecols)
+            position = chunk_end
+
+            if chunk.number_of_rows == 0:
+                continue
+
+            self.number_of_rows_read += chunk.number_of_rows
+            yield chunk
+
+    def __iter__(self):
+        return self.iterChunks()
+
+    def readAllChunks(self):
+
+        '''Reads all the remaining data into a single starDataTable'''
+
+        return self._particle_block.readTable(self._buffer, text_source = self.text_source, usecols = self.usecols, workers = self.workers)
+
+
+class starChunkWriter(object):
+
+    '''Writes a starfile one chunk of particles at a time. The optics block and
+    particle headers are written when the file is opened - copied from the
+    text_source file if one is given, as is any untouched text of the chunks
+
+    Use as a context manager or call close() when finished'''
+
+    def __init__(self, filename, star_comments, optics_info, column_names, float_format = '%.6f', text_source = None):
+        self.filename = filename
+        self.column_names = list(column_names)
+        self.float_format = float_format
+        self.number_of_rows_written = 0
+
+        text_source = star_writer.usableTextSource(text_source, filename)
+        header = star_writer.sourceHeader(text_source, self.column_names)
+        self.text_source = text_source if header is not None else None
+
+        self._starfile = open(self.filename, 'wb')
+        if header is None:
+            star_writer.writeStarHeader(self._starfile, star_comments, optics_info, self.column_names)
+        else:
+            self._starfile.write(header)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.text_source is not None and not self._starfile.closed:
+            self._starfile.write(self.text_source.getFooter())
+        self._starfile.close()
+
+    def writeChunk(self, table):
+
+        text_source = self.text_source if table.text_source is self.text_source else None
+        if text_source is None and table.column_names != self.column_names:
+            table = table.selectColumns(self.column_names)
+
+        star_writer.writeRows(self._starfile, table, self.float_format, text_source)
+        self.number_of_rows_written += table.number_of_rows
+
+
+def processStarFileInChunks(input_filename, output_filename, chunk_function, chunk_size = 100000, float_format = '%.6f', usecols = None):
+
+    '''Streams a starfile through chunk_function, which is given each chunk as a
+    starDataTable and returns the (edited or filtered) table to write out.
+    Suitable for any operation that only needs one row at a time e.g. selecting
+    particles or resetting a column, and runs in bounded memory
+
+    Only the columns in usecols are loaded if it is given
+
+    Returns the number of particles read and written'''
+
+    with starChunkReader(input_filename, chunk_size, usecols) as reader:
+        with starChunkWriter(output_filename, reader.star_comments, reader.optics_info, reader.column_names, float_format, reader.text_source) as writer:
+            for chunk in reader:
+                writer.writeChunk(chunk_function(chunk))
+
+    return reader.number_of_rows_read, writer.number_of_rows_written
@@ -0,0 +1,275 @@
+import numpy as np
+
+
+def tokensToColumn(tokens):
+
+    '''Converts an array of byte string tokens from a star file into a typed
+    column. Integer columns are stored as int32 (int64 if they would overflow),
+    other numbers as float64 and anything else is kept as a fixed width byte
+    string array, which is far smaller than a list of python strings'''
+
+    tokens = np.asarray(tokens, dtype = 'S')
+
+    try:
+        values = tokens.astype(np.int64)
+    except (ValueError, OverflowError):
+        pass
+    else:
+        if len(values) == 0 or (values.min() >= np.iinfo(np.int32).min and values.max() <= np.iinfo(np.int32).max):
+            return values.astype(np.int32)
+        return values
+
+    try:
+        return tokens.astype(np.float64)
+    except ValueError:
+        return tokens
+
+def columnIsString(column):
+    return column.dtype.kind == 'S'
+
+def columnToText(column, float_format = '%.6f'):
+
+    '''Returns the column as an array of byte strings ready to be written into
+    a star file'''
+
+    if column.dtype.kind == 'S':
+        return column
+    elif column.dtype.kind == 'f':
+        return np.char.mod(float_format.encode(), column)
+    else:
+        return column.astype('S')
+
+def valueToColumnType(column, value):
+
+    '''Converts a single value (often a string pulled from another star file)
+    into the type used by a column'''
+
+    if column.dtype.kind == 'S':
+        if isinstance(value, bytes):
+            return value
+        return str(value).encode()
+    if isinstance(value, bytes):
+        value = value.decode()
+    if column.dtype.kind in 'iu':
+        return int(float(value))
+    return float(value)
+
+
+class starDataTable(object):
+
+    '''Columnar store for the data in a loop_ block of a star file.
+
+    Each column is parsed once into a typed numpy array (see tokensToColumn)
+    and all the columns share the same row order, so selecting or reordering
+    particles is a single numpy indexing operation per column
+
+    Tables read from a file also keep the byte range of each row's line in
+    that file (text_source, row_starts and row_ends) and note which columns
+    have been changed, so star_writer can copy the untouched text straight
+    back out'''
+
+    def __init__(self, column_names, columns = None, text_source = None, row_starts = None, row_ends = None, modified_columns = ()):
+        self.column_names = list(column_names)
+        self.columns = {}
+        self.number_of_rows = 0
+        self.text_source = text_source
+        self.row_starts = row_starts
+        self.row_ends = row_ends
+        self.modified_columns = set(modified_columns)
+
+        if columns is not None:
+            for name in self.column_names:
+                self.columns[name] = columns[name]
+            if len(self.column_names) > 0:
+                self.number_of_rows = len(self.columns[self.column_names[0]])
+
+    def hasTextSource(self):
+        return self.text_source is not None and self.row_starts is not None
+
+    def getPassthroughColumns(self):
+
+        '''Returns the columns of the original file that were not loaded (see
+        usecols) - these only exist as the row text in the original file'''
+
+        if not self.hasTextSource():
+            return []
+        return [name for name in self.text_source.column_names if name not in self.columns]
+
+    @classmethod
+    def fromDataLines(cls, column_names, data_lines):
+
+        '''Makes a table from the (byte string) data lines of a star file loop'''
+
+        number_of_columns = len(column_names)
+        tokens = np.array(b' '.join(data_lines).split(), dtype = 'S')
+
+        if len(tokens) != len(data_lines) * number_of_columns:
+            raise ValueError('The number of data values does not match the number of headers in the star file')
+
+        tokens = tokens.reshape(len(data_lines), number_of_columns)
+
+        columns = {}
+        for i, name in enumerate(column_names):
+            columns[name] = tokensToColumn(tokens[:,i])
+
+        table = cls(column_names, columns)
+        table.number_of_rows = len(data_lines)
+
+        return table
+
+    def hasColumn(self, name):
+        return name in self.columns
+
+    def getColumn(self, name):
+        try:
+            return self.columns[name]
+        except KeyError:
+            if name in self.getPassthroughColumns():
+                raise KeyError('The column %s was not loaded from the starfile' % name)
+            raise
+
+    def setColumn(self, name, values, rows = None):
+
+        '''Sets the values of an existing column (or part of it if rows is
+        given). The column type is promoted if the new data does not fit e.g.
+        setting fractional values into an integer column'''
+
+        column = self.columns[name]
+        values = np.asarray(values)
+
+        if column.dtype.kind == 'S' and values.dtype.kind != 'S':
+            values = columnToText(values)
+        elif column.dtype.kind != 'S' and values.dtype.kind in 'SU':
+            values = tokensToColumn(values.astype('S'))
+
+        new_dtype = np.result_type(column.dtype, values.dtype)
+        if column.dtype.kind in 'iu' and values.dtype.kind == 'f':
+            new_dtype = np.float64
+        if new_dtype != column.dtype:
+            column = column.astype(new_dtype)
+            self.columns[name] = column
+
+        self.modified_columns.add(name)
+
+        if rows is None:
+            if len(values) != self.number_of_rows:
+                raise ValueError('The new data column is an incorrect length or shape')
+            column[:] = values
+        else:
+            column[rows] = values
+
+    def setValue(self, name, row, value):
+        column = self.columns[name]
+        value = valueToColumnType(column, value)
+        if column.dtype.kind in 'iu' and isinstance(value, float):
+            self.setColumn(name, np.array([value]), rows = [row])
+        elif column.dtype.kind == 'S' and len(value) > column.dtype.itemsize:
+            self.setColumn(name, np.array([value]), rows = [row])
+        else:
+            column[row] = value
+            self.modified_columns.add(name)
+
+    def getValue(self, name, row):
+
+        '''Returns a single value as a python object (str for text columns)'''
+
+        value = self.columns[name][row]
+        if isinstance(value, bytes):
+            return value.decode()
+        return value.item()
+
+    def getValueString(self, name, row):
+        value = self.columns[name][row]
+        if isinstance(value, bytes):
+            return value.decode()
+        return columnToText(self.columns[name][row:row+1])[0].decode()
+
+    def addColumn(self, name, values):
+
+        '''Adds a new column to the end of the table - raises an error if the
+        column already exists or is the wrong length'''
+
+        if name in self.columns:
+            raise ValueError('The column %s already exists' % name)
+
+        values = np.asarray(values)
+        if values.dtype.kind == 'U':
+            values = values.astype('S')
+        if len(values) != self.number_of_rows:
+            raise ValueError('The new data column is an incorrect length or shape')
+
+        self.column_names.append(name)
+        self.columns[name] = values.copy()
+        self.modified_columns.add(name)
+
+    def replaceColumn(self, name, values):
+
+        '''Swaps in a new array for an existing column rather than writing into
+        the old one, which may be shared with another table'''
+
+        values = np.asarray(values)
+        if len(values) != self.number_of_rows:
+            raise ValueError('The new data column is an incorrect length or shape')
+
+        self.columns[name] = values
+        self.modified_columns.add(name)
+
+    def getRow(self, row):
+
+        '''Returns all the data for one row as a list of strings'''
+
+        return [self.getValueString(name, row) for name in self.column_names]
+
+    def take(self, index):
+
+        '''Returns a new table containing the rows specified by index, which
+        can be an integer array, a boolean mask or a slice'''
+
+        if not isinstance(index, slice):
+            index = np.asarray(index)
+        columns = {name:self.columns[name][index] for name in self.column_names}
+
+        if not self.hasTextSource():
+            return starDataTable(self.column_names, columns, modified_columns = self.modified_columns)
+
+        return starDataTable(self.column_names, columns, self.text_source, self.row_starts[index], self.row_ends[index], self.modified_columns)
+
+    def selectColumns(self, column_names):
+
+        '''Returns a table with only the given columns, in the given order,
+        sharing the column arrays of this one'''
+
+        return starDataTable(column_names, self.columns, self.text_source, self.row_starts, self.row_ends, self.modified_columns)
+
+    def sortByColumn(self, name):
+        return self.take(np.argsort(self.columns[name], kind = 'stable'))
+
+
+def concatenateTables(tables):
+
+    '''Joins several tables with identical columns into one table. The row
+    text is only kept if all the tables were read from the same file'''
+
+    column_names = tables[0].column_names
+    columns = {}
+    modified_columns = set()
+
+    for name in column_names:
+        parts = [table.columns[name] for table in tables]
+        if any(part.dtype.kind == 'S' for part in parts):
+            parts = [columnToText(part) for part in parts]
+        columns[name] = np.concatenate(parts)
+
+    for table in tables:
+        modified_columns.update(table.modified_columns)
+
+    text_source = tables[0].text_source
+    if not all(table.hasTextSource() and table.text_source is text_source for table in tables):
+        if any(len(table.getPassthroughColumns()) > 0 for table in tables):
+            raise ValueError('Tables without all their columns loaded can only be joined with tables from the same starfile')
+        return starDataTable(column_names, columns, modified_columns = modified_columns)
+
+    row_starts = np.concatenate([table.row_starts for table in tables])
+    row_ends = np.concatenate([table.row_ends for table in tables])
+
+    return starDataTable(column_names, columns, text_source, row_starts, row_ends, modified_columns)
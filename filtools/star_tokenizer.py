@@ -0,0 +1,407 @@
+import concurrent.futures
+import itertools
+import mmap
+import os
+
+import numpy as np
+
+from filtools import star_table
+
+#Byte ranges are tokenized in pieces of roughly this size to bound memory use
+DEFAULT_RANGE_SIZE = 64 * 1024 * 1024
+
+#Number of processes used to tokenize big loops (see setDefaultWorkers) and the
+#smallest piece worth sending to another process
+DEFAULT_WORKERS = 1
+MIN_PARALLEL_RANGE_SIZE = 4 * 1024 * 1024
+
+
+def setDefaultWorkers(workers):
+
+    '''Sets the number of processes used to parse starfiles when a reader isn't
+    given its own workers option'''
+
+    global DEFAULT_WORKERS
+    DEFAULT_WORKERS = max(int(workers), 1)
+
+def mapStarFile(filename):
+
+    '''Memory maps a starfile for reading. The map stays valid after the file
+    itself is closed'''
+
+    with open(filename, 'rb') as starfile:
+        if os.fstat(starfile.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(starfile.fileno(), 0, access = mmap.ACCESS_READ)
+
+
+class starDataBlock(object):
+
+    '''Describes where one data_ block is in a mapped starfile: its header
+    lines, column names and the byte range of its loop data'''
+
+    def __init__(self, name, start, end):
+        self.name = name
+        self.start = start
+        self.end = end
+        self.is_loop = False
+        self.header_lines = []
+        self.column_names = []
+        self.columns_end = start
+        self.body_start = end
+        self.body_end = end
+
+    def parseHeader(self, buffer):
+
+        '''Reads the header lines of the block up to the start of the loop data'''
+
+        position = self.start
+
+        while position < self.end:
+            line_end = buffer.find(b'\n', position, self.end)
+            if line_end == -1:
+                line_end = self.end
+            line = buffer[position:line_end].strip().decode(errors = 'replace')
+
+            if line.startswith('data_') or line.startswith('#') or len(line) == 0:
+                pass
+            elif line == 'loop_':
+                self.is_loop = True
+            elif line.startswith('_'):
+                self.column_names.append(line.split()[0][1:])
+                self.columns_end = min(line_end + 1, self.end)
+            else:
+                break
+
+            self.header_lines.append(line)
+            position = line_end + 1
+
+        self.body_start = min(position, self.end)
+
+        #Comments and blank lines at the end of the block aren't loop data
+        position = self.end
+        while position > self.body_start:
+            line_start = max(buffer.rfind(b'\n', self.body_start, position - 1) + 1, self.body_start)
+            line = buffer[line_start:position].strip()
+            if len(line) != 0 and not line.startswith(b'#'):
+                break
+            position = line_start
+
+        self.body_end = position
+
+    def readTable(self, buffer, range_size = DEFAULT_RANGE_SIZE, text_source = None, usecols = None, workers = None):
+
+        '''Tokenizes the loop data of the block into a starDataTable'''
+
+        return readTableFromByteRange(buffer, self.body_start, self.body_end, self.column_names, range_size, text_source, usecols, workers)
+
+    def getTextSource(self, filename):
+        return starTextSource(filename, self.column_names, self.body_start, self.columns_end, self.body_end)
+
+
+class starTextSource(object):
+
+    '''Records where the particle loop of a starfile is, so tables read from it
+    can hand their original text to star_writer. The file is mapped again when
+    the text is needed and is only used if it is unchanged since it was read'''
+
+    def __init__(self, filename, column_names, header_end, columns_end, body_end, file_size = None, file_mtime_ns = None):
+        self.filename = os.path.abspath(filename)
+        self.column_names = list(column_names)
+        self.column_set = set(self.column_names)
+        self.header_end = header_end
+        self.columns_end = columns_end
+        self.body_end = body_end
+
+        if file_size is None:
+            file_stats = os.stat(self.filename)
+            file_size, file_mtime_ns = file_stats.st_size, file_stats.st_mtime_ns
+
+        self.file_size = file_size
+        self.file_mtime_ns = file_mtime_ns
+        self._buffer = None
+
+    def toDict(self):
+        return {'filename':self.filename, 'column_names':self.column_names, 'header_end':self.header_end, 'columns_end':self.columns_end,
+                'body_end':self.body_end, 'file_size':self.file_size, 'file_mtime_ns':self.file_mtime_ns}
+
+    @classmethod
+    def fromDict(cls, source_info):
+        return cls(**source_info)
+
+    def isUnchanged(self):
+        try:
+            file_stats = os.stat(self.filename)
+        except OSError:
+            return False
+        return file_stats.st_size == self.file_size and file_stats.st_mtime_ns == self.file_mtime_ns
+
+    def getBuffer(self):
+        if self._buffer is None:
+            self._buffer = mapStarFile(self.filename)
+        return self._buffer
+
+    def getFooter(self):
+
+        '''Returns whatever follows the last line of loop data - usually just
+        blank lines, but possibly other data blocks'''
+
+        buffer = self.getBuffer()
+        data_end = self.body_end
+
+        #Step back over the trailing whitespace a window at a time
+        while data_end > self.header_end:
+            window_start = max(data_end - 4096, self.header_end)
+            non_space = np.flatnonzero(np.frombuffer(buffer, dtype = np.uint8, count = data_end - window_start, offset = window_start) > 32)
+            if len(non_space) > 0:
+                data_end = window_start + int(non_space[-1]) + 1
+                break
+            data_end = window_start
+
+        line_end = buffer.find(b'\n', data_end, self.body_end)
+        data_end = self.body_end if line_end == -1 else line_end + 1
+
+        return buffer[data_end:]
+
+
+def findDataBlocks(buffer):
+
+    '''Finds every data_ block in a mapped starfile and parses its header.
+    Only lines consisting of a single data_ word start a block, so a data_ inside
+    a file path can't be mistaken for one'''
+
+    block_starts = []
+    candidates = [0] if buffer[:5] == b'data_' else []
+
+    position = buffer.find(b'\ndata_')
+    while position != -1:
+        candidates.append(position + 1)
+        position = buffer.find(b'\ndata_', position + 1)
+
+    for position in candidates:
+        line_end = buffer.find(b'\n', position)
+        if line_end == -1:
+            line_end = len(buffer)
+        line = buffer[position:line_end].split()
+        if len(line) == 1:
+            block_starts.append((line[0][5:].decode(), position))
+
+    blocks = []
+    for i, (name, start) in enumerate(block_starts):
+        end = block_starts[i + 1][1] if i + 1 < len(block_starts) else len(buffer)
+        block = starDataBlock(name, start, end)
+        block.parseHeader(buffer)
+        blocks.append(block)
+
+    return blocks
+
+def findParticleBlock(blocks):
+
+    '''Returns the block with the particle data - data_particles or, for older
+    starfiles without an optics block, the last loop block'''
+
+    for block in blocks:
+        if block.name == 'particles':
+            return block
+
+    loop_blocks = [block for block in blocks if block.is_loop and block.name != 'optics']
+    if len(loop_blocks) == 0:
+        raise ValueError('No particle data could be found in the starfile')
+
+    return loop_blocks[-1]
+
+def splitByteRange(buffer, start, end, range_size = DEFAULT_RANGE_SIZE):
+
+    '''Splits a byte range into pieces of about range_size bytes that each end
+    on a newline, so no row is split between two pieces'''
+
+    byte_ranges = []
+    position = start
+
+    while position < end:
+        split_position = end
+        if position + range_size < end:
+            newline = buffer.find(b'\n', position + range_size, end)
+            if newline != -1:
+                split_position = newline + 1
+        byte_ranges.append((position, split_position))
+        position = split_position
+
+    return byte_ranges
+
+def findTokens(body):
+
+    '''Returns the start and end position of every whitespace separated token
+    in an array of bytes - any byte up to and including space is whitespace'''
+
+    is_token = body > 32
+
+    token_starts = np.flatnonzero(is_token[1:] > is_token[:-1]) + 1
+    token_ends = np.flatnonzero(is_token[:-1] > is_token[1:]) + 1
+
+    if len(body) > 0 and is_token[0]:
+        token_starts = np.concatenate(([0], token_starts))
+    if len(body) > 0 and is_token[-1]:
+        token_ends = np.concatenate((token_ends, [len(body)]))
+
+    return token_starts, token_ends
+
+def gatherTokens(padded_body, token_starts, token_lengths):
+
+    '''Copies tokens out of the (zero padded) body into a fixed width byte
+    string array without making a python object for each token'''
+
+    if len(token_starts) == 0:
+        return np.array([], dtype = 'S1')
+
+    width = max(int(token_lengths.max()), 1)
+
+    #A byte string view of the body starting at every byte, so indexing it with
+    #the token starts copies width bytes per token in one go
+    windows = np.ndarray(shape = (len(padded_body) - width + 1,), dtype = 'S%i' % width, buffer = padded_body, strides = (1,))
+    tokens = windows[token_starts]
+
+    #Blank out whatever follows each token (not needed for fixed width columns)
+    if (token_lengths != width).any():
+        characters = tokens.view(np.uint8).reshape(len(tokens), width)
+        np.multiply(characters, np.arange(width) < token_lengths[:,None], out = characters, casting = 'unsafe')
+
+    return tokens
+
+def gatherText(buffer, starts, lengths):
+
+    '''Copies byte ranges of a buffer into a fixed width byte string array,
+    like gatherTokens but without needing the buffer to be padded'''
+
+    body = np.frombuffer(buffer, dtype = np.uint8)
+    width = max(int(lengths.max()), 1) if len(lengths) > 0 else 1
+    text = np.zeros(len(starts), dtype = 'S%i' % width)
+
+    #Ranges too close to the end of the buffer are copied from a padded tail
+    near_end = starts + width > len(body)
+    if near_end.any():
+        tail_start = int(starts[near_end].min())
+        padded_tail = np.concatenate((body[tail_start:], np.zeros(width, dtype = np.uint8)))
+        text[near_end] = gatherTokens(padded_tail, starts[near_end] - tail_start, lengths[near_end])
+
+    if not near_end.all():
+        text[~near_end] = gatherTokens(body, starts[~near_end], lengths[~near_end])
+
+    return text
+
+def tokenizeByteRange(buffer, start, end, column_names, usecols = None, text_columns = ()):
+
+    '''Tokenizes the loop data between two byte positions into a dictionary of
+    typed columns - returns (columns, number_of_rows, row_starts, row_ends) with
+    the byte range of each row's line in the buffer
+
+    If usecols is given only those columns are converted, the others are just
+    skipped over. Columns in text_columns are kept as text whatever they hold'''
+
+    number_of_columns = len(column_names)
+    body = np.frombuffer(buffer, dtype = np.uint8, count = end - start, offset = start)
+
+    token_starts, token_ends = findTokens(body)
+
+    if len(token_starts) % number_of_columns != 0:
+        raise ValueError('The number of data values does not match the number of headers in the star file')
+
+    #Every line with data on it should have exactly one value per header - true
+    #if the first and last value of every row are on the same line and each row
+    #is on a later line than the one before
+    number_of_rows = len(token_starts) // number_of_columns
+    newlines = np.flatnonzero(body == 10)
+    row_lines = np.searchsorted(newlines, token_starts[::number_of_columns])
+    row_last_lines = np.searchsorted(newlines, token_starts[number_of_columns - 1::number_of_columns])
+
+    if (row_lines != row_last_lines).any() or (np.diff(row_lines) <= 0).any():
+        tokens_per_line = np.bincount(np.searchsorted(newlines, token_starts))
+        bad_line = np.flatnonzero((tokens_per_line > 0) & (tokens_per_line != number_of_columns))[0]
+        raise ValueError('Data line %i has %i values but there are %i headers in the star file' % (bad_line + 1, tokens_per_line[bad_line], number_of_columns))
+
+    line_bounds = np.concatenate(([-1], newlines, [len(body)]))
+    row_starts = start + line_bounds[row_lines] + 1
+    row_ends = start + line_bounds[row_lines + 1]
+
+    token_starts = token_starts.reshape(number_of_rows, number_of_columns)
+    token_lengths = token_ends.reshape(number_of_rows, number_of_columns) - token_starts
+
+    max_length = int(token_lengths.max()) if number_of_rows > 0 else 1
+    padded_body = np.concatenate((body, np.zeros(max_length, dtype = np.uint8)))
+
+    columns = {}
+    for i, name in enumerate(column_names):
+        if name in text_columns:
+            columns[name] = gatherTokens(padded_body, token_starts[:,i], token_lengths[:,i])
+        elif usecols is None or name in usecols:
+            columns[name] = star_table.tokensToColumn(gatherTokens(padded_body, token_starts[:,i], token_lengths[:,i]))
+
+    return columns, number_of_rows, row_starts, row_ends
+
+def _tokenizeFileRange(filename, start, end, column_names, usecols):
+
+    '''Tokenizes a byte range in a worker process, which maps the file itself'''
+
+    return tokenizeByteRange(mapStarFile(filename), start, end, column_names, usecols)
+
+def readTableFromByteRange(buffer, start, end, column_names, range_size = DEFAULT_RANGE_SIZE, text_source = None, usecols = None, workers = None):
+
+    '''Tokenizes loop data into a starDataTable, working through the byte range
+    in newline aligned pieces to bound the temporary memory use. If a text
+    source is given the table keeps the byte range of each row
+
+    With usecols only those columns are loaded - the text source is then needed
+    to write the other columns back out
+
+    With more than one worker the pieces are tokenized in a process pool (each
+    process maps the text source's file) and joined back together in order'''
+
+    if usecols is not None and text_source is None:
+        raise ValueError('Only loading some of the columns needs a text source for the other columns')
+
+    if workers is None:
+        workers = DEFAULT_WORKERS
+
+    table_columns = [name for name in column_names if usecols is None or name in usecols]
+
+    if workers > 1 and text_source is not None:
+        #Several pieces per worker keeps the processes evenly loaded
+        range_size = min(range_size, max(MIN_PARALLEL_RANGE_SIZE, (end - start) // (workers * 4) + 1))
+    byte_ranges = splitByteRange(buffer, start, end, range_size)
+
+    if workers > 1 and text_source is not None and len(byte_ranges) > 1:
+        range_starts, range_ends = zip(*byte_ranges)
+        with concurrent.futures.ProcessPoolExecutor(max_workers = min(workers, len(byte_ranges))) as pool:
+            range_results = list(pool.map(_tokenizeFileRange, itertools.repeat(text_source.filename), range_starts, range_ends,
+                                          itertools.repeat(column_names), itertools.repeat(usecols)))
+    else:
+        range_results = [tokenizeByteRange(buffer, range_start, range_end, column_names, usecols) for range_start, range_end in byte_ranges]
+
+    #Each piece works out its own column types. A column that is text in one
+    #piece but looked like numbers in another is read again as text in those
+    #pieces, so the table is the same however the body was split up
+    range_results = [(byte_range, result) for byte_range, result in zip(byte_ranges, range_results) if result[1] > 0]
+    text_columns = [name for name in table_columns if any(star_table.columnIsString(result[0][name]) for byte_range, result in range_results)]
+
+    tables = []
+    for (range_start, range_end), (columns, number_of_rows, row_starts, row_ends) in range_results:
+        numeric_columns = [name for name in text_columns if not star_table.columnIsString(columns[name])]
+        if len(numeric_columns) > 0:
+            columns.update(tokenizeByteRange(buffer, range_start, range_end, column_names, numeric_columns, numeric_columns)[0])
+
+        if text_source is None:
+            tables.append(star_table.starDataTable(table_columns, columns))
+        else:
+            tables.append(star_table.starDataTable(table_columns, columns, text_source, row_starts, row_ends))
+
+    if len(tables) == 0:
+        table = star_table.starDataTable.fromDataLines(table_columns, [])
+        if text_source is not None:
+            table.text_source = text_source
+            table.row_starts = np.zeros(0, dtype = np.int64)
+            table.row_ends = np.zeros(0, dtype = np.int64)
+        return table
+    elif len(tables) == 1:
+        return tables[0]
+
+    return star_table.concatenateTables(tables)
@@ -0,0 +1,268 @@
+import os
+import re
+
+import numpy as np
+
+from filtools import perf_report, star_table, star_tokenizer
+
+#Rows are formatted and written in blocks of this many rows
+DEFAULT_WRITE_ROWS = 100000
+
+
+def writeStarHeader(write_star, star_comments, optics_info, column_names):
+
+    '''Writes the optics block and the particle loop headers into an open
+    (binary) file'''
+
+    star_comment = star_comments[0] if len(star_comments) > 0 else '# version 30001'
+    header = ''
+
+    if len(optics_info) > 0:
+        header += '\n' + star_comment + '\n\n'
+        for i in optics_info:
+            header += i + '\n'
+        header += '\n'
+
+    header += '\n ' + star_comment + ' \n\ndata_particles\n\nloop_\n'
+
+    for number, column_name in enumerate(column_names):
+        header += '_%s #%i\n' % (column_name, number + 1)
+
+    write_star.write(header.encode())
+
+def usableTextSource(text_source, output_filename = None):
+
+    '''Returns the text source if its original text can still be used - the
+    file must be unchanged since it was read and must not be the file that is
+    about to be overwritten'''
+
+    if text_source is None or not text_source.isUnchanged():
+        return None
+    if output_filename is not None and os.path.abspath(output_filename) == text_source.filename:
+        return None
+
+    return text_source
+
+def outputColumnNames(table, text_source):
+
+    '''Returns the columns that will be written out. With a text source that's
+    all the columns of the original file (loaded or not), in their original
+    order, followed by any new columns'''
+
+    if text_source is None:
+        return table.column_names
+
+    return text_source.column_names + [name for name in table.column_names if name not in text_source.column_set]
+
+def sourceHeader(text_source, column_names):
+
+    '''Returns the original header text of the file with lines added for any new
+    columns, or None if the columns no longer line up with the original ones'''
+
+    if text_source is None or column_names[:len(text_source.column_names)] != text_source.column_names:
+        return None
+
+    buffer = text_source.getBuffer()
+    new_columns = ''.join('_%s #%i\n' % (name, number + 1) for number, name in enumerate(column_names) if number >= len(text_source.column_names))
+
+    return buffer[:text_source.columns_end] + new_columns.encode() + buffer[text_source.columns_end:text_source.header_end]
+
+def _integerDigits(cells, first_position, number_of_digits, values):
+
+    '''Writes the decimal digits of non-negative integers right aligned into
+    columns of a uint8 cell array'''
+
+    for i in range(number_of_digits):
+        values, digits = np.divmod(values, 10)
+        cells[:,first_position + number_of_digits - 1 - i] = digits + 48
+
+def formatIntegerCells(column):
+
+    '''Formats an integer column as null padded text cells (see joinCells)'''
+
+    magnitudes = np.abs(column.astype(np.int64))
+    number_of_digits = len(str(int(magnitudes.max()))) if len(column) > 0 else 1
+
+    cells = np.zeros((len(column), number_of_digits + 1), dtype = np.uint8)
+    cells[:,0] = np.where(column < 0, 45, 0)
+    _integerDigits(cells, 1, number_of_digits, magnitudes)
+
+    #Blank out the leading zeros but keep the last digit
+    leading_zeros = np.cumprod(cells[:,1:number_of_digits] == 48, axis = 1).astype(bool)
+    cells[:,1:number_of_digits][leading_zeros] = 0
+
+    return cells.view('S%i' % cells.shape[1]).ravel()
+
+def formatFloatCells(column, float_format = '%.6f'):
+
+    '''Formats a float column as null padded text cells (see joinCells)
+
+    Fixed point formats are built with integer arithmetic, which is several
+    times faster than printf style formatting. Values that are not finite, too
+    big, or lie too close to a rounding boundary are formatted with printf so
+    the text is the same either way'''
+
+    fixed_point = re.match(r'^%\.(\d+)f$', float_format)
+    if fixed_point is None or len(column) == 0:
+        return star_table.columnToText(column, float_format)
+
+    decimal_places = int(fixed_point.group(1))
+    with np.errstate(over = 'ignore', invalid = 'ignore'):
+        scaled = np.abs(column) * 10**decimal_places
+    use_printf = ~np.isfinite(scaled) | (scaled >= 2**53)
+    scaled[use_printf] = 0
+    use_printf |= np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6 + scaled * 1e-15
+
+    rounded = np.round(scaled).astype(np.int64)
+    number_of_digits = len(str(int(rounded.max()) // 10**decimal_places))
+    point = 1 + number_of_digits
+
+    cells = np.zeros((len(column), point + 1 + decimal_places), dtype = np.uint8)
+    cells[:,0] = np.where(np.signbit(column), 45, 0)
+    _integerDigits(cells, point + 1, decimal_places, rounded % 10**decimal_places)
+    _integerDigits(cells, 1, number_of_digits, rounded // 10**decimal_places)
+    if decimal_places > 0:
+        cells[:,point] = 46
+
+    leading_zeros = np.cumprod(cells[:,1:point - 1] == 48, axis = 1).astype(bool)
+    cells[:,1:point - 1][leading_zeros] = 0
+
+    if use_printf.any():
+        printf_text = np.char.mod(float_format.encode(), column[use_printf])
+        if printf_text.dtype.itemsize > cells.shape[1]:
+            cells = np.pad(cells, ((0, 0), (0, printf_text.dtype.itemsize - cells.shape[1])))
+        cells[use_printf] = 0
+        cells[use_printf,:printf_text.dtype.itemsize] = printf_text.view(np.uint8).reshape(len(printf_text), -1)
+
+    return cells.view('S%i' % cells.shape[1]).ravel()
+
+def formatColumnCells(column, float_format = '%.6f'):
+    if column.dtype.kind == 'S':
+        return column
+    elif column.dtype.kind == 'f':
+        return formatFloatCells(column, float_format)
+    return formatIntegerCells(column)
+
+def joinCells(cells, separator = b'\t', line_end = b'\n'):
+
+    '''Joins columns of text cells into star file rows, each cell followed by
+    the separator. Cells are laid out side by side in one byte array and the
+    null padding is then squeezed out in a single pass, so no python string is
+    made for any row or cell'''
+
+    number_of_rows = len(cells[0])
+    if number_of_rows == 0:
+        return b''
+
+    row_width = sum(cell.dtype.itemsize + len(separator) for cell in cells) + len(line_end)
+    rows = np.zeros((number_of_rows, row_width), dtype = np.uint8)
+
+    position = 0
+    for cell in cells:
+        width = cell.dtype.itemsize
+        rows[:,position:position + width] = np.ascontiguousarray(cell).view(np.uint8).reshape(number_of_rows, width)
+        position += width
+        for character in separator:
+            rows[:,position] = character
+            position += 1
+
+    for character in line_end:
+        rows[:,position] = character
+        position += 1
+
+    return rows[rows != 0].tobytes()
+
+def _splitLines(lines, number_of_columns):
+
+    '''Finds the cells of the original lines again. Returns the lines as one
+    byte array (with a byte of padding keeping the lines apart) and the start
+    and length of every cell in it'''
+
+    number_of_rows = len(lines)
+    line_width = lines.dtype.itemsize + 1
+    line_bytes = np.zeros((number_of_rows + 1, line_width), dtype = np.uint8)
+    line_bytes[:-1,:-1] = lines.view(np.uint8).reshape(number_of_rows, -1)
+    line_bytes = line_bytes.ravel()
+
+    token_starts, token_ends = star_tokenizer.findTokens(line_bytes)
+    token_starts = token_starts.reshape(number_of_rows, number_of_columns)
+    token_lengths = token_ends.reshape(number_of_rows, number_of_columns) - token_starts
+
+    return line_bytes, token_starts, token_lengths
+
+def formatRows(table, float_format = '%.6f', text_source = None, rows = slice(None)):
+
+    '''Returns the text of some rows of the table. Without a text source every
+    cell is formatted. Otherwise the original lines are copied and only the
+    cells of changed columns are replaced, keeping the original spacing, and
+    any new columns are added to the end of the lines'''
+
+    column_names = outputColumnNames(table, text_source)
+
+    if text_source is None:
+        return joinCells([formatColumnCells(table.getColumn(name)[rows], float_format) for name in column_names])
+
+    row_starts = table.row_starts[rows]
+    line_lengths = table.row_ends[rows] - row_starts
+    lines = star_tokenizer.gatherText(text_source.getBuffer(), row_starts, line_lengths)
+    number_of_source_columns = len(text_source.column_names)
+
+    modified = [i for i, name in enumerate(text_source.column_names) if name in table.modified_columns and name in table.columns]
+
+    if len(modified) == 0:
+        pieces = [lines]
+    else:
+        #Copy the text between the changed cells and splice in the new values
+        line_bytes, token_starts, token_lengths = _splitLines(lines, number_of_source_columns)
+        line_offsets = np.arange(len(lines), dtype = np.int64) * (lines.dtype.itemsize + 1)
+        pieces = []
+        text_start = line_offsets
+        for i in modified:
+            pieces.append(star_tokenizer.gatherTokens(line_bytes, text_start, token_starts[:,i] - text_start))
+            pieces.append(formatColumnCells(table.getColumn(text_source.column_names[i])[rows], float_format))
+            text_start = token_starts[:,i] + token_lengths[:,i]
+        pieces.append(star_tokenizer.gatherTokens(line_bytes, text_start, line_offsets + line_lengths - text_start))
+
+    if len(column_names) > number_of_source_columns:
+        #New columns go on the end, after a tab if the line doesn't already end in whitespace
+        line_characters = lines.view(np.uint8).reshape(len(lines), -1)
+        ends_in_space = line_characters[np.arange(len(lines)), np.maximum(line_lengths - 1, 0)] <= 32
+        pieces.append(np.where(ends_in_space, b'', b'\t').astype('S1'))
+        for name in column_names[number_of_source_columns:]:
+            pieces.append(formatColumnCells(table.getColumn(name)[rows], float_format))
+            pieces.append(np.full(len(lines), b'\t', dtype = 'S1'))
+
+    return joinCells(pieces, separator = b'', line_end = b'\n')
+
+def writeRows(write_star, table, float_format = '%.6f', text_source = None, rows_per_write = DEFAULT_WRITE_ROWS):
+
+    '''Writes the rows of a table into an open binary file a block at a time'''
+
+    for start in range(0, table.number_of_rows, rows_per_write):
+        write_star.write(formatRows(table, float_format, text_source, slice(start, start + rows_per_write)))
+
+def writeStarFile(filename, star_comments, optics_info, table, float_format = '%.6f'):
+
+    '''Writes a table as a starfile. If the table was read from a file that is
+    still unchanged, its header and any untouched text is copied over as it
+    was, so reading and writing a file without changes reproduces it exactly.
+    Columns that were changed are formatted with float_format'''
+
+    with perf_report.timeStage('write', particles = table.number_of_rows):
+        text_source = usableTextSource(table.text_source if table.hasTextSource() else None, filename)
+        if text_source is None and len(table.getPassthroughColumns()) > 0:
+            raise ValueError('%s has changed since it was read, so the columns that were not loaded can not be copied from it' % table.text_source.filename)
+
+        header = sourceHeader(text_source, outputColumnNames(table, text_source))
+
+        with open(filename, 'wb') as write_star:
+
+            if header is None:
+                writeStarHeader(write_star, star_comments, optics_info, table.column_names)
+            else:
+                write_star.write(header)
+
+            writeRows(write_star, table, float_format, text_source)
+
+            if header is not None:
+                write_star.write(text_source.getFooter())
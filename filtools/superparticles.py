@@ -11,14 +11,14 @@ def make_superparticles(starfile_path, window_size):
     particles = parse_star.readBlockDataFromStarfile(starfile_path)
 
     #sort the particles based on their rot angle
-    sorted_particles = sorted(list(zip(*particles.particle_data_block)), key = lambda x: float(x[particles.headers['rlnAngleRot']]))
-    particles.particle_data_block = list(zip(*sorted_particles))
+    particles.sortParticlesByColumn('rlnAngleRot')
+    image_names = particles.getStringDataColumn('rlnImageName')
 
     #Need some code to make the folders etc
 
     for particle_num in range(particles.number_of_particles):
 
-        particle_names = particles.particle_data_block[particles.headers['rlnImageName']][particle_num:particle_num+window_size]
+        particle_names = image_names[particle_num:particle_num+window_size]
 
         #Extremely confusing code that just tries to load the newest particle into memory
         try:
@@ -96,9 +96,7 @@ def makeTurningFilamentVideo(starfile_path, frame_rate, video_length):
 
     particles = parse_star.readBlockDataFromStarfile(starfile_path)
     video_filename = starfile_path[:-5] + 'turningvid.mrcs'
-    sorted_particles = sorted(list(zip(*particles.particle_data_block)), key = lambda x: float(x[particles.headers['rlnAngleRot']]))
-    particles.particles = sorted_particles
-    particles.particle_data_block = list(zip(*sorted_particles))
+    particles.sortParticlesByColumn('rlnAngleRot')
 
     particle_name_list = particles.getStringDataColumn('rlnImageName')
 
@@ -1,55 +1,125 @@
 import numpy as np
 from math import isnan
 
-from filtools import parse_star
+from filtools import filament_pool, fit_checkpoint, parse_star, segment_reductions, spatial_duplicates, star_join, star_stream
+from utils import circular
 from utils.plotfit import *
 
+#Columns copied by updateAlignments and updateCTF
+ALIGNMENT_COLUMNS = ['rlnAngleRot', 'rlnAnglePsi', 'rlnAngleTilt', 'rlnOriginXAngst', 'rlnOriginYAngst']
+CTF_COLUMNS = ['rlnDefocusU', 'rlnDefocusV', 'rlnDefocusAngle', 'rlnCtfBfactor', 'rlnCtfScalefactor']
+
+#The columns each command reads - everything else is copied straight from the
+#input file when the result is written. None means the command needs them all
+COMMAND_COLUMNS = {
+    'unify_tilt':['rlnAngleTilt'],
+    'reset_tilt':['rlnAngleTilt'],
+    'unify_rot':['rlnAngleRot', 'rlnMaxValueProbDistribution'],
+    'unifyXY':['rlnOriginXAngst', 'rlnOriginYAngst', 'rlnMaxValueProbDistribution'],
+    'unify_psi':['rlnAnglePsi', 'rlnMaxValueProbDistribution'],
+    'removeShortFils':[],
+    'orderFilaments':[],
+    'removeDuplicates':[],
+    'mergeStarFiles':None,
+    'correctExpandedParticles':None,
+    'updateAlignments':star_join.PARTICLE_KEYS + ALIGNMENT_COLUMNS,
+    'updateCTF':star_join.PARTICLE_KEYS + CTF_COLUMNS,
+    }
+
 def unify_tilt(starfile_path, plot_changes = False, save_changes = True):
     '''
     Super basic function that resets all tilt angles such that they equal the
     median tilt angle
     '''
 
-    filament_data = parse_star.readFilamentsFromStarFile(starfile_path)
+    filament_data = parse_star.readFilamentsFromStarFile(starfile_path, usecols = COMMAND_COLUMNS['unify_tilt'])
+    unifyTiltInObject(filament_data)
+    filament_data.writeFilamentsToStarFile()
 
-    for filament_no in range(filament_data.number_of_filaments):
+def unifyTiltInObject(filament_data):
 
-        original_tilt_angles = filament_data.getNumpyFilamentColumn(filament_no, 'rlnAngleTilt')
-        tilt_median = np.full(len(original_tilt_angles), np.median(original_tilt_angles), dtype = 'float16')
+    '''Sets the tilt angles of each filament in a loaded filament object to
+    their median'''
 
-        filament_data.addFilamentDataColumn(filament_no, tilt_median, 'rlnAngleTilt')
+    filament_offsets = filament_data.filament_offsets
+    tilt_medians = segment_reductions.segmentMedian(filament_data.table.getColumn('rlnAngleTilt'), filament_offsets)
 
-    filament_data.writeFilamentsToStarFile()
+    filament_data.addDataColumn(segment_reductions.expandSegments(tilt_medians.astype('float16'), filament_offsets), 'rlnAngleTilt')
 
 
 def reset_tilt(starfile_path, plot_changes = False, save_changes = True):
     '''
     Function to reset the tilt values for all particles to 90 degrees
-    '''
-
-    filament_data = parse_star.readFilamentsFromStarFile(starfile_path)
 
-    for filament_no in range(filament_data.number_of_filaments):
+    Only one row is needed at a time so the starfile is streamed in chunks
+    '''
 
-        tilt_original = filament_data.getNumpyFilamentColumn(filament_no, 'rlnAngleTilt')
+    def resetChunkTilt(chunk):
+        chunk.setColumn('rlnAngleTilt', np.full(chunk.number_of_rows, 90.0))
+        return chunk
 
-        reset_tilt = np.full(len(tilt_original), 90, dtype = 'float16')
-        filament_data.addFilamentDataColumn(filament_no, reset_tilt, 'rlnAngleTilt')
+    save_file_name = starfile_path[:-5] + '_updatedrlnAngleTilt.star'
+    star_stream.processStarFileInChunks(starfile_path, save_file_name, resetChunkTilt, usecols = COMMAND_COLUMNS['reset_tilt'])
 
     print('The tilt angles for all filaments have been fitted')
-
-    filament_data.writeFilamentsToStarFile()
+    print('New starfile saved as ' + save_file_name)
 
     if plot_changes:
         plot_changes()
 
-def unify_rot(starfile_path, twist, rise = 4.75, apix = 1.05, plot_changes = False):
+def resetTiltInObject(filament_data):
+
+    '''Sets the tilt angles of every particle in a loaded filament object to 90'''
+
+    filament_data.addDataColumn(np.full(filament_data.number_of_particles, 90.0), 'rlnAngleTilt')
+
+def unify_rot(starfile_path, twist, rise = 4.75, apix = 1.05, plot_changes = False, engine = 'search', jobs = 1, chunk_size = filament_pool.DEFAULT_CHUNK_SIZE,
+              checkpoint_interval = fit_checkpoint.DEFAULT_CHECKPOINT_INTERVAL, resume = False):
     '''
     Function that fits the rot angles for all filaments - VERY slow at the moment
+
+    engine picks how the lines are fitted, see unifyRotInObject. With more than
+    one job, batches of chunk_size filaments are fitted in parallel
+
+    The fitted filaments are checkpointed next to the starfile every
+    checkpoint_interval seconds (None turns this off) and resume carries on
+    from a checkpoint of the same starfile and parameters. The checkpoint is
+    removed once the new starfile is saved
     '''
+
+    filament_data = parse_star.readFilamentsFromStarFile(starfile_path, usecols = COMMAND_COLUMNS['unify_rot'])
+
+    checkpoint = None
+    if checkpoint_interval is not None:
+        parameters = {'operation':'unify_rot', 'twist':twist, 'rise':rise, 'apix':apix, 'engine':engine}
+        checkpoint = fit_checkpoint.fitCheckpoint(fit_checkpoint.checkpointPath(starfile_path, 'unify_rot'), lambda: fit_checkpoint.checkpointKey(starfile_path, parameters),
+                                                  filament_data.table.getColumn('rlnAngleRot'), filament_data.number_of_filaments, checkpoint_interval, resume)
+
+    unifyRotInObject(filament_data, twist, rise, apix, engine, jobs, chunk_size, checkpoint)
+    filament_data.writeFilamentsToStarFile()
+
+    if checkpoint is not None:
+        checkpoint.remove()
+
+#Ways of fitting the rot angles of a filament: 'search' is the exhaustive
+#intercept search and gradient grid, 'hough' is the wrap aware Hough
+#accumulator with a coarse-to-fine gradient search (O(n log n) per filament)
+ROT_ENGINES = ['search', 'hough']
+
+def unifyRotInObject(filament_data, twist, rise = 4.75, apix = 1.05, engine = 'search', jobs = 1, chunk_size = filament_pool.DEFAULT_CHUNK_SIZE, checkpoint = None):
+
+    '''Fits the rot angles of every filament in a loaded filament object. The
+    filaments are fitted in batches of chunk_size, in a pool of jobs processes
+    if jobs is more than 1 - the result is the same either way
+
+    checkpoint is an optional fit_checkpoint.fitCheckpoint that the fitted
+    batches are saved to, and that filaments already fitted are taken from'''
+
+    if engine not in ROT_ENGINES:
+        raise ValueError('Unknown rot fitting engine %s, the options are: %s' % (engine, ', '.join(ROT_ENGINES)))
+
     initial_gradient = twist/(rise/apix)
 
-    filament_data = parse_star.readFilamentsFromStarFile(starfile_path)
     #print('Filaments with less than 5 particles will be removed')
     #filament_data.removeShortFilaments(5)
     print('There are %s filaments to process' % filament_data.number_of_filaments)
@@ -58,91 +128,137 @@ def unify_rot(starfile_path, twist, rise = 4.75, apix = 1.05, plot_changes = Fal
 
     #np_lin_reg = np.vectorize(linearRegression, otypes = [float])
 
-    for filament_no in range(filament_data.number_of_filaments):
+    table = filament_data.table
+    columns = {name:table.getColumn(name) for name in ['rlnHelicalTrackLengthAngst', 'rlnAngleRot', 'rlnMaxValueProbDistribution']}
 
-        rot_angles = filament_data.getNumpyFilamentColumn(filament_no, 'rlnAngleRot')
-        rln_score = filament_data.getNumpyFilamentColumn(filament_no, 'rlnMaxValueProbDistribution')
-        tracklength = filament_data.getNumpyFilamentColumn(filament_no, 'rlnHelicalTrackLengthAngst')
-        psi_angles = filament_data.getNumpyFilamentColumn(filament_no, 'rlnAnglePsi')
-        xsh = filament_data.getNumpyFilamentColumn(filament_no, 'rlnOriginXAngst')
-        ysh = filament_data.getNumpyFilamentColumn(filament_no, 'rlnOriginYAngst')
+    adjusted_rot_angles = filament_pool.mapFilamentChunks(fitRotChunk, columns, filament_data.filament_offsets, table.getColumn('rlnAngleRot'),
+                                                          (initial_gradient, m_list, engine), jobs, chunk_size, 'Tube %s completed', checkpoint)
 
-        #This makes everything take ages but is necessary
-        number_of_particles = len(ysh)
-        search_limit = number_of_particles*(tracklength[1]*0.1*2)
+    filament_data.addDataColumn(adjusted_rot_angles, 'rlnAngleRot')
 
-        #find the best linear plot with a gradient of 4 by changing the y-intercept
-        search_limit = number_of_particles*(tracklength[1]*0.1*2)
-        y_intercepts = np.arange((-180 - search_limit),(180 + search_limit),0.1)
-        #Exhaustive search for gradient 4 and -4:
-        pos_m4_search = exhaustiveLinearSearch(initial_gradient, y_intercepts, tracklength, rot_angles, rln_score, 4)
-        neg_m4_search = exhaustiveLinearSearch(-initial_gradient, y_intercepts, tracklength, rot_angles, rln_score, 4)
+def fitRotChunk(columns, filament_offsets, initial_gradient, m_list, engine):
 
-        top_scored_plots = np.concatenate((pos_m4_search[-20:], neg_m4_search[-20:]))
-        top_y_intercepts = np.hsplit(top_scored_plots,2)[0]
+    '''Fits the rot angles of a batch of filaments, returning the adjusted rot
+    angles of all their particles (see filament_pool.mapFilamentChunks)'''
 
-        best_plot = optimiseLinearGradient(m_list,top_y_intercepts, tracklength, rot_angles, rln_score, 4)
+    adjusted_rot_angles = np.array(columns['rlnAngleRot'], dtype = np.float64)
+
+    #A line can't be fitted through a single particle
+    fitted_filaments = np.flatnonzero(np.diff(filament_offsets) >= 2)
+    filament_rows = [slice(filament_offsets[i], filament_offsets[i + 1]) for i in fitted_filaments]
+    tracklengths = [columns['rlnHelicalTrackLengthAngst'][rows] for rows in filament_rows]
+    rot_angle_list = [columns['rlnAngleRot'][rows] for rows in filament_rows]
+    rln_scores = [columns['rlnMaxValueProbDistribution'][rows] for rows in filament_rows]
+
+    if engine == 'hough':
+        best_plots = houghRotFit((m_list[0], m_list[-1]), tracklengths, rot_angle_list, rln_scores, 4)
+    else:
+        #Find the best intercepts for each filament, then refine the gradients of
+        #all the filaments together in batches
+        top_y_intercept_list = []
+
+        for tracklength, rot_angles, rln_score in zip(tracklengths, rot_angle_list, rln_scores):
+
+            #find the best linear plot with a gradient of 4 by changing the y-intercept
+            number_of_particles = len(tracklength)
+            search_limit = number_of_particles*(tracklength[1]*0.1*2)
+            y_intercepts = np.arange((-180 - search_limit),(180 + search_limit),0.1)
+            #Exhaustive search for gradient 4 and -4:
+            pos_m4_search = exhaustiveLinearSearch(initial_gradient, y_intercepts, tracklength, rot_angles, rln_score, 4)
+            neg_m4_search = exhaustiveLinearSearch(-initial_gradient, y_intercepts, tracklength, rot_angles, rln_score, 4)
+
+            top_scored_plots = np.concatenate((pos_m4_search[-20:], neg_m4_search[-20:]))
+            top_y_intercept_list.append(np.hsplit(top_scored_plots,2)[0])
+
+        best_plots = optimiseLinearGradientBatch(m_list, top_y_intercept_list, tracklengths, rot_angle_list, rln_scores, 4)
+
+    for rows, best_plot, tracklength, rot_angles in zip(filament_rows, best_plots, tracklengths, rot_angle_list):
 
         best_gradient = best_plot[0]
         y_intercept = best_plot[1]
 
         line_of_best_fit = linRegress(tracklength,y_intercept,best_gradient)
 
-        adjusted_rot_angles = adjustAngletoLOBF(line_of_best_fit, rot_angles, 4)
+        adjusted_rot_angles[rows] = circular.snapToLine(rot_angles, line_of_best_fit, 4)
 
-        filament_data.addFilamentDataColumn(filament_no, adjusted_rot_angles, 'rlnAngleRot')
+    return adjusted_rot_angles
 
-        if filament_no % 100 == 0:
-            print('Tube %s completed' % (filament_no))
+def unifyXY(starfile_path, plot_changes = False, degree = 2, weighted = True, outlier_threshold = None):
+    '''
+    Fits the x and y shifts of each filament with a polynomial of the helical
+    track length, see unifyXYInObject
+    '''
 
+    filament_data = parse_star.readFilamentsFromStarFile(starfile_path, usecols = COMMAND_COLUMNS['unifyXY'])
+    unifyXYInObject(filament_data, degree, weighted, outlier_threshold)
     filament_data.writeFilamentsToStarFile()
 
-def unifyXY(starfile_path, plot_changes = False, rot_outliers = []):
-    '''
-    Fairly basic function to fit the x and y shifts using a polynomial
+def unifyXYInObject(filament_data, degree = 2, weighted = True, outlier_threshold = None):
 
-    Need to implement selective changes i.e. only changing particles that are
-    outliers
-    '''
+    '''Smooths the x and y shifts of every filament in a loaded filament object
+    with a least squares polynomial of the helical track length, fitted for all
+    the filaments at once
 
-    filament_data = parse_star.readFilamentsFromStarFile(starfile_path)
+    The fit is weighted by rlnMaxValueProbDistribution if weighted is set. If
+    outlier_threshold is given only the shifts further than that (in Angstrom)
+    from the fit are replaced, otherwise all of them are'''
 
-    for filament_no in range(filament_data.number_of_filaments):
+    table = filament_data.table
+    filament_offsets = filament_data.filament_offsets
+    tracklength = table.getColumn('rlnHelicalTrackLengthAngst')
+    weights = table.getColumn('rlnMaxValueProbDistribution') if weighted else None
 
-        xsh = filament_data.getNumpyFilamentColumn(filament_no, 'rlnOriginXAngst')
-        ysh = filament_data.getNumpyFilamentColumn(filament_no, 'rlnOriginYAngst')
-        tracklength = filament_data.getNumpyFilamentColumn(filament_no, 'rlnHelicalTrackLengthAngst')
+    for shift_column in ['rlnOriginXAngst', 'rlnOriginYAngst']:
+        shifts = table.getColumn(shift_column)
+        fitted_shifts = fitSegmentPolynomials(tracklength, shifts, filament_offsets, degree, weights)
 
-        if len(rot_outliers) > 1:
-            #Do the selective changes
-            pass
-        else:
-            uniX, uniY = fitPolynomial(Xsh,Ysh,xax)
+        #Filaments that couldn't be fitted keep their shifts
+        replace = ~np.isnan(fitted_shifts)
+        if outlier_threshold is not None:
+            replace &= np.abs(shifts - fitted_shifts) > outlier_threshold
 
-        #Checks if the "flatten and cluster" function failed - in which case the shifts are all 'nan'
-        if math.isnan(uniX[1]):
-            uniX = Xsh
-        if math.isnan(uniY[1]):
-            uniY = Ysh
+        print('%i of the %s values were replaced by the fitted values' % (np.count_nonzero(replace), shift_column))
+        filament_data.addDataColumn(np.where(replace, fitted_shifts, shifts), shift_column)
 
-        filament_data.addFilamentDataColumn(filament_no, uniX, 'rlnOriginXAngst')
-        filament_data.addFilamentDataColumn(filament_no, uniY, 'rlnOriginYAngst')
+def unify_psi(starfile_path, plot_changes = False, jobs = 1, chunk_size = filament_pool.DEFAULT_CHUNK_SIZE):
 
+    filament_data = parse_star.readFilamentsFromStarFile(starfile_path, usecols = COMMAND_COLUMNS['unify_psi'])
+    unifyPsiInObject(filament_data, jobs, chunk_size)
     filament_data.writeFilamentsToStarFile()
 
+def unifyPsiInObject(filament_data, jobs = 1, chunk_size = filament_pool.DEFAULT_CHUNK_SIZE):
 
-def unify_psi(starfile_path, plot_changes = False):
+    '''Fits the psi angles of every filament in a loaded filament object to a
+    single value per filament, in batches of chunk_size filaments (in a pool of
+    jobs processes if jobs is more than 1)'''
 
-    filament_data = parse_star.readFilamentsFromStarFile(starfile_path)
+    table = filament_data.table
+    columns = {name:table.getColumn(name) for name in ['rlnHelicalTrackLengthAngst', 'rlnAnglePsi', 'rlnMaxValueProbDistribution']}
 
-    for filament_no in range(filament_data.number_of_filaments):
+    unified_psi_angles = filament_pool.mapFilamentChunks(fitPsiChunk, columns, filament_data.filament_offsets, table.getColumn('rlnAnglePsi'), (), jobs, chunk_size)
 
-        psi_original = filament_data.getNumpyFilamentColumn(filament_no, 'rlnAnglePsi')
-        relion_score = filament_data.getNumpyFilamentColumn(filament_no, 'rlnMaxValueProbDistribution')
-        tracklength = filament_data.getNumpyFilamentColumn(filament_no, 'rlnHelicalTrackLengthAngst')
+    filament_data.addDataColumn(unified_psi_angles, 'rlnAnglePsi')
 
-        psi_low_bound = int(sorted(psi_original)[0])
-        psi_high_bound = int(sorted(psi_original)[-1])
+def fitPsiChunk(columns, filament_offsets):
+
+    '''Fits the psi angles of a batch of filaments, returning the new psi
+    angles of all their particles (see filament_pool.mapFilamentChunks)'''
+
+    unified_psi_angles = np.array(columns['rlnAnglePsi'], dtype = np.float64)
+
+    #The search is around the whole degrees below the lowest and highest angles
+    psi_low_bounds = np.trunc(segment_reductions.segmentMin(unified_psi_angles, filament_offsets))
+    psi_high_bounds = np.trunc(segment_reductions.segmentMax(unified_psi_angles, filament_offsets))
+
+    for filament_no in range(len(filament_offsets) - 1):
+
+        rows = slice(filament_offsets[filament_no], filament_offsets[filament_no + 1])
+        psi_original = unified_psi_angles[rows]
+        relion_score = columns['rlnMaxValueProbDistribution'][rows]
+        tracklength = columns['rlnHelicalTrackLengthAngst'][rows]
+
+        psi_low_bound = int(psi_low_bounds[filament_no])
+        psi_high_bound = int(psi_high_bounds[filament_no])
         psi_low_bound_search = np.arange(psi_low_bound - 8, psi_low_bound + 8, 0.5)
         psi_high_bound_search = np.arange(psi_high_bound - 8, psi_high_bound + 8, 0.5)
         y_intercepts = np.concatenate((psi_low_bound_search, psi_high_bound_search))
@@ -152,135 +268,145 @@ def unify_psi(starfile_path, plot_changes = False):
         best_plot = sorted_plots[-1]
         #line_of_best_fit = linRegress(tracklength, np.full(len(tracklength),best_plot[0]),np.full(len(tracklength),0))
         line_of_best_fit = linRegress(tracklength, best_plot[0],0)
-        unified_psi_angles = adjustAngletoLOBF(line_of_best_fit, psi_original, 5)
+        unified_psi_angles[rows] = circular.snapToLine(psi_original, line_of_best_fit, 5)
 
-        filament_data.addFilamentDataColumn(filament_no, unified_psi_angles, 'rlnAnglePsi')
-
-    filament_data.writeFilamentsToStarFile()
+    return unified_psi_angles
 
 def removeShortFilsFromStarfile(starfile_path, minimum_length):
 
+    '''Remove filaments with less than specified number of particles from a
+    starfile and save the rest'''
+
     print('Removing short filaments from %s' % starfile_path)
 
-    filament_data = parse_star.readFilamentsFromStarFile(starfile_path)
+    filament_data = parse_star.readFilamentsFromStarFile(starfile_path, usecols = COMMAND_COLUMNS['removeShortFils'])
+    removeShortFilsFromObject(filament_data, minimum_length)
+    filament_data.writeFilamentsToStarFile(suffix = '_noShortFils')
+
+def removeShortFilsFromObject(filament_object, minimum_length, verbose = True):
 
     '''Remove filaments with less than specified number of particles '''
-    print('There are %i filaments in the input star file' % filament_data.number_of_filaments)
 
-    for fil_no in range(filament_data.number_of_filaments):
-        #This is just to ensure that the starfile name is correctly updated and data structure is maintained
-        filament_data.addFilamentDataColumn(fil_no, filament_data.getNumpyFilamentColumn(fil_no,'rlnAngleRot'), 'noShortFilaments')
+    if verbose:
+        print('There are %i filaments in the input star file' % filament_object.number_of_filaments)
 
-        if len(filament_data.getNumpyFilamentColumn(fil_no, 'rlnAngleRot')) < minimum_length:
-            del filament_data.filaments[fil_no]
+    #This is just to ensure that the starfile name is correctly updated
+    filament_object.new_data_headers['noShortFilaments'] = None
 
-    #remake the filaments dictionary with sequential keys
-    temp_filaments = {}
-    filament_data.number_of_filaments = 0
-    for num, key in enumerate(sorted(filament_data.filaments.keys())):
-        temp_filaments[num] = filament_data.filaments[key]
-        filament_data.number_of_filaments += 1
+    short_filaments = np.flatnonzero(segment_reductions.segmentCounts(filament_object.filament_offsets) < minimum_length)
+    filament_object.removeMultipleFilaments(short_filaments)
 
-    filament_data.filaments = temp_filaments
+    if verbose:
+        print('There are %i filaments in the saved star file' % filament_object.number_of_filaments)
 
-    print('There are %i filaments in the saved star file' % filament_data.number_of_filaments)
 
-    filament_data.writeFilamentsToStarFile(suffix = '_noShortFils')
+def selectParticlesbyAlignmentAngleRange(starfile_path, rln_header_identifier, lower_limit, upper_limit):
 
-def removeShortFilsFromObject(filament_object, minimum_length):
+    '''Selects the particles within the stated range for a given alignment angle.
+    The starfile is streamed in chunks so this runs in bounded memory'''
 
-    '''Remove filaments with less than specified number of particles '''
+    def selectChunk(chunk):
+        return chunk.take(parse_star.angularRangeMask(chunk.getColumn(rln_header_identifier), lower_limit, upper_limit))
 
-    print('There are %i filaments in the input star file' % filament_object.number_of_filaments)
+    save_file_name = starfile_path[:-5] + '_updated' + rln_header_identifier + 'Range' + str(lower_limit) + 'to' + str(upper_limit) + '.star'
+    number_read, number_written = star_stream.processStarFileInChunks(starfile_path, save_file_name, selectChunk, usecols = [rln_header_identifier])
 
-    for fil_no in range(filament_object.number_of_filaments):
-        #This is just to ensure that the starfile name is correctly updated and data structure is maintained
-        filament_object.addFilamentDataColumn(fil_no, filament_object.getNumpyFilamentColumn(fil_no,'rlnAngleRot'), 'noShortFilaments')
+    print('%i of %i particles are within the angular range' % (number_written, number_read))
+    print('New starfile saved as ' + save_file_name)
 
-        if len(filament_object.getNumpyFilamentColumn(fil_no, 'rlnAngleRot')) < minimum_length:
-            del filament_object.filaments[fil_no]
+def orderFilaments(starfile):
+    fil_data = parse_star.readFilamentsFromStarFile(starfile, usecols = COMMAND_COLUMNS['orderFilaments'])
+    fil_data.writeFilamentsToStarFile()
 
-    #remake the filaments dictionary with sequential keys
-    temp_filaments = {}
-    filament_object.number_of_filaments = 0
-    for num, key in enumerate(sorted(filament_object.filaments.keys())):
-        temp_filaments[num] = filament_object.filaments[key]
-        filament_object.number_of_filaments += 1
+def orderFilamentsInObject(fil_data):
 
-    filament_object.filaments = temp_filaments
+    '''Nothing to do - filaments are put in order when they are loaded'''
 
-    if verbose:
-        print('There are %i filaments in the saved star file' % filament_object.number_of_filaments)
+    pass
 
+def duplicateColumns(keep = 'last', distance = None):
 
-def selectParticlesbyAlignmentAngleRange(starfile_path, rln_header_identifier, lower_limit, upper_limit):
+    '''Columns removeDuplicatesFromObject needs on top of the filament ones'''
 
-    particle_data = parse_star.readBlockDataFromStarfile(starfile_path)
+    columns = list(COMMAND_COLUMNS['removeDuplicates'])
+    if keep == 'best' or distance is not None:
+        columns.append('rlnMaxValueProbDistribution')
+    if distance is not None:
+        columns += spatial_duplicates.SPATIAL_COLUMNS + ['rlnImageName']
 
-    particle_data.selectAngularRange(rln_header_identifier, lower_limit, upper_limit)
-    particle_data.writeBlockDatatoStar()
+    return columns
 
-def orderFilaments(starfile):
-    fil_data = parse_star.readFilamentsFromStarFile(starfile)
-    fil_data.writeFilamentsToStarFile()
+def removeDuplicates(starfile, tolerance = 0, keep = 'last', distance = None, apix = 1.05, report_file = None):
 
-def removeDuplicates(starfile):
-
-    fil_data = parse_star.readFilamentsFromStarFile(starfile)
-    starting_particles = fil_data.number_of_particles
-
-    for fil_no in sorted(fil_data.filaments.keys()):
-        fil_data.removeFilamentDuplicateParticles(fil_no)
-
-        '''
-        hel_track_lengths = fil_data.getHelicalTrackLengthList(fil_no)
-        number_of_duplicates = len(hel_track_lengths) - len(set(hel_track_lengths))
-
-        if number_of_duplicates > 0:
-            for duplicate in range(number_of_duplicates):
-                for i, track_length in enumerate(hel_track_lengths):
-                    try:
-                        duplicate_position = hel_track_lengths.index(track_length, i+1)
-                        hel_track_lengths.pop(i)
-                        fil_data.removeParticleData(fil_no, i)
-                        break
-                    except ValueError:
-                        continue
-        '''
-    print('%i duplicate particles were removed from the starfile' % (starting_particles - fil_data.number_of_particles))
+    fil_data = parse_star.readFilamentsFromStarFile(starfile, usecols = duplicateColumns(keep, distance))
+    removeDuplicatesFromObject(fil_data, tolerance, keep, distance, apix, report_file)
     fil_data.writeFilamentsToStarFile(suffix = '_duplicates_removed')
 
-def mergeStarFiles(starfile1, starfile2):
+def removeDuplicatesFromObject(fil_data, tolerance = 0, keep = 'last', distance = None, apix = 1.05, report_file = None):
 
-    starfile1_obj = parse_star.readFilamentsFromStarFile(starfile1)
-    starfile2_obj = parse_star.readFilamentsFromStarFile(starfile2)
+    '''Removes the duplicate particles (track lengths within tolerance of each
+    other) from every filament in a loaded filament object, keeping the 'last',
+    'first' or 'best' scoring one of each set
 
-    combined_number_of_particles = starfile1_obj.number_of_particles + starfile2_obj.number_of_particles
-    combined_number_of_filaments = starfile1_obj.number_of_filaments + starfile2_obj.number_of_filaments
+    If distance is given, particles picked more than once under different
+    filaments or tube IDs are also removed: particles of different filaments
+    whose centres are within distance pixels (at apix) on the same micrograph
+    form a cluster and only the best scoring one is kept. The clusters are saved as JSON to
+    report_file if it's given'''
 
-    print('There are %i number of particles in %i filaments from starfile %s' % (starfile1_obj.number_of_particles, starfile1_obj.number_of_filaments, starfile1))
-    print('There are %i number of particles in %i filaments from starfile %s' % (starfile2_obj.number_of_particles, starfile2_obj.number_of_filaments, starfile2))
+    number_of_duplicates = fil_data.removeDuplicateParticles(tolerance, keep)
+    print('%i duplicate particles were removed from the starfile' % number_of_duplicates)
 
-    for fil_no in range(starfile2_obj.number_of_filaments):
-        starfile1_obj.addNewFilamentFromOtherStar(starfile2_obj, fil_no)
+    if distance is not None:
+        table = fil_data.table
+        cluster_ids = spatial_duplicates.findDuplicateClusters(table, distance, apix)
+        dropped = spatial_duplicates.lowerScoringMembers(cluster_ids, table.getColumn('rlnMaxValueProbDistribution'))
 
-    no_of_particles_before_dupremove = starfile1_obj.number_of_particles
-    for fil_no in sorted(starfile1_obj.filaments.keys()):
-        starfile1_obj.removeFilamentDuplicateParticles(fil_no)
-    no_of_particles_after_dupremove = starfile1_obj.number_of_particles
+        print('%i particles were found within %g pixels of another particle in %i clusters, %i lower scoring particles were removed'
+              % (np.count_nonzero(cluster_ids >= 0), distance, len(np.unique(cluster_ids[cluster_ids >= 0])), np.count_nonzero(dropped)))
+        if report_file is not None:
+            spatial_duplicates.saveClusterReport(report_file, table, cluster_ids, dropped, apix)
 
-    print('There are %i particles from %i filaments in the new starfile' % (starfile1_obj.number_of_particles, starfile1_obj.number_of_filaments))
+        fil_data.removeParticlesByMask(dropped)
+
+def mergeStarFiles(starfiles, duplicate_tolerance = 0, keep_duplicate = 'last', missing_columns = 'error'):
+
+    '''Merges any number of starfiles into the first one. The filaments of the
+    others are renumbered so they never share a tube ID with a filament already
+    on their micrograph. missing_columns is how columns that aren't in every
+    starfile are handled (see parse_star.reconcileColumns)'''
+
+    if len(starfiles) < 2:
+        raise ValueError('At least two starfiles are needed to merge')
+
+    star_objects = [parse_star.readFilamentsFromStarFile(starfile) for starfile in starfiles]
+
+    for starfile, star_object in zip(starfiles, star_objects):
+        print('There are %i number of particles in %i filaments from starfile %s' % (star_object.number_of_particles, star_object.number_of_filaments, starfile))
+
+    merged_star = star_objects[0]
+    merged_star.mergeFilaments(star_objects[1:], missing_columns)
+
+    no_of_particles_before_dupremove = merged_star.number_of_particles
+    merged_star.removeDuplicateParticles(duplicate_tolerance, keep_duplicate)
+    no_of_particles_after_dupremove = merged_star.number_of_particles
+
+    print('There are %i particles from %i filaments in the new starfile' % (merged_star.number_of_particles, merged_star.number_of_filaments))
     if no_of_particles_before_dupremove - no_of_particles_after_dupremove != 0:
         print('%i duplicate particles were removed from the merged starfile' % (no_of_particles_before_dupremove - no_of_particles_after_dupremove))
     else:
         print('No duplicate particles detected in new combined starfile')
 
-    try:
-        starfile_2_job_name = starfile2.split('/')[-2]
-    except IndexError: #directory layout doesn't follow the RELION format
-        starfile_2_job_name = ''
+    if len(starfiles) == 2:
+        try:
+            starfile_2_job_name = starfiles[1].split('/')[-2]
+        except IndexError: #directory layout doesn't follow the RELION format
+            starfile_2_job_name = ''
+        suffix = '_merged' + starfile_2_job_name
+    else:
+        suffix = '_merged%i' % len(starfiles)
 
-    starfile1_obj.writeFilamentsToStarFile(suffix = '_merged' + starfile_2_job_name)
+    merged_star.writeFilamentsToStarFile(suffix = suffix)
 
 def correctExpandedParticles(expanded_starfile, reference_starfile):
 
@@ -295,118 +421,129 @@ def correctExpandedParticles(expanded_starfile, reference_starfile):
     print('There are %i particles from %i filaments in the reference starfile' % (reference_star_object.number_of_particles, reference_star_object.number_of_filaments))
     print('The particles have been expanded by a factor of %i' % (int(expansion_factor)))
 
-    for fil_no in range(expanded_star.number_of_filaments):
-        expanded_star.fixExpansionOneFilament(fil_no, reference_star_object, expansion_factor)
-
-    #remove the remaining non-fixed fils
-    expanded_star.removeMultipleFilaments([i for i in range(reference_star_object.number_of_filaments)])
-    #for fil_no in range(reference_star_object.number_of_filaments):
-    #    expanded_star.removeFilament(fil_no)
+    number_of_unmatched = expanded_star.splitExpandedFilaments(reference_star_object)
+    if number_of_unmatched > 0:
+        print('%i expanded particles were not in the reference starfile and were removed' % number_of_unmatched)
 
     print('There are %i particles from %i filaments in the expanded starfile' % (expanded_star.number_of_particles, expanded_star.number_of_filaments))
 
     expanded_star.writeFilamentsToStarFile(suffix = '_unexpanded')
 
-def updateAlignments(star1, star2, subtracted=True):
+def updateColumns(star1, star2, column_names, subtracted = True, suffix = '_updated', report_file = None):
     """
-    Function to update the angles/translations from starfile1 using the
-    angles from starfile 2
+    Copies columns from the particles of starfile 2 into the same particles of
+    starfile 1
 
-    Currently very naive - assumes that particles are in identical sequence in
-    both starfiles. This could obviously lead to bugs and will fix at some point
+    Particles are matched on their micrograph and image name (the
+    rlnImageOriginalName of starfile 1 if it holds subtracted particles).
+    Particles of starfile 1 that aren't in starfile 2, or are in it more than
+    once, are left as they are. Returns the number of particles updated
     """
-    number_of_skipped_particles = 0
+    target_keys = ['rlnMicrographName', 'rlnImageOriginalName' if subtracted else 'rlnImageName']
 
-    star1_data = parse_star.readBlockDataFromStarfile(star1, index_particles = True)
-    star2_data = parse_star.readBlockDataFromStarfile(star2, index_particles = True)
+    star1_data = parse_star.readBlockDataFromStarfile(star1, usecols = set(target_keys + column_names))
+    star2_data = parse_star.readBlockDataFromStarfile(star2, usecols = set(star_join.PARTICLE_KEYS + column_names))
 
-    if star1_data.number_of_particles != star2_data.number_of_particles:
-        raise InputError('Two starfiles do not have the same number of particles')
-
-    for p_no in range(star1_data.number_of_particles):
-        ps1_micname = star1_data.getParticleMicrograph(p_no)
-        if subtracted:
-            ps1_imagename = star1_data.getParticleValue(p_no, 'rlnImageOriginalName')
-        else:
-            ps1_imagename = star1_data.getParticleImageName(p_no)
-
-        try:
-            p_no_s2 = star2_data.getParticleNumber(ps1_micname, ps1_imagename)
-        except KeyError:
-            number_of_skipped_particles +=1
-            continue
-
-        new_rot = star2_data.getParticleValue(p_no_s2, 'rlnAngleRot')
-        star1_data.setParticleValue(p_no, 'rlnAngleRot', new_rot)
-
-        new_psi = star2_data.getParticleValue(p_no_s2, 'rlnAnglePsi')
-        star1_data.setParticleValue(p_no, 'rlnAnglePsi', new_psi)
-
-        new_tilt = star2_data.getParticleValue(p_no_s2, 'rlnAngleTilt')
-        star1_data.setParticleValue(p_no, 'rlnAngleTilt', new_tilt)
-
-        new_xtrans = star2_data.getParticleValue(p_no_s2, 'rlnOriginXAngst')
-        star1_data.setParticleValue(p_no, 'rlnOriginXAngst', new_xtrans)
-
-        new_ytrans = star2_data.getParticleValue(p_no_s2, 'rlnOriginYAngst')
-        star1_data.setParticleValue(p_no, 'rlnOriginYAngst', new_ytrans)
+    source_rows, match_counts = star_join.joinTables(star1_data.table, star2_data.table, target_keys, star_join.PARTICLE_KEYS)
+    number_of_updated_particles = star_join.transferColumns(star1_data.table, star2_data.table, column_names, source_rows)
 
+    number_of_skipped_particles = np.count_nonzero(match_counts == 0)
+    number_of_ambiguous_particles = np.count_nonzero(match_counts > 1)
     if number_of_skipped_particles > 0:
         print('There were %i particles that could not be found in the updating star file %s' %(number_of_skipped_particles, star2))
+    if number_of_ambiguous_particles > 0:
+        print('There were %i particles that are in the updating star file %s more than once and were not updated' %(number_of_ambiguous_particles, star2))
+    print('Updated %s for %i of %i particles' % (', '.join(column_names), number_of_updated_particles, star1_data.number_of_particles))
+
+    if report_file is not None:
+        star_join.saveJoinReport(report_file, star1_data.table, target_keys, match_counts)
 
     star1_data.writeBlockDatatoStar(
                                     save_updated_data=True,
-                                    suffix='_updatedAlignments'
+                                    suffix=suffix
                                     )
 
-def updateCTF(star1, star2, subtracted=True):
+    return number_of_updated_particles
+
+def updateAlignments(star1, star2, subtracted = True, column_names = None, report_file = None):
     """
     Function to update the angles/translations from starfile1 using the
-    angles from starfile 2
+    angles from starfile 2 (or column_names instead)
+    """
+    return updateColumns(star1, star2, column_names or ALIGNMENT_COLUMNS, subtracted, '_updatedAlignments', report_file)
 
-    Currently very naive - assumes that particles are in identical sequence in
-    both starfiles. This could obviously lead to bugs and will fix at some point
+def updateCTF(star1, star2, subtracted = True, column_names = None, report_file = None):
+    """
+    Function to update the CTF parameters from starfile1 using the values from
+    starfile 2 (or column_names instead)
     """
-    number_of_skipped_particles = 0
+    return updateColumns(star1, star2, column_names or CTF_COLUMNS, subtracted, '_updatedCTF', report_file)
 
-    star1_data = parse_star.readBlockDataFromStarfile(star1, index_particles = True)
-    star2_data = parse_star.readBlockDataFromStarfile(star2, index_particles = True)
+#Operations that can be chained by runPipeline, with the function that runs
+#each one on a loaded filament object and the COMMAND_COLUMNS entry it reads
+PIPELINE_OPERATIONS = {
+    'remove_shortfils':(removeShortFilsFromObject, 'removeShortFils'),
+    'reset_tilt':(resetTiltInObject, 'reset_tilt'),
+    'unify_tilt':(unifyTiltInObject, 'unify_tilt'),
+    'unify_rot':(unifyRotInObject, 'unify_rot'),
+    'unify_psi':(unifyPsiInObject, 'unify_psi'),
+    'unify_xy':(unifyXYInObject, 'unifyXY'),
+    'order_filaments':(orderFilamentsInObject, 'orderFilaments'),
+    'remove_duplicates':(removeDuplicatesFromObject, 'removeDuplicates'),
+    }
 
-    if star1_data.number_of_particles != star2_data.number_of_particles:
-        raise InputError('Two starfiles do not have the same number of particles')
+def duplicatePipelineColumns(operation_arguments):
 
-    for p_no in range(star1_data.number_of_particles):
-        ps1_micname = star1_data.getParticleMicrograph(p_no)
-        if subtracted:
-            ps1_imagename = star1_data.getParticleValue(p_no, 'rlnImageOriginalName')
-        else:
-            ps1_imagename = star1_data.getParticleImageName(p_no)
+    '''Columns a remove_duplicates step needs, from its arguments tuple (the
+    arguments of removeDuplicatesFromObject after the filament object)'''
 
-        try:
-            p_no_s2 = star2_data.getParticleNumber(ps1_micname, ps1_imagename)
-        except KeyError:
-            number_of_skipped_particles +=1
-            continue
+    arguments = dict(zip(['tolerance', 'keep', 'distance', 'apix', 'report_file'], operation_arguments))
+    return duplicateColumns(arguments.get('keep', 'last'), arguments.get('distance'))
 
-        new_defu = star2_data.getParticleValue(p_no_s2, 'rlnDefocusU')
-        star1_data.setParticleValue(p_no, 'rlnDefocusU', new_defu)
+#Pipeline operations whose columns depend on their arguments, with a function
+#that takes the arguments tuple and returns the extra columns
+PIPELINE_COLUMN_HOOKS = {
+    'remove_duplicates':duplicatePipelineColumns,
+    }
 
-        new_defv = star2_data.getParticleValue(p_no_s2, 'rlnDefocusV')
-        star1_data.setParticleValue(p_no, 'rlnDefocusV', new_defv)
+def pipelineColumns(operations):
 
-        new_def_ang = star2_data.getParticleValue(p_no_s2, 'rlnDefocusAngle')
-        star1_data.setParticleValue(p_no, 'rlnDefocusAngle', new_def_ang)
+    '''Returns the columns a list of pipeline operations needs, or None if any
+    of them needs every column'''
 
-        new_ctfB = star2_data.getParticleValue(p_no_s2, 'rlnCtfBfactor')
-        star1_data.setParticleValue(p_no, 'rlnCtfBfactor', new_ctfB)
+    columns = set()
+    for operation_name, operation_arguments, *_ in operations:
+        operation_columns = COMMAND_COLUMNS[PIPELINE_OPERATIONS[operation_name][1]]
+        if operation_columns is None:
+            return None
+        columns.update(operation_columns)
+        if operation_name in PIPELINE_COLUMN_HOOKS:
+            columns.update(PIPELINE_COLUMN_HOOKS[operation_name](operation_arguments))
 
-        new_ctf_scale = star2_data.getParticleValue(p_no_s2, 'rlnCtfScalefactor')
-        star1_data.setParticleValue(p_no, 'rlnCtfScalefactor', new_ctf_scale)
+    return sorted(columns)
 
-    if number_of_skipped_particles > 0:
-        print('There were %i particles that could not be found in the updating star file %s' %(number_of_skipped_particles, star2))
+def runPipeline(starfile_path, operations, suffix = None):
 
-    star1_data.writeBlockDatatoStar(
-                                    save_updated_data=True,
-                                    suffix='_updatedCTF'
-                                    )
+    '''Runs a list of operations on a starfile, parsing it once and writing
+    the result once at the end rather than chaining through a new file for every
+    step
+
+    operations is a list of (operation name, arguments) in the order they
+    should run, with names from PIPELINE_OPERATIONS e.g.
+        [('remove_shortfils', (5,)), ('unify_tilt', ()), ('unify_psi', ())]
+    An operation can also have a dictionary of keyword arguments after its
+    arguments e.g. ('unify_rot', (4.5,), {'engine':'hough'})'''
+
+    for operation_name, *_ in operations:
+        if operation_name not in PIPELINE_OPERATIONS:
+            raise ValueError('%s can not be used in a pipeline, the options are: %s' % (operation_name, ', '.join(PIPELINE_OPERATIONS)))
+
+    filament_data = parse_star.readFilamentsFromStarFile(starfile_path, usecols = pipelineColumns(operations))
+
+    for operation_name, operation_arguments, *keyword_arguments in operations:
+        print('Running %s on %s' % (operation_name, starfile_path))
+        PIPELINE_OPERATIONS[operation_name][0](filament_data, *operation_arguments, **(keyword_arguments[0] if keyword_arguments else {}))
+
+    filament_data.writeFilamentsToStarFile(suffix = suffix)
+
+    return filament_data
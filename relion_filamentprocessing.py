@@ -6,85 +6,157 @@ from filtools import(
             unifyparticles,
             plotparticles,
             get_helixinimodel2d_angles,
+            parse_star,
+            perf_report,
+            star_tokenizer,
             )
 #from utils import csparc_ctf
 
 parser = argparse.ArgumentParser()
 
 parser.add_argument('--input', '--i', nargs = '+', help = 'Input star file(s)')
+parser.add_argument('--threads', type = int, default = 1, help = 'Number of processes used to parse big starfiles')
+parser.add_argument('--jobs', type = int, default = 1, help = 'Number of processes used to fit filaments for --unify_rot and --unify_psi')
+parser.add_argument('--chunk_size', type = int, default = 256, help = 'Number of filaments sent to each process at a time with --jobs')
 
 parser.add_argument('--unify_tilt', '--tilt', action = 'store_true', help = 'Unify the tilt values for filaments')
 parser.add_argument('--unify_rot', '--rot', type = float, help = 'Unify the rot values for filaments')
+parser.add_argument('--rot_engine', default = 'search', choices = unifyparticles.ROT_ENGINES, help = 'How --unify_rot fits the lines: the exhaustive search or the faster Hough accumulator')
+parser.add_argument('--resume', action = 'store_true', help = 'Carry on a --unify_rot run from its checkpoint, if it was made from the same starfile and options')
+parser.add_argument('--checkpoint_interval', type = float, default = 60, help = 'Seconds between saving --unify_rot checkpoints, 0 turns them off')
 parser.add_argument('--unify_psi', '--psi', action = 'store_true', help = 'Unify the psi values for filaments')
+parser.add_argument('--unify_xy', '--xy', action = 'store_true', help = 'Smooth the x and y shifts of filaments with a polynomial of the helical track length')
+parser.add_argument('--xy_degree', type = int, default = 2, help = 'Degree of the polynomial used by --unify_xy')
+parser.add_argument('--xy_outliers', type = float, help = 'Only replace the shifts further than this (in Angstrom) from the --unify_xy fit')
 
 parser.add_argument('--select_angles', '--sel', nargs = 3, metavar = '[Starfile Header] [Lower limit] [Upper limit]', help = 'Function to select particles with alignment angles that fall within the specified range')
 parser.add_argument('--order_filaments', '--order', action = 'store_true', help = 'Save stafile with filaments ordered')
 parser.add_argument('--remove_duplicates', action = 'store_true', help = 'Remove duplicate particles from starfiles')
+parser.add_argument('--duplicate_tolerance', type = float, default = 0, help = 'Particles in a filament with track lengths this close (in Angstrom) are duplicates, for --remove_duplicates and --merge_stars')
+parser.add_argument('--duplicate_distance', type = float, help = 'Also remove particles picked more than once under different filaments or tube IDs with --remove_duplicates: particles of different filaments closer than this (in pixels) on a micrograph are duplicates and only the best scoring one is kept')
+parser.add_argument('--duplicate_report', help = 'Save the clusters of duplicates found with --duplicate_distance to this JSON file')
+parser.add_argument('--apix', type = float, default = 1.05, help = 'Pixel size of the particle coordinates in Angstrom, used with --duplicate_distance')
+parser.add_argument('--keep_duplicate', default = 'last', choices = parse_star.DUPLICATE_POLICIES, help = 'Which particle of a set of duplicates to keep: the last or first along the filament or the best rlnMaxValueProbDistribution')
 
 parser.add_argument('--reset_tilt', action = 'store_true', help = 'Option to fit the tilt values for each filament')
 parser.add_argument('--remove_shortfils', type = int, help = 'Option to remove the particles from filaments shorter than the stated value')
 
+parser.add_argument('--pipeline', nargs = '+', choices = sorted(unifyparticles.PIPELINE_OPERATIONS), help = 'Run these operations in order on one loaded copy of each starfile and save a single new starfile. Values are taken from the options of the same name e.g. --pipeline remove_shortfils unify_tilt unify_psi --remove_shortfils 5')
+
 parser.add_argument('--make_superparticles', type = int, metavar = '*Specify windowing range*', help = 'Option to generate superparticles')
 
 parser.add_argument('--plot_changes', action = 'store_true', help = 'Option to save pdf plots showing the old and updated angles for each filament')
 parser.add_argument('--plot_pdf', '--p', action = 'store_true', help = 'Plot the particle data from filaments into a pdf file')
 parser.add_argument('--plot_fillenhist', action = 'store_true', help = 'Plot a histogram of the filament lengths')
 parser.add_argument('--compare_starfiles', action = 'store_true', help = 'Plot a histogram of the filament lengths')
-parser.add_argument('--merge_stars', action = 'store_true',help = 'Merge 2 starfiles keeping the two sets of filaments seperate')
+parser.add_argument('--merge_stars', action = 'store_true',help = 'Merge 2 or more starfiles keeping the sets of filaments seperate')
+parser.add_argument('--missing_columns', default = 'error', choices = parse_star.MISSING_COLUMN_POLICIES, help = 'What --merge_stars does with columns that are not in every starfile: stop with an error, only keep the columns they all have or fill the missing values with 0 (None for text)')
 parser.add_argument('--fix_expanded_particles', nargs = 1, type = str, help = 'Merge 2 starfiles keeping the two sets of filaments seperate')
 
 parser.add_argument('--get_helixinimodel2d_angles', nargs = 1, help = '[angpix] Specialised function for me')
 parser.add_argument('--update_angles', nargs = 1, help = 'Specialised function for me')
 parser.add_argument('--update_ctf', nargs = 1, help = 'Specialised function for me')
+parser.add_argument('--update_columns', nargs = 1, metavar = 'starfile', help = 'Copy the --columns of the same particles (matched on micrograph and image name) from this starfile into the input starfile')
+parser.add_argument('--subtracted', action = 'store_true', help = 'The input starfile holds subtracted particles, so --update_angles, --update_ctf and --update_columns match them on rlnImageOriginalName')
+parser.add_argument('--columns', nargs = '+', help = 'Columns copied by --update_columns, or copied instead of the alignments or CTF parameters by --update_angles and --update_ctf')
+parser.add_argument('--join_report', metavar = 'report.json', help = 'Save the particles --update_angles, --update_ctf or --update_columns could not match, or matched more than once, to this JSON file')
+parser.add_argument('--perf-report', '--perf_report', dest = 'perf_report', metavar = 'report.json', help = 'Save the time taken by each stage (parse, group, compute and write) of every operation, the particles and filaments per second and a histogram of the fit time per filament as JSON')
 parser.add_argument('--update_csparc_ctf', action = 'store_true', help = '[angpix] Specialised function for me')
 
 args=parser.parse_args()
 
+if args.duplicate_distance is not None and args.duplicate_distance <= 0:
+    parser.error('--duplicate_distance must be greater than 0')
+
+star_tokenizer.setDefaultWorkers(args.threads)
+
+if args.perf_report:
+    perf_report.startReport()
+
 
 do_plots = args.plot_changes
 
+if args.pipeline:
+    #The values of the operations come from their own options
+    #Checkpoints are only made by --unify_rot on its own
+    if args.resume or args.checkpoint_interval != parser.get_default('checkpoint_interval'):
+        parser.error('--resume and --checkpoint_interval can not be used with --pipeline')
+
+    pipeline_arguments = {'remove_shortfils':(args.remove_shortfils,), 'unify_rot':(args.unify_rot,), 'unify_psi':(args.jobs, args.chunk_size), 'unify_xy':(args.xy_degree, True, args.xy_outliers),
+                          'remove_duplicates':(args.duplicate_tolerance, args.keep_duplicate, args.duplicate_distance, args.apix, args.duplicate_report)}
+    pipeline_keyword_arguments = {'unify_rot':{'engine':args.rot_engine, 'jobs':args.jobs, 'chunk_size':args.chunk_size}}
+    for operation_name in args.pipeline:
+        #Only the first value is required, the rest can be left unset
+        if None in pipeline_arguments.get(operation_name, ())[:1]:
+            quit('Please give a value for --%s to use it in the pipeline' % operation_name)
+
+    operations = [(operation_name, pipeline_arguments.get(operation_name, ()), pipeline_keyword_arguments.get(operation_name, {})) for operation_name in args.pipeline]
+    for starfile in args.input:
+        with perf_report.timeOperation('pipeline', starfile):
+            unifyparticles.runPipeline(starfile, operations)
+
+    #Operations that ran in the pipeline are not run again on their own
+    for operation_name in args.pipeline:
+        setattr(args, operation_name, None)
+
 if args.reset_tilt:
     for starfile in args.input:
-        unifyparticles.reset_tilt(starfile, do_plots)
+        with perf_report.timeOperation('reset_tilt', starfile):
+            unifyparticles.reset_tilt(starfile, do_plots)
 
 if args.remove_shortfils:
     for starfile in args.input:
-        unifyparticles.removeShortFilsFromStarfile(starfile, args.remove_shortfils)
+        with perf_report.timeOperation('remove_shortfils', starfile):
+            unifyparticles.removeShortFilsFromStarfile(starfile, args.remove_shortfils)
 
 if args.select_angles:
     for starfile in args.input:
-        unifyparticles.selectParticlesbyAlignmentAngleRange(starfile, args.select_angles[0], int(args.select_angles[1]), int(args.select_angles[2]))
+        with perf_report.timeOperation('select_angles', starfile):
+            unifyparticles.selectParticlesbyAlignmentAngleRange(starfile, args.select_angles[0], int(args.select_angles[1]), int(args.select_angles[2]))
 
 if args.unify_tilt:
     for starfile in args.input:
-        unifyparticles.unify_tilt(starfile, do_plots)
+        with perf_report.timeOperation('unify_tilt', starfile):
+            unifyparticles.unify_tilt(starfile, do_plots)
 
 if args.unify_rot:
     for starfile in args.input:
-        unifyparticles.unify_rot(starfile, args.unify_rot, plot_changes = do_plots)
+        with perf_report.timeOperation('unify_rot', starfile):
+            unifyparticles.unify_rot(starfile, args.unify_rot, plot_changes = do_plots, engine = args.rot_engine, jobs = args.jobs, chunk_size = args.chunk_size,
+                                     checkpoint_interval = args.checkpoint_interval or None, resume = args.resume)
 
 if args.unify_psi:
     for starfile in args.input:
-        unifyparticles.unify_psi(starfile, do_plots)
+        with perf_report.timeOperation('unify_psi', starfile):
+            unifyparticles.unify_psi(starfile, do_plots, jobs = args.jobs, chunk_size = args.chunk_size)
+
+if args.unify_xy:
+    for starfile in args.input:
+        with perf_report.timeOperation('unify_xy', starfile):
+            unifyparticles.unifyXY(starfile, do_plots, args.xy_degree, outlier_threshold = args.xy_outliers)
 
 if args.order_filaments:
     for starfile in args.input:
-        unifyparticles.orderFilaments(starfile)
+        with perf_report.timeOperation('order_filaments', starfile):
+            unifyparticles.orderFilaments(starfile)
 
 if args.remove_duplicates:
     for starfile in args.input:
-        unifyparticles.removeDuplicates(starfile)
+        with perf_report.timeOperation('remove_duplicates', starfile):
+            unifyparticles.removeDuplicates(starfile, args.duplicate_tolerance, args.keep_duplicate, args.duplicate_distance, args.apix, args.duplicate_report)
 
 if args.make_superparticles:
     from filtools import superparticles
     for starfile in args.input:
-        superparticles.make_superparticles(starfile, args.make_superparticles)
+        with perf_report.timeOperation('make_superparticles', starfile):
+            superparticles.make_superparticles(starfile, args.make_superparticles)
 
 if args.merge_stars:
-    if len(args.input) != 2:
-        quit('Please provide two starfiles for this function')
+    if len(args.input) < 2:
+        quit('Please provide at least two starfiles for this function')
 
-    unifyparticles.mergeStarFiles(args.input[0], args.input[1])
+    with perf_report.timeOperation('merge_stars', args.input):
+        unifyparticles.mergeStarFiles(args.input, args.duplicate_tolerance, args.keep_duplicate, args.missing_columns)
 
 if args.fix_expanded_particles:
     if len(args.input) != 1:
@@ -92,19 +164,23 @@ if args.fix_expanded_particles:
     if len(args.fix_expanded_particles) != 1:
         raise AttributeError('Please provide a reference starfile using the --fix_expanded_particles option e.g. --fix_expanded_particles path/to/starfile.star')
 
-    unifyparticles.correctExpandedParticles(args.input[0], args.fix_expanded_particles[0])
+    with perf_report.timeOperation('fix_expanded_particles', [args.input[0], args.fix_expanded_particles[0]]):
+        unifyparticles.correctExpandedParticles(args.input[0], args.fix_expanded_particles[0])
 
 if args.update_angles:
-    if args.subtracted:
-        unifyparticles.updateAlignments(args.input[0], args.update_angles[0], subtracted=True)
-    else:
-        unifyparticles.updateAlignments(args.input[0], args.update_angles[0], subtracted=False)
+    with perf_report.timeOperation('update_angles', [args.input[0], args.update_angles[0]]):
+        unifyparticles.updateAlignments(args.input[0], args.update_angles[0], args.subtracted, args.columns, args.join_report)
 
 if args.update_ctf:
-    if args.subtracted:
-        unifyparticles.updateCTF(args.input[0], args.update_angles[0], subtracted=True)
-    else:
-        unifyparticles.updateCTF(args.input[0], args.update_angles[0], subtracted=False)
+    with perf_report.timeOperation('update_ctf', [args.input[0], args.update_ctf[0]]):
+        unifyparticles.updateCTF(args.input[0], args.update_ctf[0], args.subtracted, args.columns, args.join_report)
+
+if args.update_columns:
+    if not args.columns:
+        quit('Please give the columns to copy with --columns e.g. --columns rlnClassNumber rlnAngleRot')
+
+    with perf_report.timeOperation('update_columns', [args.input[0], args.update_columns[0]]):
+        unifyparticles.updateColumns(args.input[0], args.update_columns[0], args.columns, args.subtracted, report_file = args.join_report)
 
 
 #if args.update_csparc_ctf:
@@ -113,10 +189,12 @@ if args.update_ctf:
 
 if args.plot_pdf:
     for starfile in args.input:
-        plotparticles.plot_filament_pdf(starfile)
+        with perf_report.timeOperation('plot_pdf', starfile):
+            plotparticles.plot_filament_pdf(starfile)
 if args.plot_fillenhist:
     for starfile in args.input:
-        plotparticles.plotFilamentLengthHistogram(starfile)
+        with perf_report.timeOperation('plot_fillenhist', starfile):
+            plotparticles.plotFilamentLengthHistogram(starfile)
 if args.compare_starfiles:
     if len(args.input) != 2:
         quit('Please provide two starfiles for this function')
@@ -128,3 +206,6 @@ if args.get_helixinimodel2d_angles:
         quit('Please provide two starfiles for this function')
     else:
         get_helixinimodel2d_angles.getAngles(args.input[0], args.input[1], args.get_helixinimodel2d_angles[0])
+
+if args.perf_report:
+    perf_report.stopReport().save(args.perf_report)
@@ -0,0 +1,169 @@
+'''Times the main operations on synthetic starfiles of increasing size and
+reports the peak memory of each one.
+
+Every operation runs in a fresh process (so its peak memory is its own) with
+the star cache turned off, on files made by utils/make_synthetic_star.py which
+are kept in --workdir between runs. Not collected by pytest, run it directly:
+
+    python tests/benchmark_scaling.py --sizes 10000 100000 1000000 --output scaling.json
+'''
+
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+
+ROOT_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIRECTORY)
+
+from utils import make_synthetic_star
+
+DEFAULT_SIZES = [10000, 100000, 1000000]
+EXPANSION_FACTOR = 2
+
+
+def _peakMemoryMB():
+    peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #kilobytes on linux, bytes on mac
+    return peak_memory / (1024**2 if sys.platform == 'darwin' else 1024)
+
+def _load(files, options):
+    from filtools import parse_star
+    parse_star.readFilamentsFromStarFile(files['star'], use_cache = False)
+
+def _write(files, options):
+    from filtools import parse_star
+    filament_data = parse_star.readFilamentsFromStarFile(files['star'], use_cache = False)
+    #Change a column so the writer has to format it rather than just copy text
+    filament_data.addDataColumn(filament_data.table.getColumn('rlnAngleRot') + 1, 'rlnAngleRot')
+    start_time = time.perf_counter()
+    filament_data.writeFilamentsToStarFile()
+    return time.perf_counter() - start_time
+
+def _unifyRot(files, options):
+    from filtools import unifyparticles
+    unifyparticles.unify_rot(files['star'], -1.2, engine = options['rot_engine'], jobs = options['jobs'], checkpoint_interval = None)
+
+def _unifyPsi(files, options):
+    from filtools import unifyparticles
+    unifyparticles.unify_psi(files['star'], jobs = options['jobs'])
+
+def _removeDuplicates(files, options):
+    from filtools import unifyparticles
+    unifyparticles.removeDuplicates(files['star'])
+
+def _mergeStarFiles(files, options):
+    from filtools import unifyparticles
+    unifyparticles.mergeStarFiles([files['star'], files['other']])
+
+def _correctExpandedParticles(files, options):
+    from filtools import unifyparticles
+    unifyparticles.correctExpandedParticles(files['expanded'], files['reference'])
+
+def _updateAlignments(files, options):
+    from filtools import unifyparticles
+    unifyparticles.updateAlignments(files['star'], files['refined'], subtracted = False)
+
+#Operation name: function, which returns the time to report if it only wants
+#part of its run timed
+OPERATIONS = {
+              'load':_load,
+              'write':_write,
+              'unify_rot':_unifyRot,
+              'unify_psi':_unifyPsi,
+              'removeDuplicates':_removeDuplicates,
+              'mergeStarFiles':_mergeStarFiles,
+              'correctExpandedParticles':_correctExpandedParticles,
+              'updateAlignments':_updateAlignments,
+              }
+
+def _runOperation(operation_name, files, options):
+
+    '''Runs in a fresh worker process. Returns the seconds taken and the peak
+    memory before and after'''
+
+    os.environ['FILTOOLS_CACHE'] = '0'
+    import filtools.unifyparticles
+    starting_memory = _peakMemoryMB()
+
+    #The operations print a lot, which isn't wanted in the benchmark output
+    with open(os.devnull, 'w') as devnull:
+        stdout = sys.stdout
+        sys.stdout = devnull
+        try:
+            start_time = time.perf_counter()
+            timed_seconds = OPERATIONS[operation_name](files, options)
+            seconds = time.perf_counter() - start_time
+        finally:
+            sys.stdout = stdout
+
+    if timed_seconds is not None:
+        seconds = timed_seconds
+
+    return seconds, starting_memory, _peakMemoryMB()
+
+def makeBenchmarkFiles(workdir, size, seed = 0):
+
+    '''Makes (or reuses) the synthetic starfiles for one size'''
+
+    files = {name:os.path.join(workdir, 'synthetic_%i_%s.star' % (size, name)) for name in ['star', 'other', 'refined', 'reference', 'expanded']}
+    if all(os.path.exists(filename) for filename in files.values()):
+        return files
+
+    columns = make_synthetic_star.makeSyntheticStar(files['star'], size, seed = seed)
+    make_synthetic_star.writeSyntheticStar(files['refined'], make_synthetic_star.refinedCopy(columns, seed + 1))
+    make_synthetic_star.makeSyntheticStar(files['other'], size, seed = seed + 2)
+
+    #The expanded file has about size particles
+    reference_columns = make_synthetic_star.makeSyntheticStar(files['reference'], size // EXPANSION_FACTOR, seed = seed + 3, duplicate_fraction = 0)
+    make_synthetic_star.writeSyntheticStar(files['expanded'], make_synthetic_star.expandedCopy(reference_columns, EXPANSION_FACTOR))
+
+    return files
+
+def runBenchmarks(sizes, operations, workdir, options):
+    results = []
+    context = multiprocessing.get_context('spawn')
+
+    for size in sizes:
+        print('Making the synthetic starfiles for %i particles' % size)
+        files = makeBenchmarkFiles(workdir, size)
+
+        for operation_name in operations:
+            with concurrent.futures.ProcessPoolExecutor(max_workers = 1, mp_context = context) as pool:
+                try:
+                    seconds, starting_memory, peak_memory = pool.submit(_runOperation, operation_name, files, options).result()
+                except Exception as error:
+                    print('%-26s %9i particles   failed: %s' % (operation_name, size, error))
+                    results.append({'operation':operation_name, 'particles':size, 'error':str(error)})
+                    continue
+
+            print('%-26s %9i particles %10.3f s %12.0f particles/s   peak memory %8.1f MB' % (operation_name, size, seconds, size / seconds, peak_memory))
+            results.append({'operation':operation_name, 'particles':size, 'seconds':seconds, 'particles_per_second':size / seconds,
+                            'peak_memory_mb':peak_memory, 'start_memory_mb':starting_memory})
+
+    return results
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = 'Time the starfile operations on synthetic data of increasing size')
+    parser.add_argument('--sizes', type = int, nargs = '+', default = DEFAULT_SIZES, help = 'Numbers of particles to test')
+    parser.add_argument('--operations', nargs = '+', default = list(OPERATIONS), choices = list(OPERATIONS))
+    parser.add_argument('--workdir', default = os.path.join(tempfile.gettempdir(), 'filtools_benchmark'), help = 'Where the synthetic starfiles are kept')
+    parser.add_argument('--rot_engine', default = 'hough', help = 'Engine used by unify_rot')
+    parser.add_argument('--jobs', type = int, default = 1, help = 'Processes used by unify_rot and unify_psi')
+    parser.add_argument('--output', help = 'Save the results as JSON here')
+    args = parser.parse_args()
+
+    os.makedirs(args.workdir, exist_ok = True)
+    results = runBenchmarks(args.sizes, args.operations, args.workdir, {'rot_engine':args.rot_engine, 'jobs':args.jobs})
+
+    if args.output:
+        with open(args.output, 'w') as results_file:
+            json.dump({'sizes':args.sizes, 'options':vars(args), 'results':results}, results_file, indent = 2)
+        print('Results saved as ' + args.output)
@@ -2,15 +2,36 @@ from filtools import(
             unifyparticles,
             plotparticles,
             get_helixinimodel2d_angles,
-            parse_star
+            parse_star,
+            star_stream,
+            star_cache,
+            star_file,
+            star_table,
+            star_tokenizer,
+            star_writer,
+            segment_reductions,
+            fit_checkpoint,
+            perf_report,
+            spatial_duplicates,
+            star_join,
             )
+from utils import circular, make_synthetic_star, plotfit
+
+import os
+import shutil
 
 import numpy as np
+import pytest
 
 
 test_starfile1 = 'tests/test_data/test_star1.star'
 test_starfile2 = 'tests/test_data/test_star2.star'
 
+@pytest.fixture(autouse = True)
+def _cacheInTempDirectory(tmp_path, monkeypatch):
+    #Keeps the star caches made by the tests out of the repository
+    monkeypatch.setenv('FILTOOLS_CACHE_DIR', str(tmp_path / 'cache'))
+
 class TestFunctions:
 
     def test_updateAlignments(self):
@@ -36,3 +57,580 @@ class TestFunctions:
         rot_orig_file = updating_angles_star.getNumpyDataColumn('rlnDefocusU')
 
         assert np.isclose(rot_saved_file, rot_orig_file).all()
+
+    def test_blockDataColumnTypes(self):
+
+        block_data = parse_star.readBlockDataFromStarfile(test_starfile1)
+
+        assert block_data.table.getColumn('rlnAngleRot').dtype == np.float64
+        assert block_data.table.getColumn('rlnHelicalTubeID').dtype == np.int32
+        assert block_data.table.getColumn('rlnMicrographName').dtype.kind == 'S'
+        assert block_data.getParticleMicrograph(0).endswith('_fractions.mrc')
+
+    def test_filamentOffsets(self):
+
+        filament_data = parse_star.readFilamentsFromStarFile(test_starfile1)
+        offsets = filament_data.filament_offsets
+
+        assert offsets[0] == 0 and offsets[-1] == filament_data.number_of_particles
+        assert len(offsets) == filament_data.number_of_filaments + 1
+
+        tracklength = filament_data.getNumpyFilamentColumn(5, 'rlnHelicalTrackLengthAngst')
+        assert np.shares_memory(tracklength, filament_data.table.getColumn('rlnHelicalTrackLengthAngst'))
+        assert (np.diff(tracklength) >= 0).all()
+
+    def test_chunkedReader(self):
+
+        block_data = parse_star.readBlockDataFromStarfile(test_starfile1)
+
+        with star_stream.starChunkReader(test_starfile1, chunk_size = 100) as reader:
+            chunk_sizes = [chunk.number_of_rows for chunk in reader]
+
+        assert max(chunk_sizes) == 100
+        assert sum(chunk_sizes) == block_data.number_of_particles
+        assert reader.column_names == block_data.table.column_names
+
+    def test_tokenizerMatchesLineParsing(self):
+
+        buffer = star_tokenizer.mapStarFile(test_starfile1)
+        particle_block = star_tokenizer.findParticleBlock(star_tokenizer.findDataBlocks(buffer))
+        tokenized_table = particle_block.readTable(buffer, range_size = 4096)
+
+        with open(test_starfile1, 'rb') as starfile:
+            data_lines = [i.strip() for i in starfile.read()[particle_block.body_start:].splitlines() if len(i.strip()) != 0]
+        line_table = star_table.starDataTable.fromDataLines(particle_block.column_names, data_lines)
+
+        for name in line_table.column_names:
+            assert (tokenized_table.getColumn(name) == line_table.getColumn(name)).all()
+
+    def test_starCache(self, tmp_path, monkeypatch):
+
+        starfile = str(tmp_path / 'test_star1.star')
+        shutil.copy(test_starfile1, starfile)
+
+        assert star_cache.loadCachedTable(starfile) is None
+        parsed_table = parse_star.loadParticleTableFromStar(starfile)[3]
+        cached_star = star_cache.loadCachedTable(starfile)
+        assert cached_star is not None
+
+        for name in parsed_table.column_names:
+            assert (cached_star[3].getColumn(name) == parsed_table.getColumn(name)).all()
+
+        #A cache that can't record the use is still read
+        def failedUtime(*args):
+            raise PermissionError('read only')
+        monkeypatch.setattr(star_cache.os, 'utime', failedUtime)
+        assert star_cache.loadCachedTable(starfile) is not None
+
+        #Changing the starfile should invalidate the cache entry
+        with open(starfile, 'a') as appended_star:
+            appended_star.write('\n')
+        assert star_cache.loadCachedTable(starfile) is None
+
+        #Entries are kept next to the starfile by default
+        monkeypatch.delenv('FILTOOLS_CACHE_DIR')
+        assert star_cache.cacheEntryPath(starfile).startswith(str(tmp_path / '.filtools_cache'))
+
+    def test_writerRoundTrip(self, tmp_path):
+
+        starfile = str(tmp_path / 'test_star1.star')
+        shutil.copy(test_starfile1, starfile)
+
+        #Without any edits the file should be reproduced exactly
+        block_data = parse_star.readBlockDataFromStarfile(starfile, use_cache = False)
+        block_data.writeBlockDatatoStar(suffix = '_copy')
+        with open(starfile, 'rb') as original, open(str(tmp_path / 'test_star1_copy.star'), 'rb') as copy:
+            assert original.read() == copy.read()
+
+        #Only the edited column should change
+        new_tilt = block_data.getNumpyDataColumn('rlnAngleTilt') + 0.5
+        block_data.addColumntoBlockData(new_tilt, 'rlnAngleTilt')
+        block_data.writeBlockDatatoStar(suffix = '_edited', float_format = '%.3f')
+        edited_table = parse_star.readBlockDataFromStarfile(str(tmp_path / 'test_star1_edited.star'), use_cache = False).table
+
+        assert np.allclose(edited_table.getColumn('rlnAngleTilt'), new_tilt, atol = 1e-3)
+        for name in block_data.table.column_names:
+            if name != 'rlnAngleTilt':
+                assert (edited_table.getColumn(name) == block_data.table.getColumn(name)).all()
+
+        values = np.array([0, -0.0, 1.5e-7, -2.25, 123456.789, np.nan])
+        cells = star_writer.formatFloatCells(values, '%.6f')
+        assert [i.replace(b'\0', b'') for i in cells] == np.char.mod(b'%.6f', values).tolist()
+
+    def test_multiBlockStarFile(self, tmp_path):
+
+        for iteration, distribution in ((1, 0.25), (2, 0.4)):
+            with open(str(tmp_path / ('run_it%03i_model.star' % iteration)), 'w') as model_star:
+                model_star.write('\n# version 30001\n\ndata_model_general\n\n_rlnReferenceDimensionality 2\n_rlnCurrentResolution 4.5\n_rlnOutputRootName Class2D/job001/run\n\n')
+                model_star.write('data_model_classes\n\nloop_\n_rlnReferenceImage #1\n_rlnClassDistribution #2\n')
+                model_star.write('000001@Class2D/job001/run_classes.mrcs %f\n000002@Class2D/job001/run_classes.mrcs %f\n\n' % (distribution, 1 - distribution))
+                model_star.write('data_model_class_1\n\nloop_\n_rlnSpectralIndex #1\n_rlnResolution #2\n0 0.000000\n1 0.002000\n')
+
+        with star_file.starFile(str(tmp_path / 'run_it001_model.star')) as model_star:
+            assert model_star.getBlockNames() == ['model_general', 'model_classes', 'model_class_1']
+            assert model_star.getValue('model_general', 'rlnReferenceDimensionality') == 2
+            assert model_star.getValue('model_general', 'rlnOutputRootName') == 'Class2D/job001/run'
+            assert model_star.getTable('model_class_1').number_of_rows == 2
+
+        models = parse_star.parseAllModelsinDirectory(str(tmp_path))
+        assert models.number_of_iterations == 2
+        assert models.number_of_classes == 2
+        assert models.getClassDistForOneClass(0) == [0.25, 0.4]
+
+    def test_usecolsPassthrough(self, tmp_path):
+
+        starfile = str(tmp_path / 'test_star1.star')
+        shutil.copy(test_starfile1, starfile)
+
+        filament_data = parse_star.readFilamentsFromStarFile(starfile, use_cache = False, usecols = ['rlnAngleTilt'])
+        assert sorted(filament_data.table.column_names) == sorted(parse_star.FILAMENT_COLUMNS + ['rlnAngleTilt'])
+
+        for filament_no in range(filament_data.number_of_filaments):
+            filament_data.addFilamentDataColumn(filament_no, np.full(filament_data.getNumberofParticlesinFilament(filament_no), 90.0), 'rlnAngleTilt')
+        filament_data.writeFilamentsToStarFile()
+
+        original_table = parse_star.readBlockDataFromStarfile(starfile, use_cache = False).table
+        written_table = parse_star.readBlockDataFromStarfile(str(tmp_path / 'test_star1_updatedrlnAngleTilt.star'), use_cache = False).table
+
+        assert written_table.column_names == original_table.column_names
+        assert (written_table.getColumn('rlnAngleTilt') == 90).all()
+        for name in ['rlnImageName', 'rlnAngleRot', 'rlnOriginXAngst']:
+            assert sorted(written_table.getColumn(name).tolist()) == sorted(original_table.getColumn(name).tolist())
+
+    def test_parallelParsing(self):
+
+        with star_file.starFile(test_starfile1) as star:
+            block = star.getParticleBlock()
+            text_source = block.getTextSource(test_starfile1)
+            serial_table = block.readTable(star.buffer, range_size = 1000, text_source = text_source, workers = 1)
+
+            star_tokenizer.MIN_PARALLEL_RANGE_SIZE, min_range_size = 1000, star_tokenizer.MIN_PARALLEL_RANGE_SIZE
+            try:
+                parallel_table = block.readTable(star.buffer, range_size = 1000, text_source = text_source, workers = 2)
+            finally:
+                star_tokenizer.MIN_PARALLEL_RANGE_SIZE = min_range_size
+
+        assert parallel_table.column_names == serial_table.column_names
+        assert (parallel_table.row_starts == serial_table.row_starts).all()
+        for name in serial_table.column_names:
+            assert (parallel_table.getColumn(name) == serial_table.getColumn(name)).all()
+
+        #A column that only has text in some of the pieces is text in all of them
+        body = b''.join(b'%i 0%i\n' % (i, i) for i in range(200)) + b'7 GroupA\n'
+        whole_table = star_tokenizer.readTableFromByteRange(body, 0, len(body), ['rlnNumber', 'rlnGroupName'])
+        split_table = star_tokenizer.readTableFromByteRange(body, 0, len(body), ['rlnNumber', 'rlnGroupName'], range_size = 100)
+        assert split_table.getColumn('rlnGroupName').tolist() == whole_table.getColumn('rlnGroupName').tolist()
+        assert split_table.getColumn('rlnGroupName')[:3].tolist() == [b'00', b'01', b'02']
+
+    def test_pipeline(self, tmp_path):
+
+        starfile = str(tmp_path / 'test_star1.star')
+        shutil.copy(test_starfile1, starfile)
+
+        unifyparticles.runPipeline(starfile, [('remove_shortfils', (5,)), ('unify_tilt', ()), ('unify_psi', ())])
+        pipeline_table = parse_star.readBlockDataFromStarfile(str(tmp_path / 'test_star1_updatednoShortFilamentsrlnAngleTiltrlnAnglePsi.star'), use_cache = False).table
+
+        #Same result as chaining the commands through their own files
+        unifyparticles.removeShortFilsFromStarfile(starfile, 5)
+        unifyparticles.unify_tilt(str(tmp_path / 'test_star1_noShortFilsnoShortFilaments.star'))
+        unifyparticles.unify_psi(str(tmp_path / 'test_star1_noShortFilsnoShortFilaments_updatedrlnAngleTilt.star'))
+        chained_table = parse_star.readBlockDataFromStarfile(str(tmp_path / 'test_star1_noShortFilsnoShortFilaments_updatedrlnAngleTilt_updatedrlnAnglePsi.star'), use_cache = False).table
+
+        assert pipeline_table.column_names == chained_table.column_names
+        for name in pipeline_table.column_names:
+            assert (pipeline_table.getColumn(name) == chained_table.getColumn(name)).all()
+
+        #The columns of remove_duplicates depend on its arguments
+        assert 'rlnCoordinateX' not in unifyparticles.pipelineColumns([('remove_duplicates', (0, 'last'))])
+        assert 'rlnCoordinateX' in unifyparticles.pipelineColumns([('remove_duplicates', (0, 'last', 5))])
+
+        #Keyword arguments after the arguments
+        rot_table = unifyparticles.runPipeline(starfile, [('unify_rot', (4.5,), {'engine':'hough', 'chunk_size':4})], suffix = '_rot').table
+        assert rot_table.number_of_rows == parse_star.readBlockDataFromStarfile(starfile, use_cache = False).table.number_of_rows
+
+    def test_exhaustiveLinearSearch(self):
+
+        random = np.random.default_rng(0)
+        tracklength = np.arange(30) * 14.25
+        rot_angles = 0.3 * tracklength - 20 + random.normal(0, 2, 30)
+        rln_score = random.uniform(0.05, 0.5, 30)
+        y_intercepts = np.arange(-200, 200, 0.1)
+
+        #One intercept at a time, the way the search used to work
+        expected = []
+        for y in y_intercepts:
+            residuals = circular.angularDistance(rot_angles, plotfit.linRegress(tracklength, y, 0.3))
+            scored_errors = np.where(residuals < 4, rln_score / residuals, np.nan)
+            sum_error = np.nansum(scored_errors) * np.count_nonzero(~np.isnan(scored_errors))
+            if sum_error != 0:
+                expected.append([y, sum_error])
+        expected = np.array(expected)
+
+        for tile_elements in [1, 1000, plotfit.DEFAULT_TILE_ELEMENTS]:
+            sorted_score = plotfit.exhaustiveLinearSearch(0.3, y_intercepts, tracklength, rot_angles, rln_score, 4, tile_elements)
+            assert sorted_score.shape == expected.shape and len(expected) > 0
+            assert np.allclose(np.sort(sorted_score[:,1]), np.sort(expected[:,1]))
+            assert (np.diff(sorted_score[:,1]) >= 0).all()
+
+        #A line that runs over the 180 wrap scores the same as without the wrap
+        rot_angles = 0.3 * tracklength + 160 + random.normal(0, 2, 30)
+        unwrapped_score = plotfit.exhaustiveLinearSearch(0.3, [160], tracklength, rot_angles, rln_score, 4)
+        assert np.allclose(plotfit.exhaustiveLinearSearch(0.3, [160], tracklength, circular.wrapAngles(rot_angles), rln_score, 4), unwrapped_score)
+        unwrapped_plot = plotfit.optimiseLinearGradient([0.3], [160], tracklength, rot_angles, rln_score, 4)
+        assert np.allclose(plotfit.optimiseLinearGradient([0.3], [160], tracklength, circular.wrapAngles(rot_angles), rln_score, 4), unwrapped_plot)
+
+    def test_optimiseLinearGradientBatch(self):
+
+        random = np.random.default_rng(1)
+        m_list = np.linspace(0.15, 0.45, 40)
+        filaments = []
+        for number_of_particles in [3, 3, 12, 30]:
+            tracklength = np.arange(number_of_particles) * 14.25
+            rot_angles = 0.3 * tracklength - 20 + random.normal(0, 2, number_of_particles)
+            filaments.append((np.linspace(-30, -10, 40), tracklength, rot_angles, random.uniform(0.05, 0.5, number_of_particles)))
+
+        best_plots = plotfit.optimiseLinearGradientBatch(m_list, *zip(*filaments), 4, memory_budget = 10000)
+
+        for (y_intercepts, tracklength, rot_angles, rln_score), best_plot in zip(filaments, best_plots):
+            #Brute force over the same grid
+            scores = []
+            for m in m_list:
+                for y in y_intercepts:
+                    errors = circular.angularDistance(rot_angles, plotfit.linRegress(tracklength, y, m))
+                    scored_errors = np.where(errors < 4, errors * np.sqrt(rln_score), np.nan)
+                    scores.append([m, y, np.nansum(scored_errors) * np.count_nonzero(~np.isnan(scored_errors))])
+            scores = np.array(scores)
+
+            assert np.isclose(best_plot[2], scores[:,2].max())
+            assert (plotfit.optimiseLinearGradient(m_list, y_intercepts, tracklength, rot_angles, rln_score, 4) == best_plot).all()
+
+    def test_houghRotFit(self):
+
+        #A line that runs over the 180 wrap is found exactly
+        tracklength = np.arange(20) * 14.25
+        rot_angles = circular.wrapAngles(-0.3 * tracklength - 170)
+        best_plot = plotfit.houghRotFit((-0.5, -0.1), [tracklength], [rot_angles], [np.ones(20)], 4)[0]
+        assert np.abs(circular.wrapAngles(rot_angles - plotfit.linRegress(tracklength, best_plot[1], best_plot[0]))).max() < 1
+
+        #On real filaments the Hough lines should keep at least as many particles as the exhaustive search
+        filament_data = parse_star.readFilamentsFromStarFile(test_starfile1, use_cache = False)
+        gradient = -1.2 / (4.75 / 1.05)
+        m_list = np.linspace(gradient / 2, gradient * 1.5, 40)
+        inliers = {'search':0, 'hough':0}
+        for filament_no in np.flatnonzero(filament_data.filament_no_of_particles >= 5):
+            tracklength = filament_data.getNumpyFilamentColumn(filament_no, 'rlnHelicalTrackLengthAngst')
+            rot_angles = filament_data.getNumpyFilamentColumn(filament_no, 'rlnAngleRot')
+            rln_score = filament_data.getNumpyFilamentColumn(filament_no, 'rlnMaxValueProbDistribution')
+
+            search_limit = len(tracklength) * tracklength[1] * 0.2
+            y_intercepts = np.arange(-180 - search_limit, 180 + search_limit, 0.1)
+            top_scored_plots = np.concatenate((plotfit.exhaustiveLinearSearch(gradient, y_intercepts, tracklength, rot_angles, rln_score, 4)[-20:],
+                                               plotfit.exhaustiveLinearSearch(-gradient, y_intercepts, tracklength, rot_angles, rln_score, 4)[-20:]))
+
+            for engine, best_plot in [('search', plotfit.optimiseLinearGradient(m_list, top_scored_plots[:,0], tracklength, rot_angles, rln_score, 4)),
+                                      ('hough', plotfit.houghRotFit((m_list[0], m_list[-1]), [tracklength], [rot_angles], [rln_score], 4)[0])]:
+                if not np.isnan(best_plot[0]):
+                    inliers[engine] += np.count_nonzero(np.abs(circular.wrapAngles(rot_angles - plotfit.linRegress(tracklength, best_plot[1], best_plot[0]))) <= 4)
+
+        assert inliers['hough'] >= inliers['search'] > 0
+
+    def test_parallelFilamentFitting(self):
+
+        fitted_angles = {}
+        for jobs, chunk_size in [(1, 256), (2, 50)]:
+            filament_data = parse_star.readFilamentsFromStarFile(test_starfile1, use_cache = False)
+            unifyparticles.unifyRotInObject(filament_data, -1.2, engine = 'hough', jobs = jobs, chunk_size = chunk_size)
+            unifyparticles.unifyPsiInObject(filament_data, jobs = jobs, chunk_size = chunk_size)
+            fitted_angles[jobs] = [filament_data.table.getColumn(name).copy() for name in ['rlnAngleRot', 'rlnAnglePsi']]
+
+        for serial_column, parallel_column in zip(fitted_angles[1], fitted_angles[2]):
+            assert np.array_equal(serial_column, parallel_column)
+
+    def test_segmentReductions(self):
+
+        random = np.random.default_rng(2)
+        offsets = np.array([0, 3, 3, 10, 11, 30])
+        values = random.normal(0, 90, 30)
+        segments = [values[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+
+        assert segment_reductions.segmentCounts(offsets).tolist() == [len(segment) for segment in segments]
+        for reduction, expected in [(segment_reductions.segmentMin, np.min), (segment_reductions.segmentMax, np.max),
+                                    (segment_reductions.segmentMean, np.mean), (segment_reductions.segmentMedian, np.median)]:
+            result = reduction(values, offsets)
+            assert np.isnan(result[1])
+            assert np.allclose(result[[0, 2, 3, 4]], [expected(segment) for segment in segments if len(segment) > 0])
+
+        #The median is exactly np.median
+        assert (segment_reductions.segmentMedian(values, offsets)[[0, 2, 3, 4]] == [np.median(segment) for segment in segments if len(segment) > 0]).all()
+
+        quantiles = segment_reductions.segmentQuantiles(values, offsets, [0, 0.1, 0.5, 0.75, 1])
+        for segment, segment_quantiles in zip(segments, quantiles):
+            if len(segment) > 0:
+                assert np.allclose(segment_quantiles, np.quantile(segment, [0, 0.1, 0.5, 0.75, 1]))
+
+        #Angles either side of the wrap average to 180, not 0
+        circular_means = segment_reductions.segmentCircularMean(np.array([170, -170, 10, 20]), [0, 2, 4])
+        assert np.isclose(abs(circular_means[0]), 180) and np.isclose(circular_means[1], 15)
+
+    def test_circularAngles(self):
+
+        angles = np.array([179.0, -179.0, 90.0, -180.0, 540.0])
+        assert (circular.wrapAngles(angles) == [179, -179, 90, -180, -180]).all()
+        assert np.allclose(circular.angularResiduals([179, -179], [-179, 179]), [-2, 2])
+
+        #The outliers go onto the line and the line is wrapped
+        snapped = circular.snapToLine(np.array([178.0, 100.0, 0.0]), np.array([182.0, 181.0, np.nan]), 5)
+        assert np.allclose(snapped, [178, -179, 0])
+
+        #Ranges can cross the wrap, angularRangeMask also takes the range flipped by 180
+        assert circular.inAngularRange(np.array([175, -175, -165, 0]), 170, 190).tolist() == [True, True, False, False]
+        assert parse_star.angularRangeMask(np.array([175, -175, 5, -5, 90]), 170, 190).tolist() == [True, True, True, True, False]
+
+    def test_fitSegmentPolynomials(self):
+
+        rng = np.random.default_rng(3)
+        offsets = np.array([0, 30, 31, 33, 80])
+        x_values = np.sort(rng.uniform(0, 2000, 80))
+        y_values = rng.normal(0, 3, 80)
+        weights = rng.uniform(0.1, 1, 80)
+
+        fitted = plotfit.fitSegmentPolynomials(x_values, y_values, offsets, 2, weights)
+
+        #Same as polyfit (which weights the unsquared residuals) for each filament, with lower degrees for the short ones
+        for (start, end), degree in zip(zip(offsets[:-1], offsets[1:]), [2, 0, 1, 2]):
+            coefficients = np.polyfit(x_values[start:end], y_values[start:end], degree, w = np.sqrt(weights[start:end]))
+            assert np.allclose(fitted[start:end], np.polyval(coefficients, x_values[start:end]))
+
+        filament_data = parse_star.readFilamentsFromStarFile('tests/test_data/test_star1.star', use_cache = False)
+        original_x = filament_data.table.getColumn('rlnOriginXAngst').copy()
+        unifyparticles.unifyXYInObject(filament_data, weighted = False, outlier_threshold = 1)
+        new_x = filament_data.table.getColumn('rlnOriginXAngst')
+        changed = new_x != original_x
+        assert changed.any() and not changed.all()
+
+    def test_rotCheckpoint(self, tmp_path):
+
+        starfile = str(tmp_path / 'test_star1.star')
+        shutil.copy(test_starfile1, starfile)
+        parameters = {'twist':-1.2}
+        key = fit_checkpoint.checkpointKey(starfile, parameters)
+        checkpoint_path = fit_checkpoint.checkpointPath(starfile, 'unify_rot')
+
+        #Pretend a run was killed after fitting the first filament
+        filament_data = parse_star.readFilamentsFromStarFile(starfile, use_cache = False)
+        offsets = filament_data.filament_offsets
+        checkpoint = fit_checkpoint.fitCheckpoint(checkpoint_path, key, filament_data.table.getColumn('rlnAngleRot'), filament_data.number_of_filaments)
+        checkpoint.finishFilaments(0, 1, slice(offsets[0], offsets[1]), 12.5)
+        checkpoint.save()
+
+        #Resuming skips the finished filament and fits the rest
+        resumed = fit_checkpoint.fitCheckpoint(checkpoint_path, key, filament_data.table.getColumn('rlnAngleRot'), filament_data.number_of_filaments, resume = True)
+        unifyparticles.unifyRotInObject(filament_data, -1.2, engine = 'hough', checkpoint = resumed)
+        resumed_rot = filament_data.table.getColumn('rlnAngleRot')
+        assert (resumed_rot[offsets[0]:offsets[1]] == 12.5).all()
+        assert resumed.finished.all()
+
+        fresh_data = parse_star.readFilamentsFromStarFile(starfile, use_cache = False)
+        unifyparticles.unifyRotInObject(fresh_data, -1.2, engine = 'hough')
+        assert np.array_equal(resumed_rot[offsets[1]:], fresh_data.table.getColumn('rlnAngleRot')[offsets[1]:])
+
+        #A checkpoint for other parameters or an edited starfile is not used
+        other_key = fit_checkpoint.checkpointKey(starfile, {'twist':-1.3})
+        stale = fit_checkpoint.fitCheckpoint(checkpoint_path, other_key, fresh_data.table.getColumn('rlnAngleRot'), fresh_data.number_of_filaments, resume = True)
+        assert not stale.finished.any()
+        with open(starfile, 'a') as star_file:
+            star_file.write('\n')
+        assert fit_checkpoint.checkpointKey(starfile, parameters) != key
+
+        #A fit that ends before its first checkpoint never hashes the starfile
+        def unusedKey():
+            raise AssertionError('The starfile was hashed')
+        quick = fit_checkpoint.fitCheckpoint(checkpoint_path + '.quick', unusedKey, fresh_data.table.getColumn('rlnAngleRot'), fresh_data.number_of_filaments)
+        unifyparticles.unifyRotInObject(fresh_data, -1.2, engine = 'hough', checkpoint = quick)
+        assert quick.finished.all() and not os.path.exists(checkpoint_path + '.quick')
+
+    def test_perfReport(self, tmp_path):
+
+        starfile = str(tmp_path / 'test_star1.star')
+        shutil.copy(test_starfile1, starfile)
+
+        report = perf_report.startReport()
+        try:
+            with perf_report.timeOperation('unify_psi', starfile):
+                unifyparticles.unify_psi(starfile, chunk_size = 100)
+        finally:
+            perf_report.stopReport()
+
+        summary = report.toDict()['operations'][0]
+        assert set(summary['stages']) == {'parse', 'group', 'compute', 'write'}
+        assert summary['particles'] == 943 and summary['filaments'] == 553
+        assert sum(stage['seconds'] for stage in summary['stages'].values()) <= summary['seconds'] + 1e-6
+
+        fit_cost = summary['filament_fit_cost']
+        assert fit_cost['batches'] == 6
+        assert sum(fit_cost['seconds_per_filament_histogram']['filaments']) == 553
+
+        #Nothing is recorded without a report
+        with perf_report.timeStage('parse') as stage_record:
+            pass
+        assert perf_report.currentReport() is None and stage_record == {}
+
+    def test_syntheticStar(self, tmp_path):
+
+        starfile = str(tmp_path / 'synthetic.star')
+        columns = make_synthetic_star.makeSyntheticStar(starfile, 2000, optics_groups = 2, duplicate_fraction = 0.05)
+        number_of_particles = len(columns['rlnAngleRot'])
+        assert number_of_particles > 2000
+
+        filament_data = parse_star.readFilamentsFromStarFile(starfile, use_cache = False)
+        assert filament_data.number_of_particles == number_of_particles
+        assert len(filament_data.optics_info) == 14
+        assert min(filament_data.rln_fil_no_in_micrograph.values()) >= 1
+        assert np.array_equal(np.sort(filament_data.table.getColumn('rlnAngleRot')), np.sort(columns['rlnAngleRot']))
+
+        #The duplicates are found by removeDuplicates
+        unifyparticles.removeDuplicatesFromObject(filament_data)
+        assert filament_data.number_of_particles == 2000
+
+        refined = make_synthetic_star.refinedCopy(columns)
+        assert sorted(refined['rlnImageName'].tolist()) == sorted(columns['rlnImageName'].tolist())
+        expanded = make_synthetic_star.expandedCopy(columns, 3)
+        assert len(expanded['rlnAngleRot']) == 3 * number_of_particles
+
+    def test_duplicateParticleMask(self):
+
+        #Two filaments, the first has -0.0/0.0 and a near duplicate pair
+        track_lengths = np.array([-0.0, 0.0, 14.25, 14.26, 28.5, 0.0, 0.0])
+        offsets = np.array([0, 5, 7])
+        scores = np.array([0.1, 0.3, 0.5, 0.2, 0.1, 0.1, 0.1])
+
+        assert parse_star.duplicateParticleMask(track_lengths, offsets).tolist() == [True, False, False, False, False, True, False]
+        assert parse_star.duplicateParticleMask(track_lengths, offsets, 0.05, 'first').tolist() == [False, True, False, True, False, False, True]
+        assert parse_star.duplicateParticleMask(track_lengths, offsets, 0.05, 'best', scores).tolist() == [True, False, False, True, False, False, True]
+
+        filament_data = parse_star.readFilamentsFromStarFile(test_starfile1, use_cache = False)
+        filament_data.addNewFilamentFromOtherStar(filament_data, 0)
+        filament_data.addNewFilamentFromOtherStar(filament_data, 0)
+        number_of_particles = filament_data.number_of_particles
+        #Copies of a filament get new tube IDs so they aren't duplicates
+        assert filament_data.removeDuplicateParticles() == 0
+        filament_data.addDataColumn(np.zeros(number_of_particles), 'rlnHelicalTrackLengthAngst')
+        assert filament_data.removeDuplicateParticles(keep = 'best') == number_of_particles - filament_data.number_of_filaments
+        assert filament_data.number_of_particles == filament_data.number_of_filaments
+
+    def test_spatialDuplicates(self):
+
+        random = np.random.default_rng(4)
+        micrograph_ids = random.integers(0, 3, 400)
+        x_values = random.uniform(-50, 200, 400)
+        y_values = random.uniform(0, 200, 400)
+
+        #Same pairs as comparing every particle with every other
+        first, second = spatial_duplicates.closePairs(micrograph_ids, x_values, y_values, 6)
+        distances = np.hypot(x_values[:,None] - x_values[None,:], y_values[:,None] - y_values[None,:])
+        close = (distances <= 6) & (micrograph_ids[:,None] == micrograph_ids[None,:]) & np.triu(np.ones((400, 400), dtype = bool), 1)
+        assert sorted(zip(first.tolist(), second.tolist())) == sorted(zip(*[index.tolist() for index in np.nonzero(close)]))
+
+        #Pick the first filament again under a new tube ID, nudged a little
+        filament_data = parse_star.readFilamentsFromStarFile(test_starfile1, use_cache = False)
+        filament_data.addNewFilamentFromOtherStar(filament_data, 0)
+        table = filament_data.table
+        copied_rows = np.arange(filament_data.filament_offsets[-2], filament_data.number_of_particles)
+        table.getColumn('rlnCoordinateX')[copied_rows] += 2
+        table.getColumn('rlnMaxValueProbDistribution')[copied_rows] = 2
+
+        number_of_particles = filament_data.number_of_particles
+        cluster_ids = spatial_duplicates.findDuplicateClusters(table, 5)
+        assert (cluster_ids[copied_rows] >= 0).all() and (cluster_ids[:len(copied_rows)] == cluster_ids[copied_rows]).all()
+
+        unifyparticles.removeDuplicatesFromObject(filament_data, distance = 5)
+        assert filament_data.number_of_particles <= number_of_particles - len(copied_rows)
+        assert filament_data.table.getColumn('rlnHelicalTubeID')[-1] == table.getColumn('rlnHelicalTubeID')[-1]
+
+        #A distance above the box spacing mustn't join the boxes of a filament
+        #together, only the repicked filament (tube 3) with the first one
+        y_values = np.arange(10) * 14.0
+        table = star_table.starDataTable(spatial_duplicates.SPATIAL_COLUMNS, {'rlnMicrographName':np.full(30, b'mic'),
+                                         'rlnHelicalTubeID':np.repeat([1, 2, 3], 10).astype(np.int32), 'rlnCoordinateX':np.repeat([100.0, 300.0, 101.0], 10),
+                                         'rlnCoordinateY':np.tile(y_values, 3), 'rlnOriginXAngst':np.zeros(30), 'rlnOriginYAngst':np.zeros(30)})
+        cluster_ids = spatial_duplicates.findDuplicateClusters(table, 30)
+        assert (cluster_ids[10:20] == -1).all() and cluster_ids.max() + 1 == 10
+        assert (cluster_ids[:10] == cluster_ids[20:]).all()
+        assert np.count_nonzero(spatial_duplicates.lowerScoringMembers(cluster_ids, np.ones(30))) == 10
+        for distance in [0, -5]:
+            with pytest.raises(ValueError):
+                spatial_duplicates.findDuplicateClusters(table, distance)
+
+        #Nothing left after earlier steps
+        filament_data.removeParticlesByMask(np.ones(filament_data.number_of_particles, dtype = bool))
+        unifyparticles.removeDuplicatesFromObject(filament_data, distance = 5)
+        assert filament_data.number_of_particles == 0
+
+    def test_mergeFilaments(self):
+
+        star_objects = [parse_star.readFilamentsFromStarFile(test_starfile1, use_cache = False) for i in range(3)]
+        number_of_filaments = star_objects[0].number_of_filaments
+
+        #Same tube IDs as adding the filaments one at a time
+        one_at_a_time = parse_star.readFilamentsFromStarFile(test_starfile1, use_cache = False)
+        for other_star in star_objects[1:]:
+            for fil_no in range(number_of_filaments):
+                one_at_a_time.addNewFilamentFromOtherStar(other_star, fil_no)
+
+        merged_star = star_objects[0]
+        merged_star.mergeFilaments(star_objects[1:])
+        assert merged_star.number_of_filaments == 3 * number_of_filaments
+        assert merged_star.table.getColumn('rlnHelicalTubeID').tolist() == one_at_a_time.table.getColumn('rlnHelicalTubeID').tolist()
+        assert merged_star.removeDuplicateParticles() == 0
+
+        first_star, second_star = [parse_star.readFilamentsFromStarFile(test_starfile1, use_cache = False) for i in range(2)]
+        second_star._table = second_star._table.selectColumns([name for name in second_star._table.column_names if name != 'rlnAngleTilt'])
+        with pytest.raises(ValueError):
+            first_star.mergeFilaments([second_star])
+        first_star.mergeFilaments([second_star], 'fill')
+        assert first_star.table.getColumn('rlnAngleTilt')[second_star.number_of_particles:].tolist() == [0] * second_star.number_of_particles
+        assert parse_star.reconcileColumns([['a', 'b', 'c'], ['c', 'a']], ['one', 'two'], 'intersect') == ['a', 'c']
+
+    def test_correctExpandedParticles(self, tmp_path):
+
+        reference_star = parse_star.readFilamentsFromStarFile(test_starfile1, use_cache = False)
+        columns = {name:reference_star.table.getColumn(name) for name in reference_star.table.column_names}
+        expanded_starfile = str(tmp_path / 'expanded.star')
+        make_synthetic_star.writeSyntheticStar(expanded_starfile, make_synthetic_star.expandedCopy(columns, 3, 33))
+
+        unifyparticles.correctExpandedParticles(expanded_starfile, test_starfile1)
+        unexpanded_star = parse_star.readFilamentsFromStarFile(str(tmp_path / 'expanded_unexpanded.star'), use_cache = False)
+        assert unexpanded_star.number_of_particles == 3 * reference_star.number_of_particles
+        assert unexpanded_star.number_of_filaments == 3 * reference_star.number_of_filaments
+
+        #Every new filament holds one expansion of one filament
+        reference_rots = dict(zip(columns['rlnImageName'].astype('U').tolist(), columns['rlnAngleRot'].tolist()))
+        for fil_no in range(unexpanded_star.number_of_filaments):
+            image_names = unexpanded_star.getStringListFilamentColumn(fil_no, 'rlnImageName')
+            assert len(set(image_names)) == len(image_names)
+            reference_rot = np.array([reference_rots[name] for name in image_names])
+            rot_changes = np.round(circular.angularResiduals(reference_rot, unexpanded_star.getNumpyFilamentColumn(fil_no, 'rlnAngleRot')), 2)
+            assert len(set(rot_changes.tolist())) == 1
+
+    def test_updateColumns(self, tmp_path):
+
+        target = star_table.starDataTable(['rlnMicrographName', 'rlnImageName', 'rlnClassNumber'],
+                                          {'rlnMicrographName':np.array([b'a', b'a', b'b', b'c']), 'rlnImageName':np.array([b'1@a', b'2@a', b'1@b', b'1@c']),
+                                           'rlnClassNumber':np.zeros(4, dtype = np.int32)})
+        source = star_table.starDataTable(['rlnMicrographName', 'rlnImageName', 'rlnClassNumber'],
+                                          {'rlnMicrographName':np.array([b'b', b'a', b'b', b'c', b'c']), 'rlnImageName':np.array([b'1@b', b'1@a', b'2@b', b'1@c', b'1@c']),
+                                           'rlnClassNumber':np.array([3, 1, 4, 5, 6], dtype = np.int32)})
+
+        source_rows, match_counts = star_join.joinTables(target, source, star_join.PARTICLE_KEYS, star_join.PARTICLE_KEYS)
+        assert source_rows.tolist() == [1, -1, 0, -1] and match_counts.tolist() == [1, 0, 1, 2]
+        assert star_join.transferColumns(target, source, ['rlnClassNumber'], source_rows) == 2
+        assert target.getColumn('rlnClassNumber').tolist() == [1, 0, 3, 0]
+        report = star_join.joinReport(target, star_join.PARTICLE_KEYS, match_counts)
+        assert report['unmatched_keys'] == [['a', '2@a']] and report['ambiguous_keys'] == [['c', '1@c']]
+
+        starfile = str(tmp_path / 'test_star1.star')
+        shutil.copy(test_starfile1, starfile)
+        assert unifyparticles.updateColumns(starfile, test_starfile2, ['rlnAngleTilt', 'rlnDefocusU'], suffix = '_updated') == 943
+        updated_star = parse_star.readBlockDataFromStarfile(str(tmp_path / 'test_star1_updated.star'), use_cache = False)
+        updating_star = parse_star.readBlockDataFromStarfile(test_starfile2, use_cache = False)
+        assert np.isclose(updated_star.getNumpyDataColumn('rlnAngleTilt'), updating_star.getNumpyDataColumn('rlnAngleTilt')).all()
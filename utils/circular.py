@@ -0,0 +1,44 @@
+'''Vectorized helpers for angles in degrees, which wrap around at +-180'''
+
+import numpy as np
+
+
+def wrapAngles(angles):
+
+    '''Wraps angles into [-180, 180)'''
+
+    return np.mod(np.add(angles, 180), 360) - 180
+
+def angularResiduals(angles, reference):
+
+    '''Difference between angles and reference values the short way round the
+    circle, in [-180, 180)'''
+
+    return wrapAngles(np.subtract(angles, reference))
+
+def angularDistance(angles, reference):
+    return np.abs(angularResiduals(angles, reference))
+
+def outlierMask(angles, reference, search_range):
+
+    '''True for the angles more than search_range from their reference value.
+    nan references never make an outlier'''
+
+    with np.errstate(invalid = 'ignore'):
+        return angularDistance(angles, reference) > search_range
+
+def snapToLine(angles, line_of_best_fit, search_range):
+
+    '''Moves the outliers (angles further than search_range from the line of
+    best fit) onto the line, wrapped into [-180, 180). Returns a new array'''
+
+    return np.where(outlierMask(angles, line_of_best_fit, search_range), wrapAngles(line_of_best_fit), angles)
+
+def inAngularRange(angles, lower_limit, upper_limit):
+
+    '''True for the angles strictly between lower_limit and upper_limit going
+    round the circle, so e.g. 170 to 190 includes -175'''
+
+    with np.errstate(invalid = 'ignore'):
+        offsets = np.mod(np.subtract(angles, lower_limit), 360)
+        return (offsets > 0) & (offsets < upper_limit - lower_limit)
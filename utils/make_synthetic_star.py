@@ -0,0 +1,216 @@
+'''Makes synthetic helical particle starfiles of any size for testing and
+benchmarking.
+
+The particles are laid out like a real RELION helical extraction: micrographs
+with a few filaments each, tube IDs numbered from 1 in each micrograph, evenly
+spaced particles along each tube with their track lengths, rot angles that ramp
+with the helical twist, psi along the filament with some flipped by 180, tilts
+around 90 and per micrograph CTF values and optics groups. A fraction of the
+particles are given random (outlier) rot and tilt angles and some are
+duplicated.
+
+Companion files for the operations that need two starfiles can be made from
+the same particles: refinedCopy (new angles and shifts, shuffled, for
+updateAlignments) and expandedCopy (symmetry expanded, for
+correctExpandedParticles).
+
+e.g. python utils/make_synthetic_star.py --particles 100000 --output synthetic.star
+'''
+
+import argparse
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from filtools import star_table, star_writer
+from utils import circular
+
+OPTICS_COLUMNS = ['rlnOpticsGroupName', 'rlnOpticsGroup', 'rlnMtfFileName', 'rlnMicrographOriginalPixelSize', 'rlnVoltage',
+                  'rlnSphericalAberration', 'rlnAmplitudeContrast', 'rlnImagePixelSize', 'rlnImageSize', 'rlnImageDimensionality']
+
+
+def syntheticParticles(number_of_particles, twist = -1.2, rise = 4.75, apix = 1.05, particle_spacing = 14.25, filament_lengths = (5, 80),
+                       filaments_per_micrograph = (1, 8), outlier_fraction = 0.1, psi_flip_fraction = 0.05, duplicate_fraction = 0.01,
+                       optics_groups = 1, seed = 0):
+
+    '''Returns a dictionary of particle columns (in starfile order) for about
+    number_of_particles particles, grouped by micrograph and filament
+
+    filament_lengths and filaments_per_micrograph are the (lowest, highest)
+    number of particles per filament and filaments per micrograph. The rot
+    angles change along each filament with the gradient unify_rot expects for
+    twist, rise and apix'''
+
+    random = np.random.default_rng(seed)
+
+    #Draw enough filaments and cut the last one down to the requested size
+    mean_length = (filament_lengths[0] + filament_lengths[1]) / 2
+    lengths = random.integers(filament_lengths[0], filament_lengths[1] + 1, int(number_of_particles / mean_length * 1.2) + 2)
+    cumulative_lengths = np.cumsum(lengths)
+    number_of_filaments = int(np.searchsorted(cumulative_lengths, number_of_particles)) + 1
+    lengths = lengths[:number_of_filaments]
+    lengths[-1] -= cumulative_lengths[number_of_filaments - 1] - number_of_particles
+
+    #Share the filaments out between the micrographs
+    filaments_per_mic = random.integers(filaments_per_micrograph[0], filaments_per_micrograph[1] + 1, number_of_filaments)
+    mic_of_filament = np.repeat(np.arange(number_of_filaments), filaments_per_mic)[:number_of_filaments]
+    mic_of_filament = np.concatenate(([0], np.cumsum(np.diff(mic_of_filament) != 0)))
+    number_of_mics = int(mic_of_filament[-1]) + 1
+    mic_starts = np.flatnonzero(np.concatenate(([True], np.diff(mic_of_filament) != 0)))
+    tube_ids = np.arange(number_of_filaments) - mic_starts[mic_of_filament] + 1
+
+    filament_offsets = np.concatenate(([0], np.cumsum(lengths)))
+    particle_filaments = np.repeat(np.arange(number_of_filaments), lengths)
+    position_in_filament = np.arange(number_of_particles) - filament_offsets[particle_filaments]
+
+    #Each filament runs in a straight line across its micrograph
+    filament_psi = random.uniform(-180, 180, number_of_filaments)
+    filament_starts = random.uniform(500, 3500, (number_of_filaments, 2))
+    filament_rot_start = random.uniform(-180, 180, number_of_filaments)
+    track_start = random.uniform(0, particle_spacing, number_of_filaments)
+
+    track_lengths = np.round(track_start[particle_filaments] + position_in_filament * particle_spacing, 6)
+    psi_radians = np.radians(filament_psi[particle_filaments])
+    coordinate_x = filament_starts[particle_filaments, 0] + track_lengths / apix * np.cos(psi_radians)
+    coordinate_y = filament_starts[particle_filaments, 1] + track_lengths / apix * np.sin(psi_radians)
+
+    rot_gradient = twist / (rise / apix)
+    rot = filament_rot_start[particle_filaments] + rot_gradient * track_lengths + random.normal(0, 1, number_of_particles)
+    tilt = random.normal(90, 2, number_of_particles)
+    psi = filament_psi[particle_filaments] + random.normal(0, 1, number_of_particles)
+    psi[random.random(number_of_particles) < psi_flip_fraction] += 180
+
+    #psi outliers are the flips, as in real data
+    outliers = random.random(number_of_particles) < outlier_fraction
+    rot[outliers] = random.uniform(-180, 180, np.count_nonzero(outliers))
+    tilt[outliers] = random.uniform(60, 120, np.count_nonzero(outliers))
+
+    #Per micrograph values
+    mic_names = np.char.mod('MotionCorr/job004/Micrographs/FoilHole_%08i_Data_fractions.mrc', np.arange(number_of_mics) + 6376284).astype('S')
+    mic_optics_groups = random.integers(1, optics_groups + 1, number_of_mics)
+    mic_defocus = random.uniform(5000, 30000, number_of_mics)
+    particle_mics = mic_of_filament[particle_filaments]
+    particle_in_mic = np.arange(number_of_particles) - filament_offsets[mic_starts][particle_mics]
+    image_names = np.char.add(np.char.mod('%06i@Extract/job010/Micrographs/FoilHole_', particle_in_mic + 1).astype('S'),
+                              np.char.mod('%08i_Data_fractions.mrcs', particle_mics + 6376284).astype('S'))
+
+    columns = {
+               'rlnCoordinateX':np.round(coordinate_x, 6),
+               'rlnCoordinateY':np.round(coordinate_y, 6),
+               'rlnHelicalTubeID':tube_ids[particle_filaments].astype(np.int32),
+               'rlnAngleTiltPrior':np.full(number_of_particles, 90.0),
+               'rlnAnglePsiPrior':np.round(filament_psi[particle_filaments], 6),
+               'rlnHelicalTrackLengthAngst':track_lengths,
+               'rlnAnglePsiFlipRatio':np.full(number_of_particles, 0.5),
+               'rlnAngleRotFlipRatio':np.full(number_of_particles, 0.5),
+               'rlnImageName':image_names,
+               'rlnMicrographName':mic_names[particle_mics],
+               'rlnOpticsGroup':mic_optics_groups[particle_mics].astype(np.int32),
+               'rlnCtfMaxResolution':np.round(random.uniform(2.5, 6, number_of_mics)[particle_mics], 6),
+               'rlnDefocusU':np.round(mic_defocus[particle_mics], 6),
+               'rlnDefocusV':np.round(mic_defocus[particle_mics] - random.uniform(0, 500, number_of_mics)[particle_mics], 6),
+               'rlnDefocusAngle':np.round(random.uniform(-180, 180, number_of_mics)[particle_mics], 6),
+               'rlnAngleRot':np.round((rot + 180) % 360 - 180, 6),
+               'rlnAngleTilt':np.round(tilt, 6),
+               'rlnAnglePsi':np.round((psi + 180) % 360 - 180, 6),
+               'rlnOriginXAngst':np.round(random.normal(0, 3, number_of_particles), 6),
+               'rlnOriginYAngst':np.round(random.normal(0, 3, number_of_particles), 6),
+               'rlnClassNumber':np.ones(number_of_particles, dtype = np.int32),
+               'rlnMaxValueProbDistribution':np.round(random.uniform(0.02, 0.3, number_of_particles), 6),
+               'rlnRandomSubset':(tube_ids[particle_filaments] % 2 + 1).astype(np.int32),
+               }
+
+    #Duplicates are repeated straight after the original particle
+    duplicates = np.flatnonzero(random.random(number_of_particles) < duplicate_fraction)
+    if len(duplicates) > 0:
+        order = np.sort(np.concatenate((np.arange(number_of_particles), duplicates)), kind = 'stable')
+        columns = {name:column[order] for name, column in columns.items()}
+
+    return columns
+
+def opticsInfo(optics_groups = 1, apix = 1.05, box_size = 256):
+
+    '''The lines of an optics block, in the form the starfile reader gives'''
+
+    optics_info = ['data_optics', 'loop_'] + ['_%s #%i' % (name, number + 1) for number, name in enumerate(OPTICS_COLUMNS)]
+    for group in range(1, optics_groups + 1):
+        optics_info.append('opticsGroup%i %12i mtf_k3_std_300kv.star %12.6f %12.6f %12.6f %12.6f %12.6f %12i %12i' % (group, group, apix / 2, 300, 2.7, 0.1, apix, box_size, 2))
+
+    return optics_info
+
+def refinedCopy(columns, seed = 1):
+
+    '''The same particles with new angles and shifts as if from another
+    refinement, in a shuffled order'''
+
+    random = np.random.default_rng(seed)
+    number_of_particles = len(columns['rlnAngleRot'])
+    refined = {name:column.copy() for name, column in columns.items()}
+
+    for name, spread in [('rlnAngleRot', 5), ('rlnAngleTilt', 2), ('rlnAnglePsi', 2)]:
+        refined[name] = np.round((refined[name] + random.normal(0, spread, number_of_particles) + 180) % 360 - 180, 6)
+    for name in ['rlnOriginXAngst', 'rlnOriginYAngst']:
+        refined[name] = np.round(random.normal(0, 3, number_of_particles), 6)
+
+    order = random.permutation(number_of_particles)
+    return {name:column[order] for name, column in refined.items()}
+
+def expandedCopy(columns, expansion_factor = 2, rot_step = 7.5):
+
+    '''Symmetry expands the particles: each one is repeated expansion_factor
+    times, with the rot angle rot_step degrees lower each time (wrapped into
+    [-180, 180) like RELION does)'''
+
+    number_of_particles = len(columns['rlnAngleRot'])
+    order = np.repeat(np.arange(number_of_particles), expansion_factor)
+    expanded = {name:column[order] for name, column in columns.items()}
+
+    expansion_step = np.tile(np.arange(expansion_factor), number_of_particles)
+    expanded['rlnAngleRot'] = np.round(circular.wrapAngles(expanded['rlnAngleRot'] - expansion_step * rot_step), 6)
+
+    return expanded
+
+def writeSyntheticStar(filename, columns, optics_groups = 1, apix = 1.05):
+    table = star_table.starDataTable(list(columns.keys()), columns)
+    star_writer.writeStarFile(filename, ['# version 30001'], opticsInfo(optics_groups, apix), table)
+
+def makeSyntheticStar(filename, number_of_particles, optics_groups = 1, seed = 0, **particle_options):
+
+    '''Writes a synthetic starfile and returns its columns'''
+
+    columns = syntheticParticles(number_of_particles, optics_groups = optics_groups, seed = seed, **particle_options)
+    writeSyntheticStar(filename, columns, optics_groups, particle_options.get('apix', 1.05))
+    return columns
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = 'Make a synthetic helical particle starfile')
+    parser.add_argument('--particles', type = int, default = 10000, help = 'Number of particles (before duplicates are added)')
+    parser.add_argument('--output', '--o', required = True, help = 'Starfile to write')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--twist', type = float, default = -1.2)
+    parser.add_argument('--rise', type = float, default = 4.75)
+    parser.add_argument('--apix', type = float, default = 1.05)
+    parser.add_argument('--optics_groups', type = int, default = 1)
+    parser.add_argument('--outliers', type = float, default = 0.1, help = 'Fraction of particles with random rot and tilt angles')
+    parser.add_argument('--psi_flips', type = float, default = 0.05, help = 'Fraction of particles with psi flipped by 180')
+    parser.add_argument('--duplicates', type = float, default = 0.01, help = 'Fraction of particles that are duplicated')
+    parser.add_argument('--refined', help = 'Also write a copy with new angles and shuffled particles here e.g. for --update_angles')
+    parser.add_argument('--expanded', type = int, help = 'Also write a copy symmetry expanded by this factor e.g. for --fix_expanded_particles')
+    args = parser.parse_args()
+
+    columns = makeSyntheticStar(args.output, args.particles, args.optics_groups, args.seed, twist = args.twist, rise = args.rise, apix = args.apix,
+                                outlier_fraction = args.outliers, psi_flip_fraction = args.psi_flips, duplicate_fraction = args.duplicates)
+    print('Saved %i particles to %s' % (len(columns['rlnAngleRot']), args.output))
+
+    if args.refined:
+        writeSyntheticStar(args.refined, refinedCopy(columns, args.seed + 1), args.optics_groups, args.apix)
+        print('Saved the refined copy to %s' % args.refined)
+
+    if args.expanded:
+        expanded_filename = args.output[:-5] + '_expanded%i.star' % args.expanded
+        writeSyntheticStar(expanded_filename, expandedCopy(columns, args.expanded), args.optics_groups, args.apix)
+        print('Saved the expanded copy to %s' % expanded_filename)
@@ -1,105 +1,346 @@
 import numpy as np
 
+from utils.circular import wrapAngles, angularResiduals, angularDistance
+
+#The linear searches score a tile of lines against all the particles at once -
+#tiles hold at most this many (line, particle) residuals
+DEFAULT_TILE_ELEMENTS = 2**22
+
+#Rough number of bytes optimiseLinearGradient uses for the temporary arrays of
+#each batch, about 32 bytes go to every (gradient, intercept, particle) residual
+DEFAULT_MEMORY_BUDGET = 256 * 1024**2
+
+#The Hough line search stacks the intercepts of every (filament, gradient) row
+#into one sorted array of integer keys - the row number above HOUGH_ROW_SHIFT
+#bits and the intercept in fixed point below, so the result for a row doesn't
+#depend on which other rows are searched with it
+HOUGH_ROW_SHIFT = 42
+HOUGH_VALUE_SCALE = 2.0**32
+HOUGH_MAX_ROWS = 2**(63 - HOUGH_ROW_SHIFT)
+
 
 def linRegress(x,y,m):
     return np.add(np.multiply(m,x), y)
 
 def removeBigGaps(gaps, search_range):
-    return np.array([x if x < search_range else np.nan for x in gaps])
-
-def fixrotAngles(fitted_angles):
-
-    for particle_angle in fitted_angles:
-        if particle_angle > 180:
-            particle_angle = particle_angle - 360
-        elif particle_angle < -180:
-            particle_angle = particle_angle + 360
-
-    return fitted_angles
-
-def exhaustiveLinearSearch(m, y_intercepts, x_values, angles, rln_score, search_range):
-
-    for y in y_intercepts:
-        plot_line = linRegress(x_values,y,m)
-        residuals = np.absolute(np.subtract(angles,plot_line))
-        remove_big_gaps = removeBigGaps(residuals, search_range)
-        invert_score = np.reciprocal(remove_big_gaps)
-        scored_errors = np.multiply(invert_score, rln_score)
-        #print('Scored Errors:')
-        #print(scored_errors)
-        sum_error = np.nansum(scored_errors) * len(scored_errors[~np.isnan(scored_errors)])
-        #print(sum_error)
-        if sum_error != 0:
-            try:
-                score_y = np.concatenate((score_y, [[y,sum_error]]), axis = 0)
-            except NameError:
-                score_y = np.array([[y,sum_error]])
+    return np.where(gaps < search_range, gaps, np.nan)
+
+def exhaustiveLinearSearch(m, y_intercepts, x_values, angles, rln_score, search_range, tile_elements = DEFAULT_TILE_ELEMENTS):
+
+    '''Scores lines of gradient m through each of the y intercepts against the
+    particle angles. Particles within search_range of a line (the short way
+    round the circle) add their score divided by the distance to it, and the
+    sum is multiplied by the number of particles that were in range
+
+    Returns [y intercept, score] rows sorted by score, leaving out lines that
+    score 0. The (intercept x particle) residuals are worked out with
+    broadcasting a tile of intercepts at a time'''
+
+    y_intercepts = np.asarray(y_intercepts, dtype = np.float64).ravel()
+    x_values = np.asarray(x_values)
+    tile_size = max(1, tile_elements // max(len(x_values), 1))
+
+    sum_errors = np.empty(len(y_intercepts))
+    for start in range(0, len(y_intercepts), tile_size):
+        plot_lines = linRegress(x_values, y_intercepts[start:start + tile_size,None], m)
+        residuals = angularDistance(angles, plot_lines)
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            scored_errors = np.multiply(np.reciprocal(removeBigGaps(residuals, search_range)), rln_score)
+        sum_errors[start:start + tile_size] = np.nansum(scored_errors, axis = 1) * np.count_nonzero(~np.isnan(scored_errors), axis = 1)
 
+    score_y = np.column_stack((y_intercepts, sum_errors))[sum_errors != 0]
     sorted_score = score_y[np.argsort(score_y[:,1])]
 
     return sorted_score
 
-def optimiseLinearGradient(m_list, y_intercepts, vector, rot_angles, rln_score, search_range):
-
-    for m in m_list:
-        for y in y_intercepts:
-            plot_line = linRegress(vector,y,m)
-            error = np.absolute(np.subtract(rot_angles,plot_line))
-            remove_big_gaps = removeBigGaps(error, search_range)
-            invert_score = np.reciprocal(remove_big_gaps)
-            scored_errors = np.multiply(remove_big_gaps, np.sqrt(rln_score))
-            sum_error = np.nansum(scored_errors) * len(scored_errors[~np.isnan(scored_errors)])
-
-            if sum_error != 0:
-                try:
-                    score_y = np.concatenate((score_y, [[m,y,sum_error]]), axis = 0)
-                except NameError:
-                    score_y = np.array([[m,y,sum_error]])
-
-    sorted_score = score_y[np.argsort(score_y[:,2])]
-    best_m_score = sorted_score[-1]
-    return best_m_score
-
-def fitPolynomial(x_shifts, y_shifts, p_nums, plot = False):
-
-    #try to polynomial fit the x and y shifts - if polyfit fails then Alex's function is run instead
-    with warnings.catch_warnings():
-        try:
-            coefs = np.polyfit(filt_p_nums,filt_x_shifts,2)
-            fitt_object = np.poly1d(coefs)
-            uniX = [fitt_object(i) for i in xax]
-        except Warning:
-            print('Polynomial fitting failed')
-            uniX=flatten_and_cluster_shifts(Xsh,xax)
-        try:
-            coefs = np.polyfit(filt_p_nums,filt_y_shifts,2)
-            fitt_object = np.poly1d(coefs)
-            uniY = [fitt_object(i) for i in xax]
-        except Warning:
-            print('Polynomial fitting failed')
-            uniY=flatten_and_cluster_shifts(Ysh,xax)
-    if plot == True:
-        if mtID % 50 == 1:
-
-            plt.plot(xax,Ysh, 'o')
-            plt.plot(np.arange(xax[0],xax[-1],0.01),[fitt_object(i) for i in np.arange(xax[0],xax[-1],0.01)])
-            plt.show()
+def optimiseLinearGradient(m_list, y_intercepts, vector, rot_angles, rln_score, search_range, memory_budget = DEFAULT_MEMORY_BUDGET):
 
-    return uniX, uniY
+    '''Scores every combination of gradient and y intercept against the particle
+    angles and returns the best [m, y, score] row (all nan if no line scores)'''
+
+    return optimiseLinearGradientBatch(m_list, [y_intercepts], [vector], [rot_angles], [rln_score], search_range, memory_budget)[0]
+
+def optimiseLinearGradientBatch(m_list, y_intercept_list, vectors, rot_angle_list, rln_scores, search_range, memory_budget = DEFAULT_MEMORY_BUDGET):
+
+    '''optimiseLinearGradient for several filaments at once, returning one best
+    [m, y, score] row per filament
+
+    Particles within search_range of a line (the short way round the circle)
+    add their distance to it times the square root of their score, and the sum
+    is multiplied by the number of particles in range. Filaments with the same number of particles and
+    intercepts are scored together as one (line, particle) array, split into
+    batches that fit in memory_budget'''
+
+    m_list = np.asarray(m_list, dtype = np.float64).ravel()
+    y_intercept_list = [np.asarray(y_intercepts, dtype = np.float64).ravel() for y_intercepts in y_intercept_list]
+    best_m_scores = np.full((len(y_intercept_list), 3), np.nan)
+    max_elements = max(1, memory_budget // 32)
+
+    groups = {}
+    for filament_no, (y_intercepts, vector) in enumerate(zip(y_intercept_list, vectors)):
+        groups.setdefault((len(vector), len(y_intercepts)), []).append(filament_no)
+
+    for (number_of_particles, number_of_intercepts), filament_numbers in groups.items():
+        if number_of_particles == 0 or number_of_intercepts == 0:
+            continue
+
+        x_values = np.array([vectors[i] for i in filament_numbers], dtype = np.float64)
+        angles = np.array([rot_angle_list[i] for i in filament_numbers], dtype = np.float64)
+        score_weights = np.sqrt(np.array([rln_scores[i] for i in filament_numbers], dtype = np.float64))
+
+        #Lines are ordered filament, gradient, intercept
+        lines_per_filament = len(m_list) * number_of_intercepts
+        line_gradients = np.repeat(m_list, number_of_intercepts)
+        line_intercepts = np.concatenate([np.tile(y_intercept_list[i], len(m_list)) for i in filament_numbers])
+
+        sum_errors = np.empty(len(line_intercepts))
+        lines_per_batch = max(1, max_elements // number_of_particles)
+        for start in range(0, len(line_intercepts), lines_per_batch):
+            lines = np.arange(start, min(start + lines_per_batch, len(line_intercepts)))
+            line_filaments = lines // lines_per_filament
+
+            plot_lines = linRegress(x_values[line_filaments], line_intercepts[lines,None], line_gradients[lines % lines_per_filament,None])
+            errors = angularDistance(angles[line_filaments], plot_lines)
+            scored_errors = np.multiply(removeBigGaps(errors, search_range), score_weights[line_filaments])
+            sum_errors[lines] = np.nansum(scored_errors, axis = 1) * np.count_nonzero(~np.isnan(scored_errors), axis = 1)
+
+        for group_position, filament_no in enumerate(filament_numbers):
+            filament_sums = sum_errors[group_position * lines_per_filament:(group_position + 1) * lines_per_filament]
+            score_y = np.column_stack((line_gradients, line_intercepts[group_position * lines_per_filament:(group_position + 1) * lines_per_filament], filament_sums))[filament_sums != 0]
+            if len(score_y) > 0:
+                best_m_scores[filament_no] = score_y[np.argsort(score_y[:,2])][-1]
+
+    return best_m_scores
+
+def houghWindowSearch(line_rows, intercepts, weights, number_of_rows, search_range):
+
+    '''Wrap aware Hough accumulator for the intercepts of particles. Each row is
+    one filament at one gradient and each particle votes for the intercept
+    (angle - m*x) of the line through it. For every row this finds the window
+    of width 2*search_range holding the most votes, scored as the summed
+    weights times the number of particles, like exhaustiveLinearSearch
+
+    All the rows are sorted together so the cost is O(n log n). Returns the
+    intercept half way between the outermost particles of the best window of
+    each row, so all of them are within search_range of it, and the window's
+    score (nan and 0 for rows without particles)'''
+
+    intercepts = wrapAngles(intercepts)
+    row_keys = np.left_shift(np.asarray(line_rows, dtype = np.int64), HOUGH_ROW_SHIFT)
+
+    #A copy of the intercepts one turn up lets windows run over the 180 wrap
+    extended_values = np.concatenate((intercepts, intercepts + 360))
+    extended_weights = np.concatenate((weights, weights))
+    extended_keys = np.concatenate((row_keys, row_keys)) + np.floor((extended_values + 180) * HOUGH_VALUE_SCALE).astype(np.int64)
+    point_keys = extended_keys[:len(intercepts)]
+
+    order = np.argsort(extended_keys, kind = 'stable')
+    sorted_keys = extended_keys[order]
+    sorted_values = extended_values[order]
+    #Weights are summed in fixed point too so the sums are exact
+    weight_sums = np.concatenate(([0], np.cumsum(np.round(extended_weights[order] * HOUGH_VALUE_SCALE).astype(np.int64))))
+
+    #Windows start at each particle
+    window_starts = np.searchsorted(sorted_keys, point_keys, 'left')
+    window_ends = np.searchsorted(sorted_keys, point_keys + int(2 * search_range * HOUGH_VALUE_SCALE), 'left')
+    window_weights = (weight_sums[window_ends] - weight_sums[window_starts]) / HOUGH_VALUE_SCALE
+    window_scores = window_weights * (window_ends - window_starts)
+
+    #The first best scoring window of each row
+    best_first = np.lexsort((-window_scores, line_rows))
+    row_firsts = np.ones(len(best_first), dtype = bool)
+    row_firsts[1:] = line_rows[best_first][1:] != line_rows[best_first][:-1]
+    best_windows = best_first[row_firsts]
+    best_rows = line_rows[best_windows]
+
+    window_centres = (sorted_values[window_starts[best_windows]] + sorted_values[window_ends[best_windows] - 1]) / 2
+
+    centres = np.full(number_of_rows, np.nan)
+    scores = np.zeros(number_of_rows)
+    centres[best_rows] = wrapAngles(window_centres)
+    scores[best_rows] = window_scores[best_windows]
+
+    return centres, scores
+
+def houghLinearFitBatch(m_grids, vectors, angle_list, rln_scores, search_range, memory_budget = DEFAULT_MEMORY_BUDGET):
+
+    '''Finds the best line for each filament from its own row of gradients in
+    m_grids, using houghWindowSearch for the intercepts. Returns one [m, y,
+    score] row per filament, with y wrapped into [-180, 180)'''
 
-def adjustAngletoLOBF(line_of_best_fit, rot_angles, search_range):
-    '''
-    Ajusts outlier particles (those that lie outside the search window) to the
-    line of best fit - also should keep track of the change in angle
-    '''
+    m_grids = np.atleast_2d(np.asarray(m_grids, dtype = np.float64))
+    number_of_gradients = m_grids.shape[1]
+    filament_lengths = np.array([len(vector) for vector in vectors], dtype = np.int64)
+    best_m_scores = np.full((len(filament_lengths), 3), np.nan)
 
-    angle_change_to_optimum = np.abs(np.subtract(rot_angles, line_of_best_fit))
-    outlier_particle_positions = [num for num, i in enumerate(angle_change_to_optimum) if i > search_range]
+    #Batches of filaments are kept to about 64 bytes per (gradient, particle) vote
+    max_particles = max(1, memory_budget // (64 * number_of_gradients))
+    max_filaments = max(1, HOUGH_MAX_ROWS // number_of_gradients)
+    batch_start = 0
+    while batch_start < len(filament_lengths):
+        batch_end = batch_start + min(max_filaments, max(1, np.searchsorted(np.cumsum(filament_lengths[batch_start:]), max_particles, 'right')))
+        filament_numbers = np.arange(batch_start, batch_end)
+        batch_start = batch_end
 
-    for particle_no in outlier_particle_positions:
+        x_values = np.concatenate([np.asarray(vectors[i], dtype = np.float64) for i in filament_numbers])
+        angles = np.concatenate([np.asarray(angle_list[i], dtype = np.float64) for i in filament_numbers])
+        weights = np.concatenate([np.asarray(rln_scores[i], dtype = np.float64) for i in filament_numbers])
+        particle_filaments = np.repeat(np.arange(len(filament_numbers)), filament_lengths[filament_numbers])
+        if len(x_values) == 0:
+            continue
 
-        rot_angles[particle_no] = line_of_best_fit[particle_no]
+        #Votes are ordered particle, gradient
+        gradients = m_grids[filament_numbers][particle_filaments]
+        line_rows = (particle_filaments[:,None] * number_of_gradients + np.arange(number_of_gradients)).ravel()
+        intercepts = (angles[:,None] - gradients * x_values[:,None]).ravel()
 
-    corrected_adjusted_angles = fixrotAngles(rot_angles)
+        centres, scores = houghWindowSearch(line_rows, intercepts, np.repeat(weights, number_of_gradients), len(filament_numbers) * number_of_gradients, search_range)
+        centres = centres.reshape(len(filament_numbers), number_of_gradients)
+        scores = scores.reshape(len(filament_numbers), number_of_gradients)
 
-    return corrected_adjusted_angles
+        best_gradients = np.argmax(scores, axis = 1)
+        has_particles = filament_lengths[filament_numbers] > 0
+        rows = np.arange(len(filament_numbers))
+        best_m_scores[filament_numbers[has_particles]] = np.column_stack((m_grids[filament_numbers, best_gradients], centres[rows, best_gradients], scores[rows, best_gradients]))[has_particles]
+
+    return best_m_scores
+
+def houghRotFit(gradient_range, vectors, angle_list, rln_scores, search_range, levels = 3, steps = 9, memory_budget = DEFAULT_MEMORY_BUDGET):
+
+    '''Fits a line to the angles of each filament with a coarse-to-fine search
+    over the gradients in gradient_range - each level searches steps gradients
+    around the best one from the level before, with the spacing shrunk each
+    time. Every level is one houghLinearFitBatch over all the filaments, so the
+    cost of each filament is O(levels * steps * n log n)
+
+    Returns one [m, y, score] row per filament, with the fitted line wrapped'''
+
+    number_of_filaments = len(vectors)
+    low_gradient, high_gradient = min(gradient_range), max(gradient_range)
+    m_grids = np.tile(np.linspace(low_gradient, high_gradient, steps), (number_of_filaments, 1))
+
+    for level in range(levels):
+        best_m_scores = houghLinearFitBatch(m_grids, vectors, angle_list, rln_scores, search_range, memory_budget)
+        spacing = (m_grids[:,1] - m_grids[:,0]) if steps > 1 else np.zeros(number_of_filaments)
+        best_gradients = np.where(np.isnan(best_m_scores[:,0]), m_grids[:,0], best_m_scores[:,0])
+        m_grids = np.clip(best_gradients[:,None] + spacing[:,None] * np.linspace(-1, 1, steps), low_gradient, high_gradient)
+
+    return refineLineFits(best_m_scores, vectors, angle_list, search_range, gradient_range)
+
+def refineLineFits(best_m_scores, vectors, angle_list, search_range, gradient_range):
+
+    '''Least squares fit of each line to the particles within search_range of
+    it, keeping the gradient in gradient_range. The sums for every filament are
+    made in one pass with bincount. Lines that would lose particles by the fit
+    are left as they are'''
+
+    filament_lengths = np.array([len(vector) for vector in vectors], dtype = np.int64)
+    if filament_lengths.sum() == 0:
+        return best_m_scores
+
+    x_values = np.concatenate([np.asarray(vector, dtype = np.float64) for vector in vectors])
+    angles = np.concatenate([np.asarray(angles, dtype = np.float64) for angles in angle_list])
+    particle_filaments = np.repeat(np.arange(len(filament_lengths)), filament_lengths)
+
+    gradients = best_m_scores[particle_filaments, 0]
+    intercepts = best_m_scores[particle_filaments, 1]
+    with np.errstate(invalid = 'ignore'):
+        residuals = angularResiduals(angles, linRegress(x_values, intercepts, gradients))
+        inliers = np.abs(residuals) <= search_range
+
+    def filamentSums(values):
+        return np.bincount(particle_filaments[inliers], values[inliers], minlength = len(filament_lengths))
+
+    #Fit the residuals of the inliers as a line and add it on
+    count = filamentSums(np.ones(len(x_values)))
+    sum_x, sum_xx = filamentSums(x_values), filamentSums(x_values**2)
+    sum_r, sum_xr = filamentSums(residuals), filamentSums(x_values * residuals)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        determinant = count * sum_xx - sum_x**2
+        gradient_change = np.where(determinant > 0, (count * sum_xr - sum_x * sum_r) / determinant, 0)
+
+    refined = best_m_scores.copy()
+    refined[:,0] = np.clip(best_m_scores[:,0] + gradient_change, min(gradient_range), max(gradient_range))
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        #The intercept that centres the inliers on the refined gradient
+        intercept_change = np.where(count > 0, (sum_r - (refined[:,0] - best_m_scores[:,0]) * sum_x) / count, 0)
+    refined[:,1] = wrapAngles(best_m_scores[:,1] + intercept_change)
+
+    #Keep the original line where the fit would lose particles
+    with np.errstate(invalid = 'ignore'):
+        refined_inliers = np.abs(angularResiduals(angles, linRegress(x_values, refined[particle_filaments, 1], refined[particle_filaments, 0]))) <= search_range
+    lost_particles = np.bincount(particle_filaments, refined_inliers, minlength = len(filament_lengths)) < count
+    refined[lost_particles] = best_m_scores[lost_particles]
+
+    return refined
+
+def fitSegmentPolynomials(x_values, y_values, offsets, degree = 2, weights = None):
+
+    '''Weighted least squares fit of a polynomial of y against x for every
+    filament at once, where filament i is rows offsets[i]:offsets[i+1]. Returns
+    the fitted y of every particle
+
+    The normal equations of all the filaments are built from segment sums of
+    powers of x (centred and scaled per filament to keep them well
+    conditioned) and solved together. Filaments with too few particles for the
+    degree get the highest degree they can, and filaments with no weight get
+    nan'''
+
+    offsets = np.asarray(offsets, dtype = np.int64)
+    counts = np.diff(offsets)
+    number_of_filaments = len(counts)
+    particle_filaments = np.repeat(np.arange(number_of_filaments), counts)
+
+    x_values = np.asarray(x_values, dtype = np.float64)
+    y_values = np.asarray(y_values, dtype = np.float64)
+    weights = np.ones(len(x_values)) if weights is None else np.asarray(weights, dtype = np.float64)
+
+    def filamentSums(values):
+        return np.bincount(particle_filaments, values, minlength = number_of_filaments)
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        centres = np.nan_to_num(filamentSums(x_values) / counts)
+    spreads = np.zeros(number_of_filaments)
+    non_empty = counts > 0
+    if non_empty.any():
+        spreads[non_empty] = np.maximum.reduceat(np.abs(x_values - centres[particle_filaments]), offsets[:-1][non_empty])
+    scales = np.where(spreads > 0, spreads, 1)
+
+    scaled_x = (x_values - centres[particle_filaments]) / scales[particle_filaments]
+    powers = scaled_x[:,None] ** np.arange(2 * degree + 1)
+    moments = np.stack([filamentSums(weights * powers[:,k]) for k in range(2 * degree + 1)], axis = 1)
+    projections = np.stack([filamentSums(weights * y_values * powers[:,k]) for k in range(degree + 1)], axis = 1)
+
+    fitted = np.full(len(x_values), np.nan)
+    fitted_filaments = np.zeros(number_of_filaments, dtype = bool)
+
+    for fit_degree in range(degree, -1, -1):
+        terms = np.arange(fit_degree + 1)
+        normal_matrices = moments[:, terms[:,None] + terms[None,:]]
+
+        to_fit = ~fitted_filaments & (counts > fit_degree) & (moments[:,0] > 0)
+        if fit_degree > 0 and to_fit.any():
+            with np.errstate(divide = 'ignore', invalid = 'ignore'):
+                to_fit[to_fit] = np.linalg.cond(normal_matrices[to_fit]) < 1e10
+        if not to_fit.any():
+            continue
+
+        coefficients = np.zeros((number_of_filaments, fit_degree + 1))
+        coefficients[to_fit] = np.linalg.solve(normal_matrices[to_fit], projections[to_fit,:fit_degree + 1,None])[...,0]
+
+        particles = to_fit[particle_filaments]
+        fitted[particles] = np.einsum('ij,ij->i', powers[particles,:fit_degree + 1], coefficients[particle_filaments[particles]])
+        fitted_filaments |= to_fit
+
+    return fitted
+
+def fitPolynomial(x_shifts, y_shifts, p_nums, degree = 2):
+
+    '''Fits polynomials to the x and y shifts of one filament against p_nums
+    (e.g. the helical track length) and returns the fitted shifts'''
+
+    offsets = [0, len(p_nums)]
+    uniX = fitSegmentPolynomials(p_nums, x_shifts, offsets, degree)
+    uniY = fitSegmentPolynomials(p_nums, y_shifts, offsets, degree)
+
+    return uniX, uniY